@@ -22,81 +22,153 @@ def lfilter_zi(b,a):
 
     zid=  b[1:n] - a[1:n]*b[0]
 
-    zi_matrix=pylab.linalg.inv(zin)*(pylab.matrix(zid).transpose())
-    zi_return=[]
+    return pylab.linalg.solve(zin, zid)
 
-    #convert the result into a regular array (not a matrix)
-    for i in range(len(zi_matrix)):
-      zi_return.append(float(zi_matrix[i][0]))
-
-    return pylab.array(zi_return)
-
-def filtfilt(b,a,x):
-    #For now only accepting 1d arrays
+def filtfilt(b,a,x,zi=None):
+    #Accepts 1d arrays, or 2d arrays which are filtered row by row (along 
+    #axis 1) in one go. zi (from lfilter_zi) can be passed in if it is known
     ntaps=max(len(a),len(b))
     edge=ntaps*3
 
-    if x.ndim != 1:
-        raise ValueError, "Filiflit is only accepting 1 dimension arrays."
+    if x.ndim not in [1, 2]:
+        raise ValueError, "Filiflit is only accepting 1 or 2 dimension arrays."
 
     #x must be bigger than edge
-    if x.size < edge:
+    if x.shape[-1] < edge:
         raise ValueError, "Input vector needs to be bigger than 3 * max(len(a),len(b)."
 
     if len(a) < ntaps:
-        a=pylab.r_[a,zeros(len(b)-len(a))]
+        a=pylab.r_[a,pylab.zeros(len(b)-len(a))]
 
     if len(b) < ntaps:
-        b=pylab.r_[b,zeros(len(a)-len(b))]
+        b=pylab.r_[b,pylab.zeros(len(a)-len(b))]
 
-    zi=lfilter_zi(b,a)
+    if zi is None:
+        zi=lfilter_zi(b,a)
 
+    x2=pylab.atleast_2d(x)
     #Grow the signal to have edges for stabilizing 
     #the filter with inverted replicas of the signal
-    s=pylab.r_[2*x[0]-x[edge:1:-1],x,2*x[-1]-x[-1:-edge:-1]]
+    s=pylab.hstack((2*x2[:,:1]-x2[:,edge:1:-1],x2,2*x2[:,-1:]-x2[:,-1:-edge:-1]))
     #in the case of one go we only need one of the extrems 
     # both are needed for filtfilt
 
-    (y,zf)=ss.lfilter(b,a,s,-1,zi*s[0])
+    (y,zf)=ss.lfilter(b,a,s,1,zi*s[:,:1])
+    y=y[:,::-1]
+
+    (y,zf)=ss.lfilter(b,a,y,1,zi*y[:,:1])
 
-    (y,zf)=ss.lfilter(b,a,pylab.flipud(y),-1,zi*y[-1])
+    y=y[:,edge-1:-edge+1][:,::-1]
+    if x.ndim == 1:
+        return y[0]
+    return y
 
-    return pylab.flipud(y[edge-1:-edge+1])
+#Filters designed by waveform_filter, keyed by (Fs, band)
+_waveform_filters = {}
+
+def waveform_filter(Fstop_lo = 800, Fpass_lo = 1000,
+                    Fpass_hi = 3000, Fstop_hi = 3500, Fs = 30000.):
+  """Return (b, a, zi) for the spike band pass filter. The design is done once
+  for each Fs and band and cached."""
+  key = (float(Fs), Fstop_lo, Fpass_lo, Fpass_hi, Fstop_hi)
+  if key not in _waveform_filters:
+    ws = [2*Fstop_lo/float(Fs), 2*Fstop_hi/float(Fs)]#2* because ws is in terms of nyquist freq which is .5*Fs
+    wp = [2*Fpass_lo/float(Fs), 2*Fpass_hi/float(Fs)]
+    b,a = ss.iirdesign(wp, ws, gpass=1, gstop=10)
+    _waveform_filters[key] = (b, a, lfilter_zi(b, a))
+  return _waveform_filters[key]
 
 #Band choices from http://www.scholarpedia.org/article/Spike_sorting#Step_i.29_Filtering
 def filter_waveforms(waveform, 
                      Fstop_lo = 800, Fpass_lo = 1000,
                      Fpass_hi = 3000, Fstop_hi = 3500, Fs = 30000.):
   """
-  waveform - m x n array. m waveforms each of n samples
+  waveform - m x n array. m waveforms each of n samples. Filtered in place.
   Fstop - stop band for high pass filter
   Fpass - pass band for high pass filter
   Fs - sampling frequency of spike waveform."""
-  ws = [2*Fstop_lo/Fs, 2*Fstop_hi/Fs]#2* because ws is in terms of nyquist freq which is .5*Fs
-  wp = [2*Fpass_lo/Fs, 2*Fpass_hi/Fs]
-  b,a = ss.iirdesign(wp, ws, gpass=1, gstop=10)
-  for n in range(waveform.shape[0]):
-    waveform[n,:] = filtfilt(b,a,waveform[n,:])#ss.lfilter(b,a, waveform[n,:])
+  b,a,zi = waveform_filter(Fstop_lo, Fpass_lo, Fpass_hi, Fstop_hi, Fs)
+  if waveform.shape[0] > 0:
+    waveform[:,:] = filtfilt(b,a,waveform,zi)
   
   return waveform
 
 def discard_artifacts(waveform, threshold_mv):
-  idx = pylab.find(waveform.max(axis=1) < threshold_mv)
-  waveform = waveform[idx,:]
+  waveform = waveform[waveform.max(axis=1) < threshold_mv,:]
   return waveform
 
 def align_spike_peaks(waveform, threshold_mv):
   """Align each spike by its peak and scrunch down length apropriately"""
+  return aligned_spikes(waveform, threshold_mv)[1]
+
+def aligned_spikes(waveform, threshold_mv):
+  """align_spike_peaks that also returns the row numbers (in waveform) of the 
+  spikes it keeps: (rows, aligned waveforms)"""
   #waveform -= pylab.matrix(waveform[:,:10].mean(axis=1)).T*pylab.matrix(pylab.ones((1,waveform.shape[1])))
-  idx = pylab.find(waveform.max(axis=1) < threshold_mv)
-  waveform = waveform[idx,:]
-  peak_idx = waveform.argmin(axis=1)#a row vector of the peak indices for each spike
-  idx = pylab.find((peak_idx > 5) & (peak_idx < 15))
-  wv = pylab.zeros((idx.size,30))
-  for n in range(idx.size):
-    wv[n,:] = waveform[idx[n],peak_idx[idx[n]]-6:peak_idx[idx[n]]+24]
+  rows = pylab.flatnonzero(waveform.max(axis=1) < threshold_mv)
+  peak_idx = waveform[rows].argmin(axis=1)#a row vector of the peak indices for each spike
+  idx = pylab.flatnonzero((peak_idx > 5) & (peak_idx < 15))
+  #Gather 30 samples from 6 before the peak of each spike
+  cols = peak_idx[idx,pylab.newaxis] + pylab.arange(-6,24)
+  wv = waveform[rows[idx,pylab.newaxis],cols].astype(float)
+  
+  return rows[idx], wv
+
+def waveform_blocks(nev_file, channel_list = None, block_spikes = 100000):
+  """Stream spike waveforms (in mV) out of a nev.NevFile block by block. Each
+  block is (packet ids, timestamps, waveforms) for the spikes on the listed
+  channels (all if None) among the next block_spikes packets of the file.
+  Each electrode's samples are decoded with its own width. If the electrodes
+  have different widths (and so different numbers of samples) the spikes of 
+  each block are yielded as one block per width."""
+  neuw = nev_file.extended_header['neural event waveform']
+  mVperLSB = pylab.zeros(max(neuw.keys()) + 1 if neuw else 1)
+  for ch in neuw:
+    mVperLSB[ch] = neuw[ch]['nV per LSB'] * 1e-3
+  #Waveform format of each channel, as a code (index into formats)
+  formats = sorted(set([nev.channel_waveform_format(nev_file.waveforms.dtype, neuw[ch]) 
+                        for ch in neuw])) or [nev_file.waveforms.dtype.str]
+  format_code = pylab.zeros(mVperLSB.size, dtype=int)
+  for ch in neuw:
+    format_code[ch] = formats.index(nev.channel_waveform_format(nev_file.waveforms.dtype, neuw[ch]))
   
-  return wv
+  for n in range(0, len(nev_file), block_spikes):
+    pid = pylab.asarray(nev_file.packet_ids[n:n+block_spikes])
+    if channel_list is None:
+      keep = (pid > 0) & (pid < mVperLSB.size)
+    else:
+      keep = pylab.isin(pid, channel_list)
+    for code, fmt in enumerate(formats):
+      this = keep & (format_code[pylab.minimum(pid, mVperLSB.size - 1)] == code)
+      if len(formats) > 1 and not this.any():
+        continue
+      idx = n + pylab.flatnonzero(this)
+      wf = nev.channel_waveforms(nev_file.waveforms[idx], fmt) * mVperLSB[pid[this],pylab.newaxis]
+      yield pid[this], nev_file.timestamps[idx], wf
+
+def process_waveform_blocks(blocks, threshold_mv = None,
+                            Fstop_lo = 800, Fpass_lo = 1000,
+                            Fpass_hi = 3000, Fstop_hi = 3500, Fs = 30000.):
+  """Filter (and if threshold_mv is given, discard artifacts and align) the
+  waveforms of each block coming out of a block generator like waveform_blocks
+  and yield them. Blocks can be bare waveform matrices or tuples whose last
+  element is the waveform matrix. With alignment the other elements of a tuple
+  are subset to the spikes that are kept."""
+  for block in blocks:
+    if isinstance(block, tuple):
+      extra, waveform = block[:-1], block[-1]
+    else:
+      extra, waveform = None, block
+    waveform = filter_waveforms(pylab.array(waveform, dtype=float), 
+                                Fstop_lo, Fpass_lo, Fpass_hi, Fstop_hi, Fs)
+    if threshold_mv is not None:
+      keep, waveform = aligned_spikes(waveform, threshold_mv)
+      if extra is not None:
+        extra = tuple(pylab.asarray(e)[keep] for e in extra)
+    if extra is None:
+      yield waveform
+    else:
+      yield extra + (waveform,)
 
 def inspect_lfp(nsx_fname, channel = 1):
   """Plot the whole lfp for the given file."""
@@ -111,6 +183,49 @@ def inspect_lfp(nsx_fname, channel = 1):
   t_ms = 1000*pylab.arange(this_lfp.size)/Fs
   pylab.plot(t_ms, this_lfp)
 
+def spikes_in_windows(all_spike_time_ms, cerebus_times_ms, t1_ms = -50, t2_ms = 150):
+  """Cut a sorted spike train into windows around each trial by binary search.
+  
+  Inputs:
+    all_spike_time_ms : sorted spike times
+    cerebus_times_ms : an array of cerebus times indicating the start of the 
+                       stimuli
+    t1_ms : start time relative to cerebus_times_ms
+    t2_ms : end time relative to cerebus_times_ms (inclusive)
+  
+  Outputs:
+    spike_time_ms : flat array of the spike times in all the windows, relative
+                    to their cerebus_time, trial by trial
+    offsets : array of length n_trials + 1. The spikes of trial n are 
+              spike_time_ms[offsets[n]:offsets[n+1]]
+  """
+  all_spike_time_ms = pylab.asarray(all_spike_time_ms, dtype=float)
+  cerebus_times_ms = pylab.asarray(cerebus_times_ms, dtype=float).ravel()
+  lo = all_spike_time_ms.searchsorted(cerebus_times_ms + t1_ms, side='left')
+  hi = all_spike_time_ms.searchsorted(cerebus_times_ms + t2_ms, side='right')
+  counts = pylab.maximum(hi - lo, 0)
+  offsets = pylab.zeros(counts.size + 1, dtype=int)
+  pylab.cumsum(counts, out=offsets[1:])
+  #Index of each spike in the train: lo of its trial plus its place in the trial
+  idx = pylab.arange(offsets[-1]) + pylab.repeat(lo - offsets[:-1], counts)
+  spike_time_ms = all_spike_time_ms[idx] - pylab.repeat(cerebus_times_ms, counts)
+  return spike_time_ms, offsets
+
+def split_windows(spike_time_ms, offsets):
+  """Convert the flat array + offsets from spikes_in_windows into the old list
+  format (one array per trial, None for trials with no spikes)"""
+  return [spike_time_ms[offsets[n]:offsets[n+1]] if offsets[n+1] > offsets[n] else None 
+          for n in range(offsets.size - 1)]
+
+def join_windows(spike_time_ms):
+  """Inverse of split_windows: list of arrays (or Nones) -> flat array, offsets"""
+  counts = [0 if st is None else len(st) for st in spike_time_ms]
+  offsets = pylab.zeros(len(counts) + 1, dtype=int)
+  pylab.cumsum(counts, out=offsets[1:])
+  parts = [pylab.asarray(st, dtype=float) for st in spike_time_ms if st is not None]
+  flat = pylab.concatenate(parts) if parts else pylab.zeros(0)
+  return flat, offsets
+
 def get_spikes_in_window(cerebus_times_ms = None,
                t1_ms = -50,
                t2_ms = 150,
@@ -118,7 +233,8 @@ def get_spikes_in_window(cerebus_times_ms = None,
                nev_extended_header = None,
                frag_dir = None,
                channel = 0,
-               unit = 0):
+               unit = 0,
+               flat = False):
   """A reading function that reads in data from the cerebus spike files. 
   (Replaces get_spikes)
   
@@ -133,6 +249,8 @@ def get_spikes_in_window(cerebus_times_ms = None,
     frag_dir - directory where fragmented nev file is (absolute)
     channel - the channel we worry about
     unit - the unit  
+    flat - if true return the (spike_time_ms, offsets) of spikes_in_windows 
+           instead of a list
                  
   Outputs:
     spike_time_ms : list (length same as cerebus_times) of spike times, given
@@ -147,49 +265,173 @@ def get_spikes_in_window(cerebus_times_ms = None,
                  unit = unit,
                  tstart_ms = 0.0,
                  tdur_ms = -1,
-                 load_waveform = False,
-                 buffer_increment_size = 1000)    
-  all_spike_time_ms = data['spike time ms']
-    
-  spike_time_ms = [None] * cerebus_times_ms.size
-  for n in range(cerebus_times_ms.size):
-    tstart_ms = cerebus_times_ms[n] + t1_ms #all times in ms
-    tstop_ms = cerebus_times_ms[n] + t2_ms
-    idx = pylab.find((all_spike_time_ms >= tstart_ms) & (all_spike_time_ms <= tstop_ms))
-    if idx.size > 0:
-      rel_spike_time_ms = all_spike_time_ms[idx] - cerebus_times_ms[n]
-      spike_time_ms[n] = rel_spike_time_ms
-  
-  return spike_time_ms
-
-def spike_psth(spike_time_ms, t1_ms = -50., t2_ms = 250., bin_ms = 1):
-  """."""
-  N_trials = len(spike_time_ms)
-  t2_ms = pylab.ceil((t2_ms - t1_ms) / bin_ms)*bin_ms + t1_ms
-  N_bins = (t2_ms - t1_ms) / bin_ms
-  
-  spike_count_by_trial = pylab.zeros((N_trials,N_bins),dtype=float)
-  if N_trials > 0:
-    all_spikes_ms = pylab.array([],dtype=float)
-    for trial in range(len(spike_time_ms)):
-      if spike_time_ms[trial] is None:
-        continue
-      idx = pylab.find((spike_time_ms[trial] >= t1_ms) & 
-                       (spike_time_ms[trial] <= t2_ms))
-      spike_count_by_trial[trial,:], bin_edges = \
-        pylab.histogram(spike_time_ms[trial][idx], bins = N_bins, 
-                        range = (t1_ms, t2_ms))
-      
+                 load_waveform = False)    
+  
+  spike_time_ms, offsets = spikes_in_windows(data['spike time ms'], 
+                                             cerebus_times_ms, t1_ms, t2_ms)
+  if flat:
+    return spike_time_ms, offsets
+  return split_windows(spike_time_ms, offsets)
+
+def get_all_spikes_in_window(cerebus_times_ms = None,
+               t1_ms = -50,
+               t2_ms = 150,
+               nev_basic_header = None,
+               nev_extended_header = None,
+               frag_dir = None,
+               units = None):
+  """Multi unit version of get_spikes_in_window.
+  
+  Inputs:
+    as for get_spikes_in_window, except
+    units - list of (channel, unit) pairs. If None, every unit in frag_dir
+  
+  Outputs:
+    dictionary keyed by (channel, unit) with the (spike_time_ms, offsets) of
+    spikes_in_windows for that unit
+  """
+  if units is None:
+    units = nev.list_frag_units(frag_dir)
+  
+  windows = {}
+  for channel, unit in units:
+    windows[(channel, unit)] = \
+      get_spikes_in_window(cerebus_times_ms, t1_ms, t2_ms, 
+                           nev_basic_header, nev_extended_header, frag_dir, 
+                           channel, unit, flat = True)
+  return windows
+
+def psth_bins(t1_ms = -50., t2_ms = 250., bin_ms = 1):
+  """Stretch t2_ms so the window is a whole number of bins and return the bin
+  edges"""
+  N_bins = int(pylab.ceil((t2_ms - t1_ms) / float(bin_ms)))
+  t2_ms = N_bins*bin_ms + t1_ms
+  return pylab.linspace(t1_ms, t2_ms, N_bins + 1)
+
+def psth_counts(spike_time_ms, offsets, bin_edges):
+  """The PSTH engine. Given the flat spike times and trial offsets (see 
+  spikes_in_windows) return the n_trials x n_bins spike count matrix. Bins are
+  closed on the left, and the last bin is closed on both sides, as for 
+  pylab.histogram. Spikes outside the edges are ignored."""
+  N_trials = offsets.size - 1
+  N_bins = bin_edges.size - 1
+  spike_time_ms = pylab.asarray(spike_time_ms, dtype=float)
+  trial = pylab.repeat(pylab.arange(N_trials), pylab.diff(offsets))
+  keep = (spike_time_ms >= bin_edges[0]) & (spike_time_ms <= bin_edges[-1])
+  bin_idx = bin_edges.searchsorted(spike_time_ms[keep], side='right') - 1
+  bin_idx[bin_idx == N_bins] = N_bins - 1 #spikes right on the last edge
+  counts = pylab.bincount(trial[keep] * N_bins + bin_idx, 
+                          minlength = N_trials * N_bins)
+  return counts.reshape(N_trials, N_bins).astype(float)
+
+def psth_kernel(smooth = 'gaussian', smooth_ms = 10., bin_ms = 1):
+  """Normalized smoothing kernel, in bins. smooth is 'gaussian' (smooth_ms is
+  the sd) or 'boxcar' (smooth_ms is the width)"""
+  if smooth == 'gaussian':
+    half = int(pylab.ceil(3 * smooth_ms / float(bin_ms)))
+    x = pylab.arange(-half, half + 1) * float(bin_ms)
+    kernel = pylab.exp(-0.5 * (x / smooth_ms)**2)
+  elif smooth == 'boxcar':
+    half = int(smooth_ms / float(bin_ms) / 2.0)
+    kernel = pylab.ones(2 * half + 1)
+  else:
+    raise ValueError('Unknown smoothing kernel %s' %(smooth))
+  return kernel / kernel.sum()
+
+def smooth_psth(counts, kernel):
+  """Convolve each row of counts with the (odd length) kernel, keeping the 
+  size the same (zeros outside the window)"""
+  half = kernel.size // 2
+  padded = pylab.hstack((counts, pylab.zeros((counts.shape[0], half))))
+  return ss.lfilter(kernel, [1.], padded, axis = 1)[:, half:]
+
+def spike_psth(spike_time_ms, t1_ms = -50., t2_ms = 250., bin_ms = 1,
+               offsets = None, smooth = None, smooth_ms = 10.):
+  """Compute the PSTH.
+  
+  Inputs:
+    spike_time_ms : list of spike times for each trial (as from 
+                    get_spikes_in_window) or, if offsets is given, the flat 
+                    spike times from spikes_in_windows
+    t1_ms, t2_ms : window. t2_ms is pushed out to give a whole number of bins
+    bin_ms : bin size
+    offsets : trial offsets from spikes_in_windows
+    smooth : None, 'gaussian' or 'boxcar' (see psth_kernel)
+    smooth_ms : width of the smoothing kernel
+  
+  Outputs:
+    spike_rate : mean rate in spikes/s across trials in each bin
+    spike_count_by_trial : n_trials x n_bins
+    bin_center_ms
+  """
+  if offsets is None:
+    spike_time_ms, offsets = join_windows(spike_time_ms)
+  bin_edges = psth_bins(t1_ms, t2_ms, bin_ms)
+  
+  spike_count_by_trial = psth_counts(spike_time_ms, offsets, bin_edges)
+  if smooth is not None:
+    spike_count_by_trial = smooth_psth(spike_count_by_trial, 
+                                       psth_kernel(smooth, smooth_ms, bin_ms))
+  if spike_count_by_trial.shape[0] > 0:
     spike_rate = 1000*spike_count_by_trial.mean(axis=0)/bin_ms
   else:
     spike_rate = pylab.nan
 
-  dummy, bin_edges = \
-    pylab.histogram(None, bins = N_bins, range = (t1_ms, t2_ms))
   bin_center_ms = (bin_edges[1:] + bin_edges[:-1])/2.0
 
   return spike_rate, spike_count_by_trial, bin_center_ms
 
+def get_lfp_stack(cerebus_times_ms = None,
+              t1_ms = -50,
+              t2_ms = 150,
+              p_thresh = +400,
+              n_thresh = -400,
+              nsx_basic_header = None,
+              f_nsx = None,
+              channel_list = None):
+  """Read the lfp around every trial from all the channels we want in one pass 
+  over the ns3 file.
+  
+  Inputs:
+    cerebus_times_ms : an array of cerebus times indicating the start of the 
+                      stimuli
+    t1_ms : start time relative to cerebus_times_ms
+    t2_ms : end time relative to cerebus_times_ms 
+
+    p_thresh : If waveform exceeds this positive threshold, discard
+    n_thresh : If waveform exceeds this negative threshold, discard
+    
+    nsx_basic_header :
+    f_nsx : file handle
+    channel_list : channels to read (default [1])
+                               
+  Outputs:
+    lfps : n_trials x n_channels x n_samples array
+    good : n_trials x n_channels boolean array, false for the traces that cross
+           a threshold (or start outside the file). Traces that run off the
+           end of the file are zero past the end (as read_channel gives them)
+    t_ms : time of each sample relative to cerebus_times_ms
+  """
+  if channel_list is None:
+    channel_list = [1]
+  lfps, valid = nsx.read_epochs(f_nsx, nsx_basic_header, cerebus_times_ms,
+                                tpre_ms = -t1_ms, tdur_ms = t2_ms - t1_ms,
+                                channel_list = channel_list)
+  good = (lfps.max(axis=2) < p_thresh) & (lfps.min(axis=2) > n_thresh)
+  good &= valid[:, pylab.newaxis]
+  
+  Fs = float(nsx_basic_header['Fs Hz'])
+  t_ms = 1000*pylab.arange(lfps.shape[2])/Fs + t1_ms
+  return lfps, good, t_ms
+
+def mean_lfp_stack(lfps, good):
+  """Given the output of get_lfp_stack return the mean over the good trials 
+  (n_channels x n_samples) and the number of good trials for each channel"""
+  trace_count = good.sum(axis=0)
+  mean_lfp = (lfps * good[:,:,pylab.newaxis]).sum(axis=0, dtype=float)
+  mean_lfp /= trace_count[:, pylab.newaxis].astype(float)
+  return mean_lfp, trace_count
+
 def get_lfp_in_window(cerebus_times_ms = None,
               t1_ms = -50,
               t2_ms = 150,
@@ -201,7 +443,7 @@ def get_lfp_in_window(cerebus_times_ms = None,
               f_nsx = None,
               channel = 0):
   """A reading function that reads in data from the cerebus ns3 files to grab the
-  lfp. 
+  lfp. (Single channel version of get_lfp_stack)
   
   Inputs:
     cerebus_times_ms : an array of cerebus times indicating the start of the 
@@ -225,31 +467,12 @@ def get_lfp_in_window(cerebus_times_ms = None,
     mean_lfp : the mean lfp
     
   """
-    
-  trace_count = 0
-  tdur_ms = t2_ms - t1_ms
-  N_lfp = nsx.length_of_lfp(nsx_basic_header, tdur_ms)
-  
-  lfps = []
-  mean_lfp = pylab.zeros(N_lfp, dtype=float)
-  for n in range(cerebus_times_ms.size):
-    tstart_ms = cerebus_times_ms[n] + t1_ms #all times in ms
-    this_lfp = nsx.read_channel(f_nsx, nsx_basic_header,
-                                channel, 
-                                tstart_ms = tstart_ms,
-                                tdur_ms = tdur_ms)
-    if (this_lfp.max() < p_thresh) and (this_lfp.min() > n_thresh):
-    #if threshold == None or pylab.absolute(this_lfp.max()) < threshold:
-      lfps.append(this_lfp)
-      mean_lfp += this_lfp
-      trace_count += 1
-    else:
-      lfps.append(None)
-      
-  mean_lfp /= float(trace_count)#cerebus_times_ms.size
-  Fs = float(nsx_basic_header['Fs Hz'])
-  t_ms = 1000*pylab.arange(N_lfp)/Fs + t1_ms
-  return lfps, mean_lfp, t_ms
+  stack, good, t_ms = get_lfp_stack(cerebus_times_ms, t1_ms, t2_ms, 
+                                    p_thresh, n_thresh,
+                                    nsx_basic_header, f_nsx, [channel])
+  lfps = [stack[n,0] if good[n,0] else None for n in range(stack.shape[0])]
+  mean_lfp, trace_count = mean_lfp_stack(stack, good)
+  return lfps, mean_lfp[0], t_ms
 
   
 # To remove --------------------------------------------------------------------
@@ -283,35 +506,14 @@ def get_spikes(cerebus_times_ms = None,
   channel = fun_args['channel']
   unit = fun_args['unit']
   
-  # Read in the whole spike train - warning, if you read in the spike 
-  # waveforms as well, you may run outta memory
-  data, dummy = nev.read_frag_unit(
-                 frag_dir, nev_basic_header, nev_extended_header,
-                 channel = channel, 
-                 unit = unit,
-                 tstart_ms = 0.0,
-                 tdur_ms = -1,
-                 load_waveform = False,
-                 buffer_increment_size = 1000)    
-  all_spike_time_ms = data['spike time ms']
-    
-  spike_counts = pylab.zeros((cerebus_times_ms.size),dtype=float)
-  #mean_latency_ms = pylab.ones((cerebus_times_ms.size),dtype=float) * 1000
-  spike_time_ms = [None] * cerebus_times_ms.size
-  for n in range(cerebus_times_ms.size):
-    tstart_ms = cerebus_times_ms[n] + t1_ms #all times in ms
-    tstop_ms = cerebus_times_ms[n] + t2_ms
-    idx = pylab.find((all_spike_time_ms >= tstart_ms) & (all_spike_time_ms <= tstop_ms))
-    spike_counts[n] = idx.size
-    if idx.size > 0:
-      rel_spike_time_ms = all_spike_time_ms[idx] - cerebus_times_ms[n]
-      #mean_latency_ms[n] = rel_spike_time_ms.mean()
-      spike_time_ms[n] = rel_spike_time_ms
+  spike_time_ms, offsets = \
+    get_spikes_in_window(cerebus_times_ms, t1_ms, t2_ms, 
+                         nev_basic_header, nev_extended_header, frag_dir, 
+                         channel, unit, flat = True)
   
   data = {'trials': cerebus_times_ms.size,
-          'spike counts': spike_counts, 
-          #'mean latency ms': mean_latency_ms, 
-          'spike times ms': spike_time_ms}
+          'spike counts': pylab.diff(offsets).astype(float), 
+          'spike times ms': split_windows(spike_time_ms, offsets)}
   return data
 
 def get_lfp(cerebus_times_ms = None,
@@ -345,51 +547,26 @@ def get_lfp(cerebus_times_ms = None,
   p_thresh = fun_args.get('pos threshold', +400)
   n_thresh = fun_args.get('neg threshold', -400)
     
-  trace_count = 0
-  tdur_ms = t2_ms - t1_ms
-  N_lfp = nsx.length_of_lfp(basic_header, tdur_ms)
-  
-  mean_lfp = pylab.zeros(N_lfp, dtype=float)
-  for n in range(cerebus_times_ms.size):
-    tstart_ms = cerebus_times_ms[n] + t1_ms #all times in ms
-    this_lfp = nsx.read_channel(f_nsx, basic_header,
-                                channel, 
-                                tstart_ms = tstart_ms,
-                                tdur_ms = tdur_ms)
-    if (this_lfp.max() < p_thresh) and (this_lfp.min() > n_thresh):
-    #if threshold == None or pylab.absolute(this_lfp.max()) < threshold:
-      mean_lfp += this_lfp
-      trace_count += 1
-  
-  mean_lfp /= float(trace_count)#cerebus_times_ms.size
+  stack, good, t_ms = get_lfp_stack(cerebus_times_ms, t1_ms, t2_ms, 
+                                    p_thresh, n_thresh,
+                                    basic_header, f_nsx, [channel])
+  mean_lfp, trace_count = mean_lfp_stack(stack, good)
   
   data = {'total trials':cerebus_times_ms.size, 
-          'trials': trace_count, #The number of valid trials
-          'mean lfp': mean_lfp,
+          'trials': int(trace_count[0]), #The number of valid trials
+          'mean lfp': mean_lfp[0],
           'Fs Hz': float(basic_header['Fs Hz'])}
     
   return data
 
 def old_spike_psth(data, t1_ms = -250., t2_ms = 0., bin_ms = 10):
   """Uses data format returned by get_spikes"""
-  spike_time_ms = data['spike times ms']
   N_trials = data['trials']
-  t2_ms = pylab.ceil((t2_ms - t1_ms) / bin_ms)*bin_ms + t1_ms
-  N_bins = (t2_ms - t1_ms) / bin_ms
+  bin_edges = psth_bins(t1_ms, t2_ms, bin_ms)
   
   if N_trials > 0:
-    all_spikes_ms = pylab.array([],dtype=float)
-    for trial in range(len(spike_time_ms)):
-      if spike_time_ms[trial] is None:
-        continue
-      idx = pylab.find((spike_time_ms[trial] >= t1_ms) & 
-                       (spike_time_ms[trial] <= t2_ms))
-      all_spikes_ms = \
-        pylab.concatenate((all_spikes_ms, spike_time_ms[trial][idx]))
-    spike_n_bin, bin_edges = \
-      pylab.histogram(all_spikes_ms, bins = N_bins, 
-                      range = (t1_ms, t2_ms), new = True)
-
+    spike_time_ms, offsets = join_windows(data['spike times ms'])
+    spike_n_bin = psth_counts(spike_time_ms, offsets, bin_edges).sum(axis=0)
     spikes_per_trial_in_bin = spike_n_bin/float(N_trials) 
     spike_rate = 1000*spikes_per_trial_in_bin/bin_ms
   else:
@@ -430,27 +607,14 @@ def old_get_lfp(cerebus_times_ms = None,
   p_thresh = fun_args.get('pos threshold', +400)
   n_thresh = fun_args.get('neg threshold', -400)
     
-  trace_count = 0
-  tdur_ms = t2_ms - t1_ms
-  N_lfp = nsx.length_of_lfp(basic_header, tdur_ms)
-  
-  mean_lfp = pylab.zeros(N_lfp, dtype=float)
-  for n in range(cerebus_times_ms.size):
-    tstart_ms = cerebus_times_ms[n] + t1_ms #all times in ms
-    this_lfp = nsx.read_channel(f_nsx, basic_header,
-                                channel, 
-                                tstart_ms = tstart_ms,
-                                tdur_ms = tdur_ms)
-    if (this_lfp.max() < p_thresh) and (this_lfp.min() > n_thresh):
-    #if threshold == None or pylab.absolute(this_lfp.max()) < threshold:
-      mean_lfp += this_lfp
-      trace_count += 1
-  
-  mean_lfp /= float(trace_count)#cerebus_times_ms.size
+  stack, good, t_ms = get_lfp_stack(cerebus_times_ms, t1_ms, t2_ms, 
+                                    p_thresh, n_thresh,
+                                    basic_header, f_nsx, [channel])
+  mean_lfp, trace_count = mean_lfp_stack(stack, good)
   
   data = {'total trials':cerebus_times_ms.size, 
-          'trials': trace_count, #The number of valid trials
-          'mean lfp': mean_lfp,
+          'trials': int(trace_count[0]), #The number of valid trials
+          'mean lfp': mean_lfp[0],
           'Fs Hz': float(basic_header['Fs Hz'])}
     
   return data
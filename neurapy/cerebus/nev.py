@@ -247,22 +247,124 @@ def read_next_marker(f, basic_header, extended_header):
   
   return t, code
 
-import resource
-#to set open file limits
+# Vectorized reading -----------------------------------------------------------
+
+def packet_dtype(basic_header, extended_header):
+  """Return a numpy dtype for the data packets in this file. The fields are
+  'timestamp' - in clock cycles (see 'time stamp resolution Hz')
+  'packet id' - electrode number, 0 for non neural (digital input) packets
+  'unit' - online sorted unit, 0 for unclassified
+  'waveform' - the spike waveform, as int16 or int8 depending on the bytes per
+               waveform sample in the extended header. If the electrodes have
+               different sample widths this is left as raw bytes
+  'digital' - value of the digital input port (only makes sense for packet id 0
+              packets; it shares bytes with the waveform)
+  """
+  bytes_in_data_packets = basic_header['bytes in data packets']
+  widths = set([max(1, v['bytes per waveform sample']) for v in 
+                extended_header['neural event waveform'].values()])
+  if basic_header['spike waveform is 16bit'] or widths == set([2]):
+    waveform_format, width = '<i2', 2
+  elif widths == set([1]):
+    waveform_format, width = 'i1', 1
+  else:
+    logger.warning('Mixed waveform sample widths %s, leaving waveforms as raw bytes' %(widths))
+    waveform_format, width = 'u1', 1
+  samples = (bytes_in_data_packets - 8)/width
+  return numpy.dtype({
+    'names': ['timestamp', 'packet id', 'unit', 'reserved', 'waveform', 'digital'],
+    'formats': ['<u4', '<u2', 'u1', 'u1', (waveform_format, int(samples)), '<u2'],
+    'offsets': [0, 4, 6, 7, 8, 8],
+    'itemsize': bytes_in_data_packets})
+
+def channel_waveform_format(waveform_dtype, channel_info_dict):
+  """The numpy format of one electrode's waveform samples. The same as the
+  'waveform' field of packet_dtype unless the electrodes have different sample
+  widths, when that field is raw bytes and each electrode has its own format
+  ('<i2' or '|i1', from its 'bytes per waveform sample')"""
+  waveform_dtype = numpy.dtype(waveform_dtype)
+  if waveform_dtype != numpy.uint8 or channel_info_dict is None:
+    return waveform_dtype.str
+  if channel_info_dict['bytes per waveform sample'] == 2:
+    return '<i2'
+  return '|i1'
+
+def channel_waveforms(waveforms, waveform_format):
+  """Waveform rows (n spikes x n samples) in the format from 
+  channel_waveform_format. Raw byte rows are copied and reinterpreted, so a 2
+  byte electrode gets half as many samples per row"""
+  if waveforms.dtype == numpy.dtype(waveform_format):
+    return waveforms
+  return numpy.ascontiguousarray(waveforms).view(waveform_format)
+
+class NevFile(object):
+  """Memory-mapped access to all the data packets of a nev file at once.
+  
+  The packet region is mapped with the dtype from packet_dtype, so reading the
+  file costs nothing until we touch the data, and 
+    timestamps, packet_ids, units, waveforms
+  are column views into the file that do not copy anything. Select packets with
+  the usual numpy tricks e.g. 
+  
+  nf = nev.NevFile('datafile001.nev')
+  idx = (nf.packet_ids == 12) & (nf.units == 0)
+  spike_time_ms = nf.time_ms()[idx]
+  waveforms = nf.waveforms[idx]
+  """
+  
+  def __init__(self, fname):
+    f = open(fname, 'rb')
+    self.basic_header = read_basic_header(f)
+    self.extended_header = read_extended_header(f, self.basic_header)
+    f.close()
+    
+    bytes_in_headers = self.basic_header['bytes in headers']
+    bytes_in_data_packets = self.basic_header['bytes in data packets']
+    N = int((self.basic_header['file size'] - bytes_in_headers)//bytes_in_data_packets)
+    self.dtype = packet_dtype(self.basic_header, self.extended_header)
+    if N > 0:
+      self.packets = numpy.memmap(fname, dtype=self.dtype, mode='r', 
+                                  offset=bytes_in_headers, shape=(N,))
+    else:
+      self.packets = numpy.zeros(0, dtype=self.dtype)
+    logger.debug('NevFile: %d packets' %(N))
+    
+    self.timestamps = self.packets['timestamp']
+    self.packet_ids = self.packets['packet id']
+    self.units = self.packets['unit']
+    self.waveforms = self.packets['waveform']
+    
+  def __len__(self):
+    return self.packets.size
+  
+  def time_ms(self, idx = slice(None)):
+    """Packet times in ms (to match with lablib convention)"""
+    Fs = float(self.basic_header['time stamp resolution Hz'])
+    return self.timestamps[idx] * (1000.0/Fs)
+  
+  def digital(self):
+    """Times (ms) and values of the digital input port from the non neural 
+    packets. Same as read_frag_nonneural_digital."""
+    idx = numpy.flatnonzero(self.packet_ids == 0)
+    return self.time_ms(idx).astype('float32'), self.packets['digital'][idx]
 
 # Code to dump data enmasse in preperation for further analysis ----------------
 def fragment(f, basic_header, extended_header,
              frag_dir = 'myspikes/',
              channel_list = numpy.arange(1,97),
-             ignore_spike_sorting = True):
+             ignore_spike_sorting = True,
+             block_packets = 2**20):
   """Given a list of electrodes this will start from the beginning of the file
   and simply dump the spike times and the waveform for each electrode in a 
   separate file. 
   This automatically includes the non-neural events.
   Electrode numbering follows Cerebrus conventions i.e. starting from 1
   
-  We might want to rewrite this in C and wrap a python module round it:
-  http://starship.python.net/crew/mwh/toext/less-trivial.html
+  The file is read in blocks of block_packets packets. The packets of each block
+  are stably sorted by (packet id, unit), which keeps them in time order within
+  each group, and each group is appended to its file in one write. Files are
+  opened only while their group is written, so we never hold one open file per
+  unit.
   
   Inputs:
   f - pointer to nev file
@@ -271,92 +373,243 @@ def fragment(f, basic_header, extended_header,
   channel_list - all the required channels
   ignore_spike_sorting - if true, ignore any online sorted units and dump 
                          everything to unit 0
+  block_packets - how many packets to read at a time
   """
 
   if not os.path.exists(frag_dir):
     os.makedirs(frag_dir)
+  channel_list = numpy.asarray(channel_list)
   
-  #Open file
-  fnonneural = open(frag_dir + '/nonneural.bin', 'wb') 
+  def fname(key):
+    if key == 0:
+      return frag_dir + '/nonneural.bin'
+    return frag_dir + '/channel%02dunit%02d.bin' %(key >> 8, key & 0xff)
   
-  #Up the limit on open files if needed
-  fsoftlimit = resource.getrlimit(resource.RLIMIT_NOFILE)
-  if fsoftlimit[0] < channel_list.size * 10:
-    resource.setrlimit(resource.RLIMIT_NOFILE, (channel_list.size * 10,-1))
-  #We could do this more precisely but seriously, who has 10 spikes per electrode?
-
-  #open files for all the units
-  if channel_list.size > 0:
-    fout = [None]*(channel_list.max())
-  else:
-    fout = []
+  #Create (empty) files for all the units so that every expected file exists
   neuw = extended_header['neural event waveform']
   #print 'fragment: warning, for debugging purposes, fixing sorted units as 4 per electrode'
+  open(fname(0), 'wb').close()
   for channel in channel_list:
     if not ignore_spike_sorting:
       units_classified = neuw[channel]['number of sorted units']
     else:
       units_classified = 0
-      
-    #units_classified = 4
-    fout[channel-1] = [None]*(units_classified+1) #0 is always the unclassified one
-    for m in range(units_classified+1):
-      fname = frag_dir + '/channel%02dunit%02d.bin' %(channel,m)
-      fout[channel-1][m] = open(fname, 'wb')
+    for m in range(units_classified+1): #0 is always the unclassified one
+      open(fname((channel << 8) + m), 'wb').close()
   
   #Now just rewind and start redirecting the packets
   rewind(f, basic_header)
   
-  bytes_in_data_packets = basic_header['bytes in data packets']
-  eof = False
-  premature_eof = False  
+  dtype = packet_dtype(basic_header, extended_header)
   nnev_counter = 0
-  
-  percent_packets_read = 0
-  one_percent_packets = basic_header['total packets']/100
-  packet_counter = one_percent_packets
-  
-  while not eof:
-    #Read a the packet header
-    header_buffer = f.read(6)
-    if len(header_buffer) < 6:
-      eof = True
-      if len(header_buffer) > 0:
-        #This means we got cut off in an odd manner
-        logger.warning('fragment : premature end of file : rewinding')
-        premature_eof = True
-        rewind(f, basic_header)
+  packets_read = 0
+  packets = numpy.fromfile(f, dtype=dtype, count=block_packets)
+  while packets.size > 0:
+    pi = packets['packet id'].astype('int64')
+    if ignore_spike_sorting:
+      key = pi << 8
     else:
-      pi, = struct.unpack('H', header_buffer[4:])#packet id
-      if not pi:
-        fnonneural.write(header_buffer)
-        fnonneural.write(f.read(bytes_in_data_packets - 6))
-        nnev_counter += 1
-      elif pi in channel_list:
-        buffer = f.read(bytes_in_data_packets - 6)
-        if not ignore_spike_sorting:
-          sub_unit, =  struct.unpack('B', buffer[0])
-        else:
-          sub_unit = 0
-        thisfptr = fout[pi-1][sub_unit]
-        
-        thisfptr.write(header_buffer)
-        thisfptr.write(buffer)
-        #Note that even if we ignore online spike sorting, we preserve the unit
-        #identity
-      else:  
-        f.seek(bytes_in_data_packets - 6, 1) #skip appropriate number of bytes
-  
-    packet_counter -=1
-    if not packet_counter:
-      percent_packets_read += 1
-      #print 'dump_spike_data: %d%% packets read' %(percent_packets_read)
-      packet_counter = one_percent_packets
+      key = (pi << 8) + packets['unit']
+    key[pi == 0] = 0 #Non neural packets all go to one file
+    #Note that even if we ignore online spike sorting, we preserve the unit
+    #identity in the packets we write
+    
+    sel = numpy.flatnonzero((pi == 0) | numpy.isin(pi, channel_list))
+    order = sel[numpy.argsort(key[sel], kind='mergesort')] #mergesort is stable
+    sorted_key = key[order]
+    bounds = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(sorted_key)) + 1, [order.size]))
+    for n in range(bounds.size - 1):
+      k = int(sorted_key[bounds[n]])
+      fout = open(fname(k), 'ab')
+      packets[order[bounds[n]:bounds[n+1]]].tofile(fout)
+      fout.close()
+      if k == 0:
+        nnev_counter += bounds[n+1] - bounds[n]
+    
+    packets_read += packets.size
+    logger.debug('fragment: %d of %d packets read' %(packets_read, basic_header['total packets']))
+    packets = numpy.fromfile(f, dtype=dtype, count=block_packets)
+  
+  premature_eof = (basic_header['file size'] - basic_header['bytes in headers']) % \
+                  basic_header['bytes in data packets'] > 0
+  if premature_eof:
+    #This means we got cut off in an odd manner
+    logger.warning('fragment : premature end of file')
             
   logger.debug('fragment: found %d non neural packets' %(nnev_counter))
   
   return not premature_eof #return false if there was a problem
 
+# Columnar spike store ---------------------------------------------------------
+# A single file alternative to the fragmented directory. Layout:
+#   header (spike_store_header)
+#   group table (spike_store_group), one entry per (channel, unit), sorted
+#   timestamps of all spikes, uint32 clock cycles, sorted within each group
+#   waveforms of all spikes, n spikes x n samples
+# Group n owns spikes group['start'] to group['stop'] of the timestamp and
+# waveform arrays, so reading a time window of a unit is a binary search and a
+# slice of a memory map.
+# The waveforms are stored as they are in the nev file. If the electrodes have
+# different sample widths these are raw bytes, and each group records the format
+# of its own electrode (see channel_waveform_format).
+spike_store_version = 2
+spike_store_header = numpy.dtype([
+  ('magic', 'S8'),
+  ('version', '<u4'),
+  ('n groups', '<u4'),
+  ('n spikes', '<u8'),
+  ('n samples', '<u4'),
+  ('waveform format', 'S4'),
+  ('time stamp resolution Hz', '<f8')])
+spike_store_group = numpy.dtype([
+  ('channel', '<u2'),
+  ('unit', '<u2'),
+  ('nV per LSB', '<u2'),
+  ('waveform format', 'S4'),
+  ('start', '<u8'),
+  ('stop', '<u8')])
+
+def build_spike_store(nev_fname, store_fname, ignore_spike_sorting = True,
+                      block_spikes = 2**20):
+  """Write all the spikes in a nev file into a columnar spike store (see above)
+  that SpikeStore and read_frag_unit can read.
+  
+  Inputs:
+  nev_fname - the nev file
+  store_fname - the spike store file to write
+  ignore_spike_sorting - if true, ignore any online sorted units and put 
+                         everything in unit 0
+  block_spikes - how many waveforms to copy at a time
+  """
+  nf = NevFile(nev_fname)
+  neuw = nf.extended_header['neural event waveform']
+  
+  pi = numpy.array(nf.packet_ids)
+  neural = numpy.flatnonzero(pi > 0)
+  key = pi[neural].astype('int64') << 8
+  if not ignore_spike_sorting:
+    key += nf.units[neural]
+  #Sort by unit and then time (lexsort is stable, and the file is in time order)
+  order = neural[numpy.lexsort((nf.timestamps[neural], key))]
+  sorted_key = numpy.sort(key, kind='mergesort')
+  bounds = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(sorted_key)) + 1, [order.size]))
+  
+  n_groups = bounds.size - 1 if order.size > 0 else 0
+  groups = numpy.zeros(n_groups, dtype=spike_store_group)
+  groups['channel'] = sorted_key[bounds[:-1]][:n_groups] >> 8
+  groups['unit'] = sorted_key[bounds[:-1]][:n_groups] & 0xff
+  groups['nV per LSB'] = [neuw[c]['nV per LSB'] if c in neuw else 0 for c in groups['channel']]
+  groups['waveform format'] = [channel_waveform_format(nf.waveforms.dtype, neuw.get(c)).encode('ascii')
+                               for c in groups['channel']]
+  groups['start'] = bounds[:n_groups]
+  groups['stop'] = bounds[1:n_groups+1]
+  
+  header = numpy.zeros(1, dtype=spike_store_header)
+  header['magic'] = b'NEVSPIKE'
+  header['version'] = spike_store_version
+  header['n groups'] = n_groups
+  header['n spikes'] = order.size
+  header['n samples'] = nf.waveforms.shape[1]
+  header['waveform format'] = nf.waveforms.dtype.str.encode('ascii')
+  header['time stamp resolution Hz'] = nf.basic_header['time stamp resolution Hz']
+  
+  f = open(store_fname, 'wb')
+  header.tofile(f)
+  groups.tofile(f)
+  nf.timestamps[order].astype('<u4').tofile(f)
+  for n in range(0, order.size, block_spikes):
+    nf.waveforms[order[n:n+block_spikes]].tofile(f)
+  f.close()
+  logger.debug('build_spike_store: %d spikes in %d units' %(order.size, n_groups))
+
+class SpikeStore(object):
+  """Read a spike store written by build_spike_store.
+  
+  store = nev.SpikeStore('datafile001.spk')
+  data = store.read_unit(channel = 12, unit = 0, tstart_ms = 1000, tdur_ms = 500)
+  """
+  
+  def __init__(self, fname):
+    header = numpy.fromfile(fname, dtype=spike_store_header, count=1)
+    if header.size < 1 or header['magic'][0] != b'NEVSPIKE':
+      raise IOError('%s is not a spike store' %(fname))
+    header = header[0]
+    if header['version'] != spike_store_version:
+      raise IOError('%s is spike store version %d, need %d' %(fname, header['version'], spike_store_version))
+    
+    self.Fs = float(header['time stamp resolution Hz'])
+    n_groups = int(header['n groups'])
+    n_spikes = int(header['n spikes'])
+    n_samples = int(header['n samples'])
+    offset = spike_store_header.itemsize
+    f = open(fname, 'rb')
+    f.seek(offset)
+    self.groups = numpy.fromfile(f, dtype=spike_store_group, count=n_groups)
+    f.close()
+    offset += spike_store_group.itemsize * n_groups
+    if n_spikes > 0:
+      self.timestamps = numpy.memmap(fname, dtype='<u4', mode='r', offset=offset, shape=(n_spikes,))
+      offset += 4 * n_spikes
+      self.waveforms = numpy.memmap(fname, dtype=header['waveform format'].decode('ascii'), mode='r', 
+                                    offset=offset, shape=(n_spikes, n_samples))
+    else:
+      self.timestamps = numpy.zeros(0, dtype='<u4')
+      self.waveforms = numpy.zeros((0, n_samples), dtype=header['waveform format'].decode('ascii'))
+    self.group_index = dict(((int(g['channel']), int(g['unit'])), n) for n, g in enumerate(self.groups))
+  
+  def units(self):
+    """List of (channel, unit) in the store"""
+    return sorted(self.group_index.keys())
+  
+  def spike_range(self, channel = 1, unit = 0, tstart_ms = 0.0, tdur_ms = -1):
+    """Return (start, stop) such that timestamps[start:stop] are the spikes of
+    this unit with tstart_ms <= t < tstart_ms + tdur_ms. If tdur_ms < 0 go to
+    the end of the recording"""
+    n = self.group_index.get((channel, unit))
+    if n is None:
+      return 0, 0
+    start, stop = int(self.groups['start'][n]), int(self.groups['stop'][n])
+    ts = self.timestamps[start:stop]
+    ticks_per_ms = self.Fs/1000.0
+    lo = numpy.searchsorted(ts, _clip_ticks(numpy.ceil(tstart_ms * ticks_per_ms)))
+    if tdur_ms < 0:
+      hi = ts.size
+    else:
+      hi = numpy.searchsorted(ts, _clip_ticks(numpy.ceil((tstart_ms + tdur_ms) * ticks_per_ms)))
+    return start + int(lo), start + max(int(lo), int(hi))
+  
+  def read_unit(self, channel = 1, unit = 0, tstart_ms = 0.0, tdur_ms = 10.0, 
+                load_waveform = False):
+    """Same output as read_frag_unit (the data dictionary)"""
+    start, stop = self.spike_range(channel, unit, tstart_ms, tdur_ms)
+    data = {'spike time ms': (self.timestamps[start:stop] * (1000.0/self.Fs)).astype('float32')}
+    if load_waveform:
+      n = self.group_index.get((channel, unit))
+      if n is None:
+        data['waveform mV'] = numpy.zeros((0, self.waveforms.shape[1]), dtype='float32')
+      else:
+        mVperLSB = self.groups['nV per LSB'][n] * 1e-3
+        waveforms = channel_waveforms(self.waveforms[start:stop], 
+                                      self.groups['waveform format'][n].decode('ascii'))
+        data['waveform mV'] = (waveforms * mVperLSB).astype('float32')
+    return data
+
+_spike_stores = {}
+
+def open_spike_store(fname):
+  """Return a SpikeStore for fname, reusing the one opened earlier unless the
+  file has changed since (size or modification time)"""
+  fname = os.path.abspath(fname)
+  st = os.stat(fname)
+  key = (st.st_size, st.st_mtime)
+  if fname not in _spike_stores or _spike_stores[fname][0] != key:
+    _spike_stores[fname] = (key, SpikeStore(fname))
+  return _spike_stores[fname][1]
+
+def _clip_ticks(t):
+  """Clip a time in clock cycles to the uint32 range of the timestamps"""
+  return numpy.uint32(min(max(t, 0), 2**32 - 1))
+
 # Code to read data packets from fragmented files ------------------------------
 
 def read_frag_nonneural_digital(frag_dir, basic_header):
@@ -408,6 +661,20 @@ def read_frag_nonneural_digital(frag_dir, basic_header):
   return time_stamp_ms[:counter], codes[:counter]
 
 
+def list_frag_units(frag_dir):
+  """Return a sorted list of the (channel, unit) pairs in a fragmented 
+  directory, or a spike store file"""
+  if os.path.isfile(frag_dir):
+    return open_spike_store(frag_dir).units()
+  units = []
+  for fname in os.listdir(frag_dir):
+    if not (fname.startswith('channel') and fname.endswith('.bin')):
+      continue
+    ch, sep, un = fname[7:-4].partition('unit')
+    if sep and ch.isdigit() and un.isdigit():
+      units.append((int(ch), int(un)))
+  return sorted(units)
+
 def read_frag_unit(frag_dir, basic_header, extended_header,
                    channel = 1, 
                    unit = 0,
@@ -418,7 +685,8 @@ def read_frag_unit(frag_dir, basic_header, extended_header,
   """Given channel and unit number (0 for unsorted) and the time brackets
   return us the spike data with waveform if needed.
   
-  frag_dir - the directory the fragmented data is in
+  frag_dir - the directory the fragmented data is in, or a spike store file
+             written by build_spike_store
   basic_header - from reading the nev file
   extended_header - from the nev file
   channel - channel(pin) number
@@ -427,76 +695,61 @@ def read_frag_unit(frag_dir, basic_header, extended_header,
   tdur_ms - for this window. If set to -1 then all the data to the end of the 
             file is read
   load_waveform - if true loads the actual spike waveform as well
-  buffer_increment_size - an internal thing - we increase the size of the data
-                        arrays by this amount each time we overrun. We squeeze
-                        the arrays back to actual size once we are done
+  buffer_increment_size - no longer used, kept so old calls still work
+  
+  The unit's file is memory-mapped and the window is found by binary search on
+  the (sorted) spike times, so only the spikes in the window are read.
   """
   
   if channel < 1 or channel > 255:
     logger.warning('nev.read_frag_unit: Channel given (%d) out of range' %(channel))
     return
   
-  f = open(frag_dir + '/channel%02dunit%02d.bin' %(channel,unit))
+  if os.path.isfile(frag_dir):
+    return open_spike_store(frag_dir).read_unit(channel, unit, tstart_ms, 
+                                                tdur_ms, load_waveform), True
+  
+  fname = frag_dir + '/channel%02dunit%02d.bin' %(channel,unit)
   
   Fs = float(basic_header['time stamp resolution Hz'])
-  Ts = 1.0/Fs
   channel_info_dict = extended_header['neural event waveform'][channel]  
   bytes_in_data_packets = basic_header['bytes in data packets']
   
-  spike_time_ms = numpy.zeros(buffer_increment_size, dtype='float32')
   if load_waveform:
     mVperLSB = channel_info_dict['nV per LSB'] * 1e-3 #gives mV
     bytes_per_waveform_sample = channel_info_dict['bytes per waveform sample']  
-    if bytes_per_waveform_sample == 2:
-      waveform_format = 'h' #signed short
-    else:
+    if bytes_per_waveform_sample != 2:
       logger.warning('%d bytes in data packets not implemented yet' %(bytes_in_data_packets))
       return
-    waveform_size = (bytes_in_data_packets - 8)/bytes_per_waveform_sample
-    waveform = numpy.zeros((buffer_increment_size,waveform_size), dtype='float32')
- 
-  eof = False
-  premature_eof = False
-  counter = 0
-  current_buffer_size = spike_time_ms.size
-  tstop_ms = tstart_ms + tdur_ms
-  while not eof:
-    buffer = f.read(bytes_in_data_packets)
-    if len(buffer) < bytes_in_data_packets:
-      eof = True
-      if len(buffer) > 0:
-        #This means we got cut off in an odd manner
-        logger.warning('read_frag_unit: premature end of file indicative of serious error in dump_spike_data')
-        premature_eof = True
-    else:
-      timestamp, = struct.unpack('I', buffer[0:4])
-      tm_ms = timestamp * Ts * 1000 #cerebus time stamps are in clock cycles Ts is in s
-      
-      if tm_ms < tstart_ms:
-        continue
-      
-      if tdur_ms < 0 or tm_ms < tstop_ms:
-        spike_time_ms[counter] = tm_ms 
-        if load_waveform:
-          waveform[counter,:] = \
-            numpy.array(struct.unpack(waveform_size*waveform_format, buffer[8:])) * mVperLSB
-        
-        counter += 1
-        #print 'Loaded %d spikes' %(counter)
-        if counter == current_buffer_size: #Need to enlarge the buffer
-          spike_time_ms = \
-                numpy.concatenate((spike_time_ms, 
-                                   numpy.zeros(buffer_increment_size, dtype='float32')))
-          if load_waveform:
-            waveform = numpy.concatenate((waveform,
-                                         numpy.zeros((buffer_increment_size,waveform_size), dtype='float32')))
-          current_buffer_size = spike_time_ms.size
-      else:
-        eof = True
-        
-  data = {'spike time ms': spike_time_ms[:counter]}
+  
+  file_length_in_bytes = os.path.getsize(fname)
+  N = file_length_in_bytes//bytes_in_data_packets
+  premature_eof = file_length_in_bytes % bytes_in_data_packets > 0
+  if premature_eof:
+    #This means we got cut off in an odd manner
+    logger.warning('read_frag_unit: premature end of file indicative of serious error in dump_spike_data')
+  
+  if N > 0:
+    packets = numpy.memmap(fname, dtype=packet_dtype(basic_header, extended_header), 
+                           mode='r', shape=(N,))
+  else:
+    packets = numpy.zeros(0, dtype=packet_dtype(basic_header, extended_header))
+  ts = packets['timestamp']
+  ticks_per_ms = Fs/1000.0
+  n0 = numpy.searchsorted(ts, _clip_ticks(numpy.ceil(tstart_ms * ticks_per_ms)))
+  if tdur_ms < 0:
+    n1 = N
+  else:
+    n1 = numpy.searchsorted(ts, _clip_ticks(numpy.ceil((tstart_ms + tdur_ms) * ticks_per_ms)))
+  n1 = max(n0, n1)
+  
+  #cerebus time stamps are in clock cycles
+  data = {'spike time ms': (ts[n0:n1] * (1000.0/Fs)).astype('float32')}
   if load_waveform:
-    data['waveform mV'] = waveform[:counter,:]
+    waveforms = packets['waveform'][n0:n1]
+    waveforms = channel_waveforms(waveforms, channel_waveform_format(waveforms.dtype, 
+                                                                     channel_info_dict))
+    data['waveform mV'] = (waveforms * mVperLSB).astype('float32')
   
   return data, not premature_eof
 
@@ -531,16 +784,11 @@ def total_histogram(fname = None,
                      buffer_increment_size = 1000)
     
     this_spike_time_ms = data['spike time ms']
-    spike_bin_idx = this_spike_time_ms/bin_ms
-    for n_spike in range(len(this_spike_time_ms)):
-      n_bin = int(spike_bin_idx[n_spike])
-      if n_bin >= total_bins:
-        bins.resize(n_bin+1)#fills with zeros
-       # print bins.size, n_bin
-        bins[n_bin] = 1
-        total_bins = len(bins)
-      else:
-        bins[n_bin] += 1
+    counts = numpy.bincount((this_spike_time_ms/bin_ms).astype(int))
+    if counts.size > total_bins:
+      bins.resize(counts.size)#fills with zeros
+      total_bins = len(bins)
+    bins[:counts.size] += counts
   
   f.close()
     
@@ -73,35 +73,147 @@ def length_of_lfp(basic_header, t_dur_ms):
   Fs = float(basic_header['Fs Hz'])  
   return int(Fs * t_dur_ms/1000.0 + 0.5)
 
+def sample_matrix(f, basic_header):
+  """Memory-map the data of an open nsx file as a (samples, channels) int16
+  array. Column n is channel n+1 (we assume channels are in order)"""
+  
+  channel_count = basic_header['number of channels']
+  samples = int(basic_header['samples per channel'])
+  if samples < 1:
+    return numpy.zeros((0, channel_count), dtype='<i2')
+  return numpy.memmap(f, dtype='<i2', mode='r', 
+                      offset = basic_header['bytes in header'],
+                      shape = (samples, channel_count))
+
 def read_channel(f, basic_header,
                  channel, 
                  tstart_ms = 0.0,
                  tdur_ms = 100.0):
   """Given channel and the time brackets return us the lfp from the .ns3 file
-  directly.
+  directly. Samples past the end of the file are zero.
   """
 
   Fs = float(basic_header['Fs Hz'])   
-  channel_count = basic_header['number of channels']
-  waveform_bytes = basic_header['waveform bytes']
-  fmt = basic_header['waveform format']
   
   if tdur_ms < 0: #Read to end
     tdur_ms = 1000*basic_header['samples per channel']/Fs
     
   Nwave = int(Fs * tdur_ms/1000.0 + 0.5)
   Nstart = int(tstart_ms/1000.0 * Fs + 0.5)
-  Nstop = Nstart + Nwave
   lfp = numpy.zeros(Nwave,dtype='short')
   
-  offset = waveform_bytes * (channel-1) #We are assuming channels are in order
-  start_byte = Nstart * waveform_bytes * channel_count + offset
-  skip_bytes = waveform_bytes * (channel_count-1)
+  data = sample_matrix(f, basic_header)
+  trace = data[Nstart:Nstart + Nwave, channel - 1]
+  lfp[:trace.size] = trace
+  
+  return lfp
+
+class NsxFile(object):
+  """Memory-mapped access to the samples of a .NSx file. Nothing is read until
+  it is asked for, and single channel reads are strided views into the file.
+  
+  nsx = NsxFile('datafile001.ns3')
+  x = nsx.channel(12, tstart_ms = 1000, tdur_ms = 500)  #1-D view
+  X = nsx.channels([1,2,3], tstart_ms = 1000, tdur_ms = 500) #samples x 3
+  E = nsx.epochs([1000., 2000.], tpre_ms = 100, tdur_ms = 500) #events x channels x samples
+  """
+  
+  def __init__(self, fname):
+    f = open(fname, 'rb')
+    self.basic_header = read_basic_header(f)
+    f.close()
+    if self.basic_header is None:
+      raise IOError('%s is not a NSx 2.1 file' %(fname))
+    self.Fs = float(self.basic_header['Fs Hz'])
+    self.data = sample_matrix(fname, self.basic_header)
   
-  rewind(f, basic_header)  
-  f.seek(start_byte,1)
-  for n in range(Nwave):
-    lfp[n], = struct.unpack(fmt, f.read(waveform_bytes))
-    f.seek(skip_bytes,1)
+  def __len__(self):
+    return self.data.shape[0]
+  
+  def sample(self, t_ms):
+    """Sample index (or array of indexes) nearest the given time(s)"""
+    return (numpy.asarray(t_ms)/1000.0 * self.Fs + 0.5).astype(int)
+  
+  def _window(self, tstart_ms, tdur_ms):
+    if tdur_ms < 0:
+      tdur_ms = 1000*len(self)/self.Fs
+    Nstart = int(tstart_ms/1000.0 * self.Fs + 0.5)
+    return Nstart, Nstart + length_of_lfp(self.basic_header, tdur_ms)
+  
+  def channel(self, channel, tstart_ms = 0.0, tdur_ms = -1):
+    """A view (no copy) of one channel from tstart_ms for tdur_ms (-1 means to 
+    the end of the file). The view can be shorter than asked for at the end of
+    the file."""
+    Nstart, Nstop = self._window(tstart_ms, tdur_ms)
+    return self.data[Nstart:Nstop, channel - 1]
+  
+  def channels(self, channel_list = None, tstart_ms = 0.0, tdur_ms = -1):
+    """samples x channels array of the listed channels (all, if None). With all
+    channels, or a contiguous run of them, this is a view, otherwise a copy of
+    just the requested samples."""
+    Nstart, Nstop = self._window(tstart_ms, tdur_ms)
+    if channel_list is None:
+      return self.data[Nstart:Nstop]
+    idx = numpy.asarray(channel_list) - 1
+    if idx.size > 0 and (numpy.diff(idx) == 1).all():
+      return self.data[Nstart:Nstop, idx[0]:idx[-1] + 1]
+    return self.data[Nstart:Nstop, idx]
+  
+  def windows(self, Nwave):
+    """A (no copy) view of every window of Nwave samples in the file, shaped 
+    (start sample, channels, Nwave)"""
+    return sample_windows(self.data, Nwave)
+  
+  def epochs(self, t_ms, tpre_ms = 0.0, tdur_ms = 100.0, channel_list = None):
+    """Stack of the lfp around each event time in t_ms, starting tpre_ms before
+    the event and lasting tdur_ms. Returns an (events x channels x samples) 
+    int16 array. Epochs that run off the end of the file are zero past the end
+    (as with read_channel), ones that start outside the file are all zeros.
+    Only the requested samples are copied out of the file."""
+    Nwave = length_of_lfp(self.basic_header, tdur_ms)
+    starts = self.sample(numpy.asarray(t_ms, dtype=float) - tpre_ms).ravel()
+    return gather_epochs(self.data, starts, Nwave, channel_list)[0]
+
+def sample_windows(data, Nwave):
+  """Given a (samples, channels) array return a (no copy) view of every window
+  of Nwave samples in it, shaped (start sample, channels, Nwave)"""
+  n_windows = max(data.shape[0] - Nwave + 1, 0)
+  row, col = data.strides
+  return numpy.lib.stride_tricks.as_strided(data, 
+                shape = (n_windows, data.shape[1], Nwave),
+                strides = (row, col, row))
+
+def gather_epochs(data, starts, Nwave, channel_list = None):
+  """Copy the windows of Nwave samples starting at each of the sample indexes
+  in starts out of the (samples, channels) array data, for the listed channels
+  (all if None). Returns (epochs, valid) where epochs is (events x channels x 
+  samples) and valid is false for the epochs that start outside data (these
+  are left as zeros). Epochs that start in data but run off its end are 
+  truncated, zero after the last sample, and valid, just as read_channel 
+  returns them."""
+  win = sample_windows(data, Nwave)
+  if channel_list is None:
+    idx = numpy.arange(win.shape[1])
+  else:
+    idx = numpy.asarray(channel_list).ravel() - 1
+  starts = numpy.asarray(starts)
+  out = numpy.zeros((starts.size, idx.size, Nwave), dtype='<i2')
+  whole = (starts >= 0) & (starts < win.shape[0])
+  out[whole] = win[starts[whole][:, None], idx[None, :]]
+  valid = (starts >= 0) & (starts < data.shape[0])
+  for n in numpy.flatnonzero(valid & ~whole): #At most a few, at the end of data
+    tail = data[starts[n]:, idx]
+    out[n, :, :tail.shape[0]] = tail.T
+  return out, valid
+
+def read_epochs(f, basic_header, t_ms, tpre_ms = 0.0, tdur_ms = 100.0, 
+                channel_list = None):
+  """The multi trial, multi channel version of read_channel. For each time in 
+  t_ms read tdur_ms of lfp starting tpre_ms before it, from the listed channels
+  (all if None) in one pass over the open file f.
   
-  return lfp
\ No newline at end of file
+  Returns (epochs, valid) - see gather_epochs"""
+  Fs = float(basic_header['Fs Hz'])
+  Nwave = length_of_lfp(basic_header, tdur_ms)
+  starts = ((numpy.asarray(t_ms, dtype=float).ravel() - tpre_ms)/1000.0 * Fs + 0.5).astype(int)
+  return gather_epochs(sample_matrix(f, basic_header), starts, Nwave, channel_list)
@@ -38,6 +38,20 @@ R = lablib.LLDataFileReader(fname = "dj-2008-11-10-01.dat", endian = '>')
 #To force littleendian
 R = lablib.LLDataFileReader(fname = "dj-2008-11-10-01.dat", endian = '<')
 
+#Lazy reading: events are decoded when first used
+R = lablib.LLDataFileReader(fname = "dj-2008-11-10-01.dat", lazy = True)
+fix = R.data['Trials']['fixate']
+
+#Column cache: a directory of .npy files that loads as memory maps. Rebuilt 
+#only if the .dat file changes
+R = lablib.cache(fname = "dj-2008-11-10-01.dat", ignore_eye_data = False)
+eyeX = R.data['Trials']['eyeXData']['Data Values']['Values']
+
+#Two pass reading: index the file, then decode each event type into arrays
+R = lablib.LLDataFileReader()
+C = R.read_columns(fname = "dj-2008-11-10-01.dat", events = ['eyeXData','eyeYData'])
+eyeX = C['eyeXData']['Data Values']['Values'] #All the samples in the file
+
 Dictionary structure:
 "Header"
     "File Name" - the name of the file
@@ -103,6 +117,18 @@ import cPickle
 import glob
 #Needed for directory listing for pickle_all
 
+import numpy
+#For the indexed (two pass) reader, which decodes each event type into arrays
+
+from collections import OrderedDict
+#LRU cache of decoded events for the lazy reader
+
+import os, json, shutil
+#For the column cache (a directory of .npy files with a json description)
+
+import time, multiprocessing
+#For the batch conversion in pickle_all
+
 # Stateless functions --------------------------------------------------------
 #These functions just require a file pointer, and not any complex state 
 #information
@@ -165,6 +191,7 @@ def readLLDataEventDef(f, endian = '', root = False):
 
   theEventDef = {}
   data_dict = {}
+  prefix = endian or '=' #Standard sizes even when endian is '' (native), to match the file
   if root:
     #Root event. These are dictionaries and have time stamps
     data_dict['Absolute Time'] = []
@@ -175,10 +202,10 @@ def readLLDataEventDef(f, endian = '', root = False):
   #read in this event data
   theEventDef["typeName"] = readLLString(f)
   theEventDef["dataName"]= readLLString(f) 
-  theEventDef["offsetBytes"] = readLLNumeric(f, endian + 'L')
-  theEventDef["elements"] = readLLNumeric(f, endian + 'l')
-  theEventDef["elementBytes"] = readLLNumeric(f, endian + 'L')
-  tags = readLLNumeric(f, endian + 'L')
+  theEventDef["offsetBytes"] = readLLNumeric(f, prefix + 'L')
+  theEventDef["elements"] = readLLNumeric(f, prefix + 'l')
+  theEventDef["elementBytes"] = readLLNumeric(f, prefix + 'L')
+  tags = readLLNumeric(f, prefix + 'L')
   #Ignoring size consistency check...
   
   #If there are sub nodes    
@@ -249,10 +276,11 @@ def readLLHeader(f, endian):
   logger.debug("Lablib data file version %f" % format_version)
   
   #This is the python version of John's tricky code in line 974 LLDataFileReader
-  N_event_types = readLLNumeric(f, endian + 'l')
+  prefix = endian or '=' #Standard sizes even when endian is '' (native), to match the file
+  N_event_types = readLLNumeric(f, prefix + 'l')
   if N_event_types > 1000:
     logger.error('I read %d events which is probably an error. It is possible that the'\
-    ' endian-ness (%c) is wrong' %(N_event_types, endian))
+    ' endian-ness (%c) is wrong' %(N_event_types, prefix))
     N_event_types = 0
   else:
     logger.debug("%d Events " % N_event_types)
@@ -262,7 +290,7 @@ def readLLHeader(f, endian):
   data_dictionary = {}
   for n_event_code in xrange(N_event_types):
     eventName = readLLString(f)
-    dataBytes = readLLNumeric(f, endian + 'l') #How many bytes does the event have
+    dataBytes = readLLNumeric(f, prefix + 'l') #How many bytes does the event have
     
     file_header["Events"][eventName], dd = \
       readLLDataEventDef(f, endian, root = True)
@@ -291,11 +319,11 @@ def append_new_data_dict_trial(data_dict):
       #Append an empty list for this trial
       data_dict[key].append([])
 
-def read_llevent_code_from_file(f, event_code_fmt):
+def read_llevent_code_from_file(f, event_code_fmt, endian = ''):
   """This 'read ahead' is needed because what the event is often decides where
   it should go"""
   try:
-    event_code = readLLNumeric(f, event_code_fmt)
+    event_code = readLLNumeric(f, (endian or '=') + event_code_fmt)
   except:
     event_code = None
   return event_code
@@ -309,12 +337,13 @@ def skip_llevent_from_file(f, event_code, event_data_def_by_code, endian):
   """
   event_def = event_data_def_by_code[event_code]
   numBytes = event_def["dataBytes"]
+  length_fmt = (endian or '=') + 'L' #Always 4 bytes in the file, whatever the native size
   #LLDataFileReader.m:746 and 766
   if numBytes < 0:
     #Variable length data, figure it out LLDataFileReader.m:774
-    numBytes = readLLNumeric(f, endian + 'L')
+    numBytes = readLLNumeric(f, length_fmt)
   f.seek(numBytes,1)
-  f.seek(struct.calcsize('L'),1)
+  f.seek(struct.calcsize(length_fmt),1)
     
 def read_llevent_from_file(f, event_code, event_data_def_by_code, endian):
   """Read an event from the file.
@@ -330,12 +359,13 @@ def read_llevent_from_file(f, event_code, event_data_def_by_code, endian):
   event_def = event_data_def_by_code[event_code]
   numBytes = event_def["dataBytes"]
   event_data_buffer = None
+  length_fmt = (endian or '=') + 'L' #Always 4 bytes in the file, whatever the native size
   #LLDataFileReader.m:746 and 766
   if numBytes < 0:
     #Variable length data, figure it out LLDataFileReader.m:774
-    numBytes = readLLNumeric(f, endian + 'L')
+    numBytes = readLLNumeric(f, length_fmt)
   event_data_buffer = f.read(numBytes)
-  absolute_time = readLLNumeric(f, endian + 'L')
+  absolute_time = readLLNumeric(f, length_fmt)
   
   return absolute_time, event_data_buffer
 
@@ -384,7 +414,7 @@ def recurse_into_data_dict(data_dict, event_data_buffer, event_def_part, type_di
         stopBytes = offsetBytes+elements*elementBytes
       
       buf = event_data_buffer[offsetBytes:stopBytes]
-      fmt = endian + str(elements) + type_dict[event_def_part["typeName"]]
+      fmt = (endian or '=') + str(elements) + type_dict[event_def_part["typeName"]]
       #See http://mail.python.org/pipermail/tutor/2008-March/060698.html
       #For all data, you can ask for a multitude of values to be returned
       #by repeating the format string or placing a number in front of the 
@@ -407,14 +437,340 @@ def recurse_into_data_dict(data_dict, event_data_buffer, event_def_part, type_di
       recurse_into_data_dict(data_dict[key], event_data_buffer[offsetBytes:], event_def_child, type_dict, endian)
       #Important: the offsets are relative, hence we have to pass in this way
 
+
+def compile_event_leaves(event_def_part, data_dict, type_dict, endian = '', 
+                         base_offset = 0, root = False):
+  """Walk an event definition the way recurse_into_data_dict does, but only 
+  once, and return a flat list of the leaves that carry data. Each leaf is a 
+  tuple (target list, absolute offset, elements, elementBytes, format code). 
+  The decoded value of a leaf goes in target[-1] (the current trial)"""
+  offsetBytes = base_offset + event_def_part["offsetBytes"]
+  if event_def_part["typeName"] != "struct":
+    if not event_def_part["elementBytes"]:
+      return []
+    target = data_dict['Data Values'] if root else data_dict
+    return [(target, offsetBytes, event_def_part["elements"], 
+             event_def_part["elementBytes"], type_dict[event_def_part["typeName"]])]
+  leaves = []
+  children = event_def_part["Children"] 
+  for key in children.keys():
+    leaves += compile_event_leaves(children[key], data_dict[key], type_dict,
+                                   endian, offsetBytes)
+  return leaves
+
+class LLEventDecoder:
+  """Decodes events of one type into one data_dict (e.g. 'Trials'). The event 
+  definition is walked once, when the decoder is made, and each leaf gets a 
+  precompiled struct.Struct, so decoding an event is just a few unpacks. If all
+  the leaves are of fixed size, do not overlap and the endian-ness is given 
+  explicitly (so there is no native alignment to worry about) the whole event is
+  unpacked by a single struct.Struct.
+  
+  Gives exactly the same result as append_llevent_in_data_dict."""
+  
+  def __init__(self, data_dict, event_def, type_dict, endian = ''):
+    endian = endian or '=' #Standard sizes (and no padding) even for native
+    self.endian = endian
+    event = data_dict[event_def['dataName']]
+    self.absolute_time = event['Absolute Time']
+    self.trial_time = event['Trial Time']
+    self.is_text = event_def['dataName'] == 'text'
+    if self.is_text:
+      self.text = event['Data Values']
+      return
+    
+    self.leaves = []
+    self.variable_structs = {}
+    for target, offset, elements, elementBytes, code in \
+        compile_event_leaves(event_def, event, type_dict, endian, root = True):
+      if elements == -1:
+        st = None
+        stop = None
+      else:
+        st = struct.Struct(endian + str(elements) + code)
+        stop = offset + elements*elementBytes
+      self.leaves.append((target, offset, stop, elementBytes, code, st, elements))
+    
+    #Try and make a single struct for the whole event
+    self.whole = None
+    if all(leaf[5] is not None for leaf in self.leaves):
+      fmt = endian
+      pos = 0
+      counts = []
+      for target, offset, stop, elementBytes, code, st, elements in \
+          sorted(self.leaves, key = lambda leaf: leaf[1]):
+        if offset < pos or st.size != stop - offset:
+          fmt = None
+          break
+        fmt += 'x'*(offset - pos) + st.format[len(endian):]
+        pos = stop
+        counts.append((target, 1 if code == 's' else elements))
+      if fmt is not None:
+        self.whole = struct.Struct(fmt)
+        self.whole_targets = counts
+  
+  def decode(self, absolute_time, trial_time, event_data_buffer):
+    self.absolute_time[-1].append(absolute_time)
+    self.trial_time[-1].append(trial_time)
+    if self.is_text:
+      self.text[-1].append(event_data_buffer)
+      return
+    
+    if self.whole is not None and len(event_data_buffer) >= self.whole.size:
+      values = self.whole.unpack_from(event_data_buffer)
+      n = 0
+      for target, count in self.whole_targets:
+        target[-1].append(list(values[n:n+count]))
+        n += count
+      return
+    
+    for target, offset, stop, elementBytes, code, st, elements in self.leaves:
+      if st is None:
+        #Variable number of elements, will read to end of structure
+        stop = len(event_data_buffer)
+        elements = (stop - offset)//elementBytes
+        st = self.variable_structs.get((code, elements))
+        if st is None:
+          st = self.variable_structs[(code, elements)] = \
+            struct.Struct(self.endian + str(elements) + code)
+      try:
+        target[-1].append(list(st.unpack(event_data_buffer[offset:stop])))
+      except:
+        logger.error('%s %s %d %d %s' %(target, st.format, offset, stop, sys.exc_info()))
+
+# Indexed (two pass) reading -------------------------------------------------
+#Pass one (index_llevents) scans the whole file, held in memory, and notes down
+#where each event is. Pass two (decode_llevent_column) takes all the events of
+#one type and decodes each field of the event definition into a numpy array in
+#one go
+
+#Struct format codes -> numpy types (lablib uses standard sizes)
+numpy_type_dict = {'h': 'i2', 'H': 'u2', 'l': 'i4', 'L': 'u4', 'd': 'f8', 
+                   'f': 'f4', 'b': 'i1'}
+
+#Data type for the event index
+llevent_index_dtype = numpy.dtype([('code', 'i4'), ('offset', 'i8'), 
+                                   ('length', 'i8'), ('time', 'i8'), 
+                                   ('trial', 'i4'), ('trial time', 'i8')])
+
+def index_llevents(buf, pos, events_by_code, event_code_fmt, endian,
+                   trialStart_code, trialEnd_code):
+  """Scan through the events in buf starting at pos (the end of the header).
+  Returns an array (dtype llevent_index_dtype) with one entry per event:
+    code - event code
+    offset, length - where the event data is in buf
+    time - the absolute time stamp of the event
+    trial - trial number, -1 for the experiment header (events before the first
+            trialStart), -2 for junk events between trials
+    trial time - filled in later (LLDataFileReader.index_trial_times)
+  """
+  #Standard sizes even when endian is '' (native), to match the file layout
+  code_struct = struct.Struct((endian or '=') + event_code_fmt)
+  len_struct = struct.Struct((endian or '=') + 'L')
+  data_bytes = [ev["dataBytes"] for ev in events_by_code]
+  N_event_types = len(data_bytes)
+  buf_len = len(buf)
+  
+  codes, offsets, lengths, times, trials = [], [], [], [], []
+  n_trials = 0
+  in_trial = False
+  outside = -1 #Before the first trial, -2 after
+  while pos + code_struct.size <= buf_len:
+    code = code_struct.unpack_from(buf, pos)[0]
+    if code < 0 or code >= N_event_types:
+      logger.error('Bad event code %d at byte %d' %(code, pos))
+      break
+    p = pos + code_struct.size
+    numBytes = data_bytes[code]
+    if numBytes < 0:
+      if p + len_struct.size > buf_len:
+        break
+      numBytes = len_struct.unpack_from(buf, p)[0]
+      p += len_struct.size
+    if p + numBytes + len_struct.size > buf_len:
+      break
+    
+    if code == trialStart_code and not in_trial:
+      in_trial = True
+      outside = -2
+    codes.append(code)
+    offsets.append(p)
+    lengths.append(numBytes)
+    times.append(len_struct.unpack_from(buf, p + numBytes)[0])
+    trials.append(n_trials if in_trial else outside)
+    if in_trial and code == trialEnd_code:
+      in_trial = False
+      n_trials += 1
+    pos = p + numBytes + len_struct.size
+  
+  if pos < buf_len or in_trial:
+    logger.error("Possible premature end of file. %d bytes read" %(pos))
+  
+  index = numpy.zeros(len(codes), dtype=llevent_index_dtype)
+  index['code'] = codes
+  index['offset'] = offsets
+  index['length'] = lengths
+  index['time'] = times
+  index['trial'] = trials
+  return index
+
+def decode_llevent_column(buf, rows, event_def, type_dict, endian = ''):
+  """Decode all the events in rows (part of the index from index_llevents) of
+  the type given by event_def. Returns a dictionary with the same structure as
+  the data_dict for the event (minus the times) with each field decoded as:
+    fixed number of elements - n_events x elements array (n_events array of 
+                               strings for char fields)
+    variable number of elements - {'Values': flat array of all the elements, 
+                                   'Event Offsets': n_events + 1 array. The 
+                                   values for event n are 
+                                   Values[Event Offsets[n]:Event Offsets[n+1]]}
+                                   (a list of strings for char fields)
+  The text event is returned as a list of strings under 'Data Values'"""
+  if event_def['dataName'] == 'text':
+    return {'Data Values': [buf[o:o+l] for o, l in zip(rows['offset'], rows['length'])]}
+  if event_def["typeName"] != "struct":
+    leaf = decode_llevent_leaf(buf, rows, event_def, 0, type_dict, endian)
+    return {} if leaf is None else {'Data Values': leaf}
+  return decode_llevent_leaf(buf, rows, event_def, 0, type_dict, endian)
+
+def decode_llevent_leaf(buf, rows, event_def_part, base_offset, type_dict, endian):
+  """Recursive part of decode_llevent_column"""
+  offsetBytes = base_offset + event_def_part["offsetBytes"]
+  if event_def_part["typeName"] == "struct":
+    column = {}
+    children = event_def_part["Children"]
+    for key in children.keys():
+      leaf = decode_llevent_leaf(buf, rows, children[key], offsetBytes, type_dict, endian)
+      if leaf is not None:
+        column[key] = leaf
+    return column
+  
+  elementBytes = event_def_part["elementBytes"]
+  if not elementBytes:
+    return None
+  code = type_dict[event_def_part["typeName"]]
+  elements = event_def_part["elements"]
+  start = rows['offset'] + offsetBytes
+  stop = rows['offset'] + rows['length']
+  
+  if code == 's':
+    if elements == -1:
+      return {'Values': [buf[a:b] for a, b in zip(start, stop)],
+              'Event Offsets': numpy.arange(rows.size + 1)}
+    return numpy.array([buf[a:a+elements] for a in start], dtype='S%d' %(max(elements, 1)))
+  
+  dt = numpy.dtype((endian or '=') + numpy_type_dict[code])
+  if elements == -1:
+    counts = numpy.maximum((stop - start)//elementBytes, 0)
+    event_offsets = numpy.zeros(rows.size + 1, dtype=int)
+    numpy.cumsum(counts, out=event_offsets[1:])
+    #The elements of an event are contiguous, so copy each event's run at once
+    values = numpy.empty(event_offsets[-1], dtype=dt)
+    for a, o, n in zip(start, event_offsets[:-1], counts):
+      if n > 0:
+        values[o:o+n] = numpy.frombuffer(buf, dtype=dt, count=n, offset=a)
+    return {'Values': values, 'Event Offsets': event_offsets}
+  
+  short = start + elements*elementBytes > stop
+  if short.any():
+    logger.error('%d %s events too short for %s' %(short.sum(), 
+                 event_def_part["dataName"], event_def_part["typeName"]))
+    start = numpy.where(short, 0, start) #Read from the start of buf instead, zeroed below
+  values = gather_elements(buf, start, dt, elements)
+  values[short] = 0
+  return values
+
+def gather_elements(buf, starts, dt, count):
+  """Read count contiguous elements of type dt from buf at each byte position in
+  starts and return them as a len(starts) x count array. Goes through a strided
+  view of buf, so the only index is starts itself. Positions that run off the
+  end of buf raise an IndexError"""
+  u8 = numpy.frombuffer(buf, dtype=numpy.uint8)
+  nbytes = count*dt.itemsize
+  if nbytes == 0:
+    return numpy.zeros((len(starts), count), dtype=dt)
+  windows = numpy.lib.stride_tricks.as_strided(u8, shape=(max(u8.size - nbytes + 1, 0), nbytes), 
+                                               strides=(1, 1))
+  return numpy.ascontiguousarray(windows[starts]).view(dt)
   
 # Stateful functions ---------------------------------------------------------
 #These functions require a state, so they are written as methods of a 
 #LLDataFileReader class, so that we can store the state in the instance and
 #let functions use it as needed
 
+class LLLazyEvents:
+  """Stands in for data['Trials'] (or data['Experiment Header']) in a lazily
+  read file. Looks like the usual dictionary of events, but an event is only 
+  decoded (from the index, with the compiled decoders) when it is first asked 
+  for. Decoded events are cached. If max_decoded is set only that many events
+  are kept, the least recently used being dropped first."""
+  
+  def __init__(self, reader, section = 'Trials', max_decoded = None):
+    self.reader = reader
+    self.section = section
+    self.max_decoded = max_decoded
+    self.decoded = OrderedDict()
+    #data_dict is keyed by dataName, the index by event name
+    self.event_names = dict((ev['dataName'], name) for name, ev in 
+                            reader.data['Header']['Events'].items())
+  
+  def keys(self):
+    return self.reader.data_dict_template.keys()
+  
+  def __iter__(self):
+    return iter(self.keys())
+  
+  def __len__(self):
+    return len(self.reader.data_dict_template)
+  
+  def __contains__(self, key):
+    return key in self.reader.data_dict_template
+  
+  def has_key(self, key):
+    return key in self
+  
+  def get(self, key, default = None):
+    if key in self:
+      return self[key]
+    return default
+  
+  def iteritems(self):
+    """Decodes the events one at a time, as they are reached"""
+    for key in self.keys():
+      yield key, self[key]
+  
+  def itervalues(self):
+    for key in self.keys():
+      yield self[key]
+  
+  def items(self):
+    return [(key, self[key]) for key in self.keys()]
+  
+  def values(self):
+    return [self[key] for key in self.keys()]
+  
+  def __getitem__(self, key):
+    if key in self.decoded:
+      event = self.decoded.pop(key) #Reinsert, to mark as most recently used
+    else:
+      event = self.reader.decode_event(self.event_names[key], self.section)
+      if self.max_decoded is not None:
+        while len(self.decoded) >= self.max_decoded:
+          self.decoded.popitem(last = False)
+    self.decoded[key] = event
+    return event
+  
+  def to_dict(self):
+    """Decode everything and return a normal data dictionary"""
+    return dict((key, self.reader.decode_event(self.event_names[key], self.section))
+                for key in self.keys())
+
 class LLDataFileReader:
-  def __init__(self, fname = None, ignore_events = None, endian = ''):
+  def __init__(self, fname = None, ignore_events = None, endian = '', 
+               lazy = False, max_decoded = None):
+    """If lazy is true only the header and the event index are read when the
+    file is opened, and events are decoded when they are first used (see 
+    open). ignore_events has no meaning then."""
     self.initialized = False
     #LLDataEventDef.m:13
     self.type_dict = {'short': 'h',
@@ -428,7 +784,10 @@ class LLDataFileReader:
                       'boolean': 'b'}
     #This dictionary converts lablib's data type convention to struct.unpack's
     if fname is not None:
-      self.read(fname, ignore_events, endian)
+      if lazy:
+        self.open(fname, endian, max_decoded)
+      else:
+        self.read(fname, ignore_events, endian)
       
   def read(self, fname = "dj-2008-10-30-01.dat", ignore_events = None, endian = ''):
     """The returned dictionary 'file_data' is described in the doc string of 
@@ -460,10 +819,10 @@ class LLDataFileReader:
     data_dict = self.data['Experiment Header']
     append_new_data_dict_trial(data_dict)
     #event_code = self.read_and_append_llevent(f, data_dict)
-    event_code = read_llevent_code_from_file(f, self.event_code_fmt)
+    event_code = read_llevent_code_from_file(f, self.event_code_fmt, self.endian)
     while event_code != self.trialStart_code and event_code is not None:
       self.read_and_append_llevent(f, event_code, data_dict)
-      event_code = read_llevent_code_from_file(f, self.event_code_fmt)
+      event_code = read_llevent_code_from_file(f, self.event_code_fmt, self.endian)
 
     #Read in trial events
     data_dict = self.data['Trials']
@@ -476,7 +835,7 @@ class LLDataFileReader:
         #self.read_and_append_llevent(f, event_code, data_dict_jnk)
         skip_llevent_from_file(f, event_code, self.events_by_code, self.endian)
         #We could potentially have junk in between the trials
-        event_code = read_llevent_code_from_file(f, self.event_code_fmt)
+        event_code = read_llevent_code_from_file(f, self.event_code_fmt, self.endian)
       
       if event_code is not None:
         append_new_data_dict_trial(data_dict) #New trial starts
@@ -486,11 +845,11 @@ class LLDataFileReader:
           self.read_and_append_llevent(f, event_code, data_dict)
         else:
           skip_llevent_from_file(f, event_code, self.events_by_code, self.endian)
-        event_code = read_llevent_code_from_file(f, self.event_code_fmt)
+        event_code = read_llevent_code_from_file(f, self.event_code_fmt, self.endian)
 
       if event_code == self.trialEnd_code:
         self.read_and_append_llevent(f, event_code, data_dict)
-        event_code = read_llevent_code_from_file(f, self.event_code_fmt)
+        event_code = read_llevent_code_from_file(f, self.event_code_fmt, self.endian)
         trial_properly_closed = True
         n_trials += 1
     
@@ -501,6 +860,127 @@ class LLDataFileReader:
     
     f.close()
         
+  def read_index(self, fname = "dj-2008-10-30-01.dat", endian = ''):
+    """First pass of the two pass reader. Read the header and the whole file 
+    into memory, and index the events (see index_llevents). Sets self.index 
+    and returns it. The data itself is decoded by event_column/read_columns"""
+    self.ignore_events = None
+    self.endian = endian
+    self.data = {}
+    
+    f = open(fname,"rb")
+    self.data['Header'], self.data_dict_template = readLLHeader(f, self.endian)
+    data_start = f.tell()
+    f.seek(0)
+    self.buffer = f.read()
+    f.close()
+    
+    self.set_state()
+    self.index = index_llevents(self.buffer, data_start, self.events_by_code,
+                                self.event_code_fmt, self.endian,
+                                self.trialStart_code, self.trialEnd_code)
+    self.n_trials = int(self.index['trial'].max()) + 1 if self.index.size else 0
+    self.index_trial_times()
+    return self.index
+  
+  def index_trial_times(self):
+    """Fill in the trial times in the index. For most events this is just the
+    time since the last trialStart, which we do in one go. The few events that
+    change the timing state (samples, spikes, etc) are passed through 
+    set_timing_state in order, as read does."""
+    index = self.index
+    code = index['code']
+    is_start = code == self.trialStart_code
+    last_start = numpy.maximum.accumulate(numpy.where(is_start, numpy.arange(index.size), -1)) \
+                 if index.size else numpy.zeros(0, dtype=int)
+    index['trial time'] = numpy.where(last_start >= 0, 
+                                      index['time'] - index['time'][last_start], -1)
+    
+    timing_codes = [self.trialStart_code, self.sampleZero_code, 
+                    self.spikeZero_code, self.sample01_code, self.sample_code,
+                    self.spike_code, self.spike0_code]
+    replay = numpy.flatnonzero(numpy.isin(code, timing_codes) & (index['trial'] != -2))
+    buf = self.buffer
+    for n in replay:
+      ev = index[n]
+      index['trial time'][n] = \
+        self.set_timing_state(int(ev['code']), int(ev['time']), 
+                              buf[ev['offset']:ev['offset'] + ev['length']])
+  
+  def event_rows(self, event_name, section = 'Trials'):
+    """The part of the index for one type of event in 'Trials' or 
+    'Experiment Header'"""
+    code = self.data['Header']['Events'][event_name]['EventCode']
+    if section == 'Trials':
+      sel = (self.index['code'] == code) & (self.index['trial'] >= 0)
+    else:
+      sel = (self.index['code'] == code) & (self.index['trial'] == -1)
+    return self.index[sel]
+  
+  def event_column(self, event_name, section = 'Trials'):
+    """Second pass of the two pass reader. Decode all the events of one type
+    into arrays (see decode_llevent_column) and add
+      'Absolute Time', 'Trial Time' - arrays, one entry per event
+      'Trial Offsets' - n_trials + 1 array. The events of trial n are 
+                        Trial Offsets[n] to Trial Offsets[n+1]
+    """
+    rows = self.event_rows(event_name, section)
+    column = decode_llevent_column(self.buffer, rows, 
+                                   self.data['Header']['Events'][event_name],
+                                   self.type_dict, self.endian)
+    column['Absolute Time'] = rows['time']
+    column['Trial Time'] = rows['trial time']
+    if section == 'Trials':
+      column['Trial Offsets'] = rows['trial'].searchsorted(numpy.arange(self.n_trials + 1))
+    else:
+      column['Trial Offsets'] = numpy.array([0, rows.size])
+    return column
+  
+  def read_columns(self, fname = None, endian = '', events = None, 
+                   section = 'Trials'):
+    """Two pass reading. Index the file (if fname is given) and decode the 
+    listed events (all of them if None) as columns, into self.columns"""
+    if fname is not None:
+      self.read_index(fname, endian)
+    if events is None:
+      events = self.data['Header']['Events'].keys()
+    self.columns = {}
+    for event_name in events:
+      self.columns[event_name] = self.event_column(event_name, section)
+    return self.columns
+  
+  def open(self, fname = "dj-2008-10-30-01.dat", endian = '', max_decoded = None):
+    """Lazy reading. Index the file (read_index) and set up data['Trials'] and
+    data['Experiment Header'] to decode events as they are asked for. The 
+    decoded events are the same as those from read. max_decoded limits how 
+    many events are kept decoded in each section (see LLLazyEvents)"""
+    self.read_index(fname, endian)
+    self.data['Trials'] = LLLazyEvents(self, 'Trials', max_decoded)
+    self.data['Experiment Header'] = LLLazyEvents(self, 'Experiment Header', max_decoded)
+    self.data['Junk Events'] = copy.deepcopy(self.data_dict_template)
+    append_new_data_dict_trial(self.data['Junk Events'])
+  
+  def decode_event(self, event_name, section = 'Trials'):
+    """Decode all the events of one type in 'Trials' or 'Experiment Header' 
+    from the index into the same structure read produces, using the trial 
+    times worked out when indexing"""
+    event_def = self.data['Header']['Events'][event_name]
+    data_dict = {event_def['dataName']: 
+                 copy.deepcopy(self.data_dict_template[event_def['dataName']])}
+    dec = LLEventDecoder(data_dict, event_def, self.type_dict, self.endian)
+    rows = self.event_rows(event_name, section)
+    if section == 'Trials':
+      trial_offsets = rows['trial'].searchsorted(numpy.arange(self.n_trials + 1))
+    else:
+      trial_offsets = [0, rows.size]
+    buf = self.buffer
+    for n in xrange(len(trial_offsets) - 1):
+      append_new_data_dict_trial(data_dict)
+      for ev in rows[trial_offsets[n]:trial_offsets[n+1]].tolist():
+        code, offset, length, absolute_time, trial, trial_time = ev
+        dec.decode(absolute_time, trial_time, buf[offset:offset+length])
+    return data_dict[event_def['dataName']]
+  
   def set_state(self):
     """This function takes the file_header structure (as returned by 
     readLLHeader) and sets up a state for LLDataFileReader that enables us to
@@ -508,6 +988,7 @@ class LLDataFileReader:
 
     file_header = self.data["Header"]
     self.events_by_code = file_header["EventsByCode"]
+    self.decoders = {}
 
     #Figure out what we have to ignore
     ev = file_header["Events"]
@@ -591,20 +1072,25 @@ class LLDataFileReader:
     absolute_time, event_data_buffer = \
       read_llevent_from_file(f, event_code, self.events_by_code, self.endian)
     trial_time = self.set_timing_state(event_code, absolute_time, event_data_buffer)
-    event_def = self.events_by_code[event_code]
-    append_llevent_in_data_dict(data_dict, 
-                                event_code, absolute_time, trial_time,
-                                event_data_buffer,
-                                event_def,
-                                self.type_dict,
-                                self.endian) 
+    self.decoder(data_dict, event_code).decode(absolute_time, trial_time, 
+                                               event_data_buffer)
     
     return event_code  
   
+  def decoder(self, data_dict, event_code):
+    """Return the (cached) LLEventDecoder for this event going into data_dict"""
+    key = (id(data_dict), event_code)
+    dec = self.decoders.get(key)
+    if dec is None:
+      dec = self.decoders[key] = \
+        LLEventDecoder(data_dict, self.events_by_code[event_code], 
+                       self.type_dict, self.endian)
+    return dec
+  
   def set_timing_state(self, event_code, absolute_time, event_data_buffer):
     """Some events cause us to reset some timers"""
 
-    endian = self.endian
+    endian = self.endian or '=' #Standard sizes even when endian is '' (native)
     trial_time = absolute_time
     #LLdataFileReader.m:787
     if event_code == self.trialStart_code:
@@ -667,7 +1153,7 @@ class LLDataFileReader:
           stopBytes = offsetBytes+elements*elementBytes
         
         buf = event_data_buffer[offsetBytes:stopBytes]
-        fmt = endian + str(elements) + self.type_dict[thisEventPartDef["typeName"]]
+        fmt = (self.endian or '=') + str(elements) + self.type_dict[thisEventPartDef["typeName"]]
         #See http://mail.python.org/pipermail/tutor/2008-March/060698.html
         #For all data, you can ask for a multitude of values to be returned
         #by repeating the format string or placing a number in front of the 
@@ -692,8 +1178,12 @@ class LLDataFileReader:
   def pickle(self, fname = 'test.pkl'):
     """Pickle the data"""
     
+    data = dict(self.data)
+    for key in data.keys():
+      if isinstance(data[key], LLLazyEvents):
+        data[key] = data[key].to_dict()
     f = open(fname,'wb')
-    cPickle.dump(self.data, f, protocol = 2)
+    cPickle.dump(data, f, protocol = 2)
     f.close()
     
   def un_pickle(self, fname = 'test.pkl'):
@@ -738,22 +1228,279 @@ def pickle(fname = '../Data/dj-2008-11-10-01.dat',
   
   return R
 
-def pickle_all(dir = '.', ignore_eye_data = True, force = False):
+# Column cache ---------------------------------------------------------------
+#A faster alternative to pickling. The columns from the two pass reader 
+#(LLDataFileReader.event_column) are saved as a directory of .npy files that are
+#memory mapped when loaded. Ragged data (variable length fields, text) is kept 
+#as flat arrays plus offsets. A json file (cache.json) describes the layout and
+#records the cache version and the size and modification time of the .dat file
+#so that we can tell when a cache is out of date.
+llcache_version = 1
+
+def cache_name(fname, ignore_eye_data = True):
+  """Name of the cache directory for a lablib .dat file"""
+  if ignore_eye_data:
+    return fname.replace('.dat','.llc')
+  return fname.replace('.dat','-eye.llc')
+
+def source_key(fname):
+  """What we check to see if a cache is up to date"""
+  st = os.stat(fname)
+  return {'version': llcache_version, 'size': st.st_size, 'mtime': st.st_mtime}
+
+def cache_is_current(fname, cache_dir, endian = ''):
+  """True if cache_dir is a cache of the current version of fname, read with
+  the same endian setting"""
+  try:
+    f = open(os.path.join(cache_dir, 'cache.json'))
+    meta = json.load(f)
+    f.close()
+  except (IOError, OSError, ValueError):
+    return False
+  key = source_key(fname)
+  key['endian'] = endian
+  return all(meta.get(k) == key[k] for k in key)
+
+def save_cache(R, fname, cache_dir, ignore_events = None):
+  """Decode every event of the indexed reader R (see read_index) as columns and
+  save them in cache_dir. fname is the .dat file R indexed. The cache is built
+  in a temporary directory and moved into place when complete."""
+  ignore_events = ignore_events or []
+  tmp_dir = cache_dir + '.tmp'
+  if os.path.exists(tmp_dir):
+    shutil.rmtree(tmp_dir)
+  os.makedirs(tmp_dir)
+  
+  files = []
+  def save(path, value):
+    if isinstance(value, dict):
+      for key in value.keys():
+        save(path + [key], value[key])
+      return
+    if isinstance(value, list):
+      #Strings. Stored as flat bytes + offsets, like the other ragged data
+      offsets = numpy.zeros(len(value) + 1, dtype=int)
+      numpy.cumsum([len(v) for v in value], out=offsets[1:])
+      save(path + ['Bytes'], numpy.frombuffer(b''.join(value), dtype=numpy.uint8))
+      save(path + ['Byte Offsets'], offsets)
+      return
+    name = 'c%05d.npy' %(len(files))
+    numpy.save(os.path.join(tmp_dir, name), numpy.ascontiguousarray(value))
+    files.append([path, name])
+  
+  for section in ['Experiment Header', 'Trials']:
+    for event_name in R.data['Header']['Events'].keys():
+      if event_name not in ignore_events:
+        save([section, event_name], R.event_column(event_name, section))
+  
+  f = open(os.path.join(tmp_dir, 'header.pkl'), 'wb')
+  cPickle.dump(R.data['Header'], f, protocol = 2)
+  f.close()
+  meta = source_key(fname)
+  meta.update({'source': os.path.basename(fname), 'endian': R.endian,
+               'trials': R.n_trials, 'files': files})
+  f = open(os.path.join(tmp_dir, 'cache.json'), 'w')
+  json.dump(meta, f)
+  f.close()
+  
+  if os.path.exists(cache_dir):
+    shutil.rmtree(cache_dir)
+  os.rename(tmp_dir, cache_dir)
+
+def load_cache(cache_dir, mmap = True):
+  """Load a column cache and return a LLDataFileReader structure whose data has
+  'Header' and, in place of the usual lists, 'Trials' and 'Experiment Header'
+  as dictionaries of columns (see LLDataFileReader.event_column). Arrays are 
+  memory mapped unless mmap is False. Strings come back as lists."""
+  f = open(os.path.join(cache_dir, 'cache.json'))
+  meta = json.load(f)
+  f.close()
+  if meta['version'] != llcache_version:
+    raise IOError('%s is cache version %s, need %d' %(cache_dir, meta['version'], llcache_version))
+  
+  R = LLDataFileReader()
+  f = open(os.path.join(cache_dir, 'header.pkl'), 'rb')
+  R.data = {'Header': cPickle.load(f), 'Trials': {}, 'Experiment Header': {}}
+  f.close()
+  R.endian = meta['endian']
+  R.n_trials = meta['trials']
+  
+  mmap_mode = 'r' if mmap else None
+  for path, name in meta['files']:
+    node = R.data
+    for key in path[:-1]:
+      node = node.setdefault(key, {})
+    node[path[-1]] = numpy.load(os.path.join(cache_dir, name), mmap_mode = mmap_mode)
+  
+  def strings(node):
+    for key in node.keys():
+      if isinstance(node[key], dict):
+        if 'Bytes' in node[key]:
+          b = node[key]['Bytes'].tobytes()
+          o = node[key]['Byte Offsets']
+          node[key] = [b[o[n]:o[n+1]] for n in xrange(len(o) - 1)]
+        else:
+          strings(node[key])
+  strings(R.data['Trials'])
+  strings(R.data['Experiment Header'])
+  return R
+
+def build_cache(fname = '../Data/dj-2008-11-10-01.dat', ignore_eye_data = True, 
+                force = False, endian = ''):
+  """Build the column cache for fname if it is missing or out of date (or force
+  is set). Returns the name of the cache directory"""
+  cache_dir = cache_name(fname, ignore_eye_data)
+  if force or not cache_is_current(fname, cache_dir, endian):
+    R = LLDataFileReader()
+    R.read_index(fname, endian)
+    if ignore_eye_data:
+      ignore_events = ['eyeXData','eyeYData','eyePData']
+    else:
+      ignore_events = None
+    save_cache(R, fname, cache_dir, ignore_events)
+  return cache_dir
+
+def cache(fname = '../Data/dj-2008-11-10-01.dat', ignore_eye_data = True, 
+          force = False, endian = ''):
+  """The column cache version of pickle. Builds the cache (build_cache) if 
+  needed and returns it (load_cache)"""
+  return load_cache(build_cache(fname, ignore_eye_data, force, endian))
+
+# Batch conversion -----------------------------------------------------------
+manifest_name = 'lablib_manifest.json'
+decoder_version = 1 #Bump when a change to the reader changes what pickle writes
+
+def manifest_key(fname):
+  """What the manifest records to tell if the pickle of fname is up to date"""
+  st = os.stat(fname)
+  return {'decoder version': decoder_version, 'size': st.st_size, 'mtime': st.st_mtime}
+
+def output_name(fname, ignore_eye_data = True, format = 'pickle'):
+  """Name of the pickle file or cache directory fname gets converted to"""
+  if format == 'cache':
+    return cache_name(fname, ignore_eye_data)
+  if ignore_eye_data:
+    return fname.replace('.dat','.pkl')
+  return fname.replace('.dat','-eye.pkl')
+
+def load_manifest(dir = '.'):
+  """The record of what pickle_all has converted in dir (empty if none)"""
+  try:
+    f = open(os.path.join(dir, manifest_name))
+    manifest = json.load(f)
+    f.close()
+  except (IOError, OSError, ValueError):
+    manifest = {}
+  return manifest
+
+def save_manifest(manifest, dir = '.'):
+  """Write the manifest. Written to a temporary file and renamed so that an
+  interrupted run never leaves a half written manifest behind"""
+  fname = os.path.join(dir, manifest_name)
+  f = open(fname + '.tmp', 'w')
+  json.dump(manifest, f, indent = 1, sort_keys = True)
+  f.close()
+  if os.path.exists(fname):
+    os.remove(fname)
+  os.rename(fname + '.tmp', fname)
+
+def is_up_to_date(fname, manifest, ignore_eye_data = True, format = 'pickle',
+                  endian = ''):
+  """True if the manifest says fname has been converted, by the current
+  decoder_version, since it last changed, and the output is still there. Files
+  not in the manifest (converted before there was one) are out of date, since
+  we can't tell which reader made them. Column caches are checked against their
+  own cache.json"""
+  foutname = output_name(fname, ignore_eye_data, format)
+  if format == 'cache':
+    return cache_is_current(fname, foutname, endian) #The cache keeps its own record
+  if not os.path.exists(foutname):
+    return False
+  entry = manifest.get(os.path.basename(foutname))
+  if entry is None:
+    return False
+  key = manifest_key(fname)
+  return all(entry.get(k) == key[k] for k in key)
+
+def _convert_file(args):
+  """Worker for pickle_all. Returns (fname, seconds, error message or None)"""
+  fname, ignore_eye_data, format, endian = args
+  t0 = time.time()
+  try:
+    if format == 'cache':
+      build_cache(fname = fname, ignore_eye_data = ignore_eye_data, 
+                  force = True, endian = endian)
+    else:
+      pickle(fname = fname, ignore_eye_data = ignore_eye_data)
+    error = None
+  except Exception:
+    error = '%s: %s' %(sys.exc_info()[0].__name__, sys.exc_info()[1])
+  return fname, time.time() - t0, error
+
+def pickle_all(dir = '.', ignore_eye_data = True, force = False, 
+               format = 'pickle', endian = '', processes = 1):
   """Go through a directory converting lablib data files to pickle files.
   Inputs:
   dir - where are the files located
   ignore_eye_data - if true don't bother to pickle the eye data
-  force - if true reconvert files even if they have an existing pickle file"""
+  force - if true reconvert files even if they are up to date
+  format - 'pickle' or 'cache' (column cache, see build_cache)
+  endian - endian-ness of the files (column cache only)
+  processes - how many files to convert at once. None means one per core
   
+  Files are converted largest first, so the big ones don't hold up the end of
+  the run. What has been converted is recorded in a manifest (lablib_manifest.json)
+  in dir, along with the size and modification time of each source file and
+  the decoder_version, so files that have not changed since (and were converted
+  by the current reader) are skipped. Files converted before there was a 
+  manifest are converted again. Timing and throughput is 
+  logged as each file finishes.
+  
+  Output:
+  list of (file name, seconds, error message or None), in the order finished"""
+  
+  manifest = load_manifest(dir)
   dat_files = glob.glob(dir + '/*.dat')
-  for n in xrange(len(dat_files)):
-    if ignore_eye_data:
-      pkl_file = dat_files[n].replace('.dat','.pkl')
-    else:
-      pkl_file = dat_files[n].replace('.dat','-eye.pkl')
-    
-    if glob.os.path.exists(pkl_file) and not force:
+  todo = [fn for fn in dat_files 
+          if force or not is_up_to_date(fn, manifest, ignore_eye_data, format, endian)]
+  todo.sort(key = os.path.getsize, reverse = True)
+  logger.info('%d of %d files to convert' %(len(todo), len(dat_files)))
+  
+  jobs = [(fn, ignore_eye_data, format, endian) for fn in todo]
+  if processes == 1:
+    pool = None
+    finished = (_convert_file(job) for job in jobs)
+  else:
+    pool = multiprocessing.Pool(processes)
+    finished = pool.imap_unordered(_convert_file, jobs, chunksize = 1)
+  
+  results = []
+  total_mb = 0.0
+  t0 = time.time()
+  try:
+    for fname, seconds, error in finished:
+      results.append((fname, seconds, error))
+      if error is not None:
+        logger.error('[%d/%d] %s failed: %s' %(len(results), len(jobs), fname, error))
         continue
-      
-    pickle(fname = dat_files[n], ignore_eye_data = ignore_eye_data)  
-    
\ No newline at end of file
+      key = manifest_key(fname)
+      mb = key['size']/1e6
+      total_mb += mb
+      logger.info('[%d/%d] %s %.1f MB in %.1f s (%.1f MB/s)' %(len(results), 
+                  len(jobs), fname, mb, seconds, mb/max(seconds, 1e-6)))
+      key['seconds'] = seconds
+      manifest[os.path.basename(output_name(fname, ignore_eye_data, format))] = key
+      save_manifest(manifest, dir)
+  except BaseException: #Including KeyboardInterrupt. Don't wait on the workers
+    if pool is not None:
+      pool.terminate()
+      pool.join()
+    raise
+  if pool is not None:
+    pool.close()
+    pool.join()
+  
+  elapsed = time.time() - t0
+  logger.info('Converted %.1f MB in %.1f s (%.1f MB/s)' %(total_mb, elapsed, 
+              total_mb/max(elapsed, 1e-6)))
+  return results
@@ -1,7 +1,12 @@
 """Functions to read the flotilla of files produced by the Neuralynx system."""
 
 from struct import unpack as upk, pack as pk, calcsize as csize
+from concurrent.futures import ProcessPoolExecutor
 import logging
+import os
+import queue
+import shutil
+import threading
 import numpy as np
 
 logger = logging.getLogger(__name__)
@@ -85,6 +90,7 @@ def read_csc(fin, assume_same_fs=True):
         't0': the timestamp of the first packet.
     NOTE: while 'packets' returns the exact packets read, 'Fs' and 'trace' assume that the record has no gaps and that the
     sampling frequency has not changed during the recording
+    For files too large to load whole, use CscTrace.
     """
     hdr = read_header(fin)
 
@@ -98,56 +104,133 @@ def read_csc(fin, assume_same_fs=True):
 
     if not assume_same_fs: return {'header': hdr, 'packets': data}
 
-    packet_duration_us = 512 * (1. / data['Fs'][0]) * 1e6
-    # For the version we are dealing with, Neuralynx packets are always 512
-    # This is actually a very poor estimate if the sampling freq is low, since it rounds to nearest Hz
-    # So we'll not rely on this but come up with our own estimate
-
     samp = data['samp']
     ts_us = data['timestamp']
-    dt_us = np.diff(ts_us).astype('f')
-    idx = np.argwhere(dt_us > packet_duration_us)  # This will find any instances where we paused the recording
-    if idx.size == 0:  # No padding needed
+    idx, starts, Fs = csc_sections(ts_us, data['Ns'], data['Fs'][0])
+    if idx.size == 2:  # No padding needed
         trace = samp.ravel()
-        Fs = (data['Ns'][:-1] / (dt_us * 1e-6)).mean()
     else:  # We have some padding to do.
         logger.debug('Gaps in record, padding')
-        # Our first task is to find all the contiguous sections of data
-        idx += 1  # Shifting indexes to point at the packets that come after a gap
-        idx = np.insert(idx, 0, 0)  # Now idx contains the indexes of every packet that starts a contiguous section
-        idx = np.append(idx, ts_us.size)  # And the index of the last packet
-        Ns = data['Ns']
-        estimFs_sum = 0
-        N_samps = 0
-        sections = []
-        for n in range(idx.size - 1):  # collect all the sections
-            n0 = idx[n];
-            n1 = idx[n + 1]
-            sections.append(samp[n0:n1].ravel())
-            if n1 - n0 > 1:  # We need more than one packet in a section to get an estimate
-                estimFs_sum += (Ns[n0:n1 - 1] / (dt_us[n0:n1 - 1] * 1e-6)).sum()
-                N_samps += n1 - 1 - n0
-
-        Fs = estimFs_sum / float(N_samps)
-        # Now pad the data appropriately
-        padded = [sections[0]]
-        cum_N = sections[0].size
-        for n in range(1, len(sections)):
-            # Now figure out how many zeros we have to pad to get the right length
-            Npad = int((ts_us[idx[n]] - ts_us[0]) * 1e-6 * Fs - cum_N)
-            padded.append(np.zeros(Npad))
-            padded.append(sections[n])
-            cum_N += Npad + sections[n].size
-        trace = np.concatenate(padded)  # From this packet to the packet before the gap
+        trace = np.zeros(starts[-1] + 512 * (idx[-1] - idx[-2]))
+        for n in range(idx.size - 1):
+            trace[starts[n]:starts[n] + 512 * (idx[n + 1] - idx[n])] = samp[idx[n]:idx[n + 1]].ravel()
 
     return {'header': hdr, 'packets': data, 'Fs': Fs, 'trace': trace, 't0': ts_us[0]}
 
 
-def read_nev(fin, parse_event_string=False):
+def csc_sections(ts_us, Ns, nominal_Fs):
+    """Find the contiguous sections of a continuous record and where they go in the zero padded trace.
+    Inputs:
+      ts_us - packet timestamps
+      Ns - number of valid samples in each packet
+      nominal_Fs - the sampling frequency the device reports
+    Outputs:
+      idx - the index of every packet that starts a contiguous section, followed by the number of packets
+      starts - the sample in the trace at which each section starts
+      Fs - the average frequency computed from the timestamps, ignoring the gaps
+    """
+    packet_duration_us = 512 * (1. / nominal_Fs) * 1e6
+    # For the version we are dealing with, Neuralynx packets are always 512
+    # This is actually a very poor estimate if the sampling freq is low, since it rounds to nearest Hz
+    # So we'll not rely on this but come up with our own estimate
+    dt_us = np.diff(ts_us).astype('f')
+    gap = dt_us > packet_duration_us  # This will find any instances where we paused the recording
+    # Shifting indexes to point at the packets that come after a gap, and adding the first and (one after) last packet
+    idx = np.concatenate(([0], np.flatnonzero(gap) + 1, [ts_us.size]))
+    Fs = (Ns[:-1][~gap] / (dt_us[~gap] * 1e-6)).mean()
+
+    # Now figure out how many zeros we have to pad to get the right length
+    starts = np.zeros(idx.size - 1, dtype=int)
+    cum_N = 512 * idx[1]
+    for n in range(1, idx.size - 1):
+        Npad = int((ts_us[idx[n]] - ts_us[0]) * 1e-6 * Fs - cum_N)
+        if Npad < 0:
+            logger.warning('Section {:d} starts before the previous one ends, not padding'.format(n))
+            Npad = 0
+        starts[n] = cum_N + Npad
+        cum_N = starts[n] + 512 * (idx[n + 1] - idx[n])
+    return idx, starts, Fs
+
+
+class CscTrace:
+    """Lazy version of the 'trace' returned by read_csc.
+    The packets stay memory-mapped and only the gap table and the estimated Fs are computed when the file is opened.
+    trace[a:b] reads just the packets needed for those samples and fills any gaps with zeros. Samples keep their
+    original int16 type.
+
+    e.g.
+    ----------------------------------------------------------------------------------------------------------------------
+    from neurapy.neuralynx import lynxio
+
+    trace = lynxio.CscTrace('CSC1.ncs')
+    x = trace[int(10 * trace.Fs):int(20 * trace.Fs)]  # Seconds 10 to 20 of the record
+    ----------------------------------------------------------------------------------------------------------------------
+
+    Attributes:
+      'header' - the file header
+      'packets' - the memory-mapped packets (csc_packet dtype)
+      'Fs' - the average frequency computed from the timestamps
+      't0' - the timestamp of the first packet
+      'sections' - packet index, first sample in the trace and number of samples for each contiguous section
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        with open(fname, 'rb') as f:
+            self.header = read_header(f)
+            f.seek(0, 2)
+            n_packets = (f.tell() - 16 * 1024) // csc_packet.itemsize
+        self.packets = np.memmap(fname, dtype=csc_packet, mode='r', offset=16 * 1024, shape=(n_packets,))
+
+        if self.packets['Fs'].std() > 1e-6:
+            logger.warning('Fs is not fixed across trace, trace sample times will not be accurate')
+        ts_us = np.array(self.packets['timestamp'])
+        idx, starts, self.Fs = csc_sections(ts_us, self.packets['Ns'], self.packets['Fs'][0])
+        self.t0 = ts_us[0]
+        self.sections = np.zeros(starts.size, dtype=[('packet', 'i8'), ('start', 'i8'), ('length', 'i8')])
+        self.sections['packet'] = idx[:-1]
+        self.sections['start'] = starts
+        self.sections['length'] = 512 * np.diff(idx)
+        if idx.size > 2:
+            logger.debug('{:d} gaps in record'.format(idx.size - 2))
+
+    def __len__(self):
+        return int(self.sections['start'][-1] + self.sections['length'][-1])
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            a, b, step = key.indices(len(self))
+            if step != 1:
+                return self[a:b][::step] if step > 0 else self[b + 1:a + 1][::step]
+            return self._read(a, max(a, b))
+        n = int(key) + len(self) if key < 0 else int(key)
+        if not 0 <= n < len(self):
+            raise IndexError('Sample {:d} out of range'.format(int(key)))
+        return self._read(n, n + 1)[0]
+
+    def _read(self, a, b):
+        """Samples a to b of the trace, with zeros in the gaps."""
+        out = np.zeros(b - a, dtype='h')
+        sec = self.sections
+        k = max(0, np.searchsorted(sec['start'], a, 'right') - 1)
+        while k < sec.size and sec['start'][k] < b:
+            s0 = max(a, sec['start'][k])
+            s1 = min(b, sec['start'][k] + sec['length'][k])
+            if s1 > s0:
+                g0 = 512 * sec['packet'][k] + s0 - sec['start'][k]  # Sample index counting from the first packet
+                q0, q1 = g0 // 512, (g0 + s1 - s0 - 1) // 512 + 1
+                out[s0 - a:s1 - a] = self.packets['samp'][q0:q1].ravel()[g0 - 512 * q0:g0 - 512 * q0 + s1 - s0]
+            k += 1
+        return out
+
+
+def read_nev(fin, parse_event_string=False, unique_strings=False):
     """Read an event file.
     Input:
       fin - file handle
-      parse_event_string - If set to true then parse the eventstrings nicely. This takes extra time. Default is False
+      parse_event_string - If set to true then parse the eventstrings nicely. Default is False
+      unique_strings - If set to true (along with parse_event_string) return each distinct eventstring only once, plus
+                       an integer code for every event
     Ouput:
       Dictionary with fields
         'header' - the file header
@@ -164,23 +247,38 @@ def read_nev(fin, parse_event_string=False):
           'dnExtra'
           'eventstring' - The alphanumeric string NeuraLynx attaches to this event
 
-        'eventstring' - Only is parse_event_string is set to True. This is a nicely formatted eventstring
+        'eventstring' - Only if parse_event_string is set to True and unique_strings is False. Numpy array of nicely
+                        formatted eventstrings
+        'eventstring_table' - Only if parse_event_string and unique_strings are True. Sorted numpy array of the
+                              distinct eventstrings
+        'eventstring_codes' - Only if parse_event_string and unique_strings are True. For each event, the index of its
+                              eventstring in 'eventstring_table'
     """
     hdr = read_header(fin)
 
     data = np.fromfile(fin, dtype=nev_packet, count=-1)
     logger.debug('{:d} events'.format(data['timestamp'].size))
-    if parse_event_string:
-        logging.info('Packaging the event strings. This makes things slower.')
-        # Makes things slow. Often this field is not needed
-        evstring = [None] * data['timestamp'].size
-        for n in range(data['timestamp'].size):
-            str = ''.join(data['eventstring'][n])
-            evstring[n] = str.replace('\00', '').strip()
-        return {'header': hdr, 'packets': data, 'eventstring': evstring}
-    else:
+    if not parse_event_string:
         return {'header': hdr, 'packets': data}
 
+    # View the 128 chars of each event as one fixed width bytes string
+    raw = np.ascontiguousarray(data['eventstring']).view('S128').ravel()
+    if unique_strings:
+        # Most events repeat a handful of strings, so only clean up the distinct ones
+        raw_table, codes = np.unique(raw, return_inverse=True)
+        table, table_codes = np.unique(_clean_eventstrings(raw_table), return_inverse=True)
+        return {'header': hdr, 'packets': data, 'eventstring_table': table,
+                'eventstring_codes': table_codes[codes.ravel()]}
+    return {'header': hdr, 'packets': data, 'eventstring': _clean_eventstrings(raw)}
+
+
+def _clean_eventstrings(raw):
+    """Remove the nulls and surrounding whitespace from an array of raw (S128) eventstrings and decode them."""
+    c = np.ascontiguousarray(raw).view('B').reshape(raw.size, raw.dtype.itemsize)
+    # A stable sort on 'is null' moves the non-null bytes to the front of each string, keeping their order
+    c = np.take_along_axis(c, np.argsort(c == 0, axis=1, kind='stable'), axis=1)
+    return np.char.decode(np.char.strip(np.ascontiguousarray(c).view(raw.dtype).ravel()), 'latin-1')
+
 
 def read_nse(fin):
     """Read single electrode spike record.
@@ -207,24 +305,367 @@ def read_nse(fin):
     return {'header': hdr, 'packets': data}
 
 
-def write_nse(fname, time_stamps, remarks=''):
-    """Write out the given time stamps into a nse file."""
-    with open(fname, 'wb') as fout:
-        fmt = '=QII8I32h'
-        dwScNumber = 1
-        dwCellNumber = 1
-        # dnParams = [0]*8
-        # snData = [0]*32
-        garbage = [0] * 40
+def write_nse(fname, time_stamps, remarks='', cell_numbers=None, features=None, waveforms=None, sc_number=1,
+              append=False, chunk_size=100000):
+    """Write out the given spikes into a nse file.
+    Inputs:
+      fname - name of the nse file
+      time_stamps - spike timestamps (us)
+      remarks - string to put in the 16 kB header
+      cell_numbers - cell number of each spike. If None, all spikes go to cell 1
+      features - spikes x 8 array of features. If None, zeros
+      waveforms - spikes x 32 array of waveforms. If None, zeros
+      sc_number - spike acquisition entity number
+      append - if True, and the file exists, add the spikes to the end of the file instead of overwriting it
+      chunk_size - how many spikes to pack and write at a time
+    """
+    time_stamps = np.asarray(time_stamps)
+
+    def chunks():
+        for n0 in range(0, time_stamps.size, chunk_size):
+            n1 = min(n0 + chunk_size, time_stamps.size)
+            packets = np.zeros(n1 - n0, dtype=nse_packet)
+            packets['timestamp'] = time_stamps[n0:n1]
+            packets['saen'] = sc_number
+            packets['cellno'] = 1 if cell_numbers is None else cell_numbers[n0:n1]
+            if features is not None:
+                packets['Features'] = features[n0:n1]
+            if waveforms is not None:
+                packets['waveform'] = waveforms[n0:n1]
+            yield packets
+
+    _write_packets(fname, chunks(), remarks, append)
+
+
+def write_nev(fname, packets, remarks='', append=False):
+    """Write out event packets (nev_packet dtype, e.g. as returned by read_nev) into a nev file.
+    Inputs:
+      fname - name of the nev file
+      packets - the events
+      remarks - string to put in the 16 kB header
+      append - if True, and the file exists, add the events to the end of the file instead of overwriting it
+    """
+    _write_packets(fname, [np.asarray(packets, dtype=nev_packet)], remarks, append)
+
+
+def _write_packets(fname, chunks, remarks, append):
+    """Write a 16 kB header (unless appending to an existing file) followed by each array of packets in chunks."""
+    append = append and os.path.exists(fname) and os.path.getsize(fname) >= 16 * 1024
+    with open(fname, 'ab' if append else 'wb') as fout:
+        if not append:
+            if isinstance(remarks, str):
+                remarks = remarks.encode()
+            fout.write(remarks.ljust(16 * 1024, b'\x00'))
+        for packets in chunks:
+            packets.tofile(fout)
+
+
+class BackgroundWriter:
+    """Write-behind output file shared by the extractors.
+    Arrays passed to write() are put on a bounded queue and written out, in order, by a thread of their own, so that
+    reading the next buffer overlaps with writing the last one. The thread spends its time in tofile, which releases
+    the GIL. If the queue is full write() blocks until there is room, which keeps memory use bounded.
+
+    An array passed to write() must not be modified until depth more arrays have been passed to write() or the writer
+    has been closed. Freshly read or computed arrays are safe. Reused buffers need a ring of at least depth + 1.
+    """
+
+    def __init__(self, fname, mode='wb', max_queue=8):
+        self.fname = fname
+        self.f = open(fname, mode)
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.depth = max_queue + 1  # Queued arrays plus the one being written
+        self.error = None
+        self.thread = threading.Thread(target=self._drain, daemon=True)
+        self.thread.start()
+
+    def _drain(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                break
+            if self.error is None:  # After an error just keep the queue moving, close() reports it
+                try:
+                    data.tofile(self.f)
+                except Exception as e:
+                    self.error = e
+
+    def write(self, data):
+        """Queue an array for writing."""
+        if self.error is not None:
+            raise self.error
+        self.queue.put(data)
+
+    def close(self):
+        """Wait for all the queued arrays to be written and close the file."""
+        self.queue.put(None)
+        self.thread.join()
+        self.f.close()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def nrd_timestamps(packets):
+    """Combine the split 32 bit timestamp fields of nrd packets into a uint64 array (us)."""
+    return (packets['timestamp high'].astype('uint64') << 32) | packets['timestamp low']
+
+
+def read_nrd_channel_count(hdr):
+    """Parse the number of AD channels out of an nrd file header."""
+    hdr = hdr.split()
+    return int(hdr[hdr.index('-NumADChannels') + 1])
+
+
+def find_first_nrd_packet(f, search_bytes=1024 * 1024):
+    """Return the byte offset of the first STX magic number (2048) found at a 32 bit step after the current position
+    of f. The file position is left unchanged. Returns None if no STX is found within search_bytes."""
+    start = f.tell()
+    buf = np.frombuffer(f.read(search_bytes), dtype='B')
+    f.seek(start)
+    words = buf[:buf.size - buf.size % 4].view('<i4')
+    idx = np.flatnonzero(words == 2048)
+    if idx.size == 0:
+        return None
+    return start + 4 * int(idx[0])
+
+
+class NrdFile:
+    """Random access to a raw .nrd file by timestamp.
+
+    The packet region of the file is memory-mapped with the make_nrd_packet dtype, so nothing is read from disk until it
+    is asked for. A sparse index of every index_stride-th packet timestamp is built on first use, after which any
+    timestamp can be located with two binary searches: one over the sparse index and one over index_stride packets.
+    This assumes that the file has no garbage bytes between packets (use extract_nrd_ec for suspect files) and that
+    the timestamps increase monotonically.
 
-        header = remarks.ljust(16 * 1024, b'\x00')
-        fout.write(header)
-        for ts in time_stamps:
-            fout.write(pk(fmt, ts, dwScNumber, dwCellNumber, *garbage))
+    e.g.
+    ----------------------------------------------------------------------------------------------------------------------
+    from neurapy.neuralynx import lynxio
+
+    nrd = lynxio.NrdFile('DigitalLynxRawDataFile.nrd')
+    ts, data = nrd.slice(start_ts, stop_ts, channels=[0, 1, 2, 3])
+    ----------------------------------------------------------------------------------------------------------------------
+    """
+
+    def __init__(self, fname, channels=None, index_stride=4096):
+        """
+        Inputs:
+          fname - name of nrd file
+          channels - total channels in the system. If None, read from the -NumADChannels field of the header
+          index_stride - one packet in every index_stride goes into the sparse timestamp index
+        """
+        self.fname = fname
+        self.index_stride = index_stride
+        with open(fname, 'rb') as f:
+            self.header = read_header(f)
+            self.offset = find_first_nrd_packet(f)
+            f.seek(0, 2)
+            file_size = f.tell()
+
+        if channels is None:
+            channels = read_nrd_channel_count(self.header)
+        self.channels = channels
+        self.nrd_packet = make_nrd_packet(channels)
+        self.packet_size = self.nrd_packet.itemsize
+
+        if self.offset is None:
+            logger.warning('No packets found in {:s}'.format(fname))
+            self.offset = file_size
+        n_packets = (file_size - self.offset) // self.packet_size
+        if n_packets > 0:
+            self.packets = np.memmap(fname, dtype=self.nrd_packet, mode='r', offset=self.offset, shape=(n_packets,))
+        else:
+            self.packets = np.zeros(0, dtype=self.nrd_packet)
+        self._index_pkt = None
+        self._index_ts = None
+
+    def __len__(self):
+        return self.packets.size
+
+    def timestamps(self, start_pkt=0, stop_pkt=None):
+        """Return the timestamps (us) of packets start_pkt to stop_pkt."""
+        return nrd_timestamps(self.packets[start_pkt:stop_pkt])
+
+    def build_index(self):
+        """Read the timestamp of every index_stride-th packet. Touches one page of the file per index entry."""
+        self._index_pkt = np.arange(0, self.packets.size, self.index_stride)
+        self._index_ts = nrd_timestamps(self.packets[::self.index_stride])
+        logger.debug('Indexed {:d} packets with {:d} entries'.format(self.packets.size, self._index_pkt.size))
+
+    def search(self, ts, side='left'):
+        """Equivalent of np.searchsorted(all_timestamps, ts, side) that only reads index_stride packets."""
+        if self._index_ts is None:
+            self.build_index()
+        k = int(np.searchsorted(self._index_ts, ts, side))
+        lo = self._index_pkt[k - 1] + 1 if k > 0 else 0
+        hi = self._index_pkt[k] if k < self._index_pkt.size else self.packets.size
+        return int(lo + np.searchsorted(self.timestamps(lo, hi), ts, side))
+
+    def packet_range(self, start_ts=-1, stop_ts=-1):
+        """Return (start_pkt, stop_pkt) such that packets[start_pkt:stop_pkt] have start_ts <= timestamp <= stop_ts.
+        A value of -1 means the start (end) of the file."""
+        start_pkt = 0 if start_ts == -1 else self.search(start_ts, 'left')
+        stop_pkt = self.packets.size if stop_ts == -1 else self.search(stop_ts, 'right')
+        return start_pkt, max(start_pkt, stop_pkt)
+
+    def slice(self, start_ts=-1, stop_ts=-1, channels=None):
+        """Return the timestamps and AD data of all packets with start_ts <= timestamp <= stop_ts.
+        Inputs:
+          start_ts, stop_ts - Neuralynx timestamps bracketing the data. -1 means start (end) of file
+          channels - None for all channels, an int or a slice for a strided view of the memory map, or a list of
+                     channels for a (packets x len(channels)) copy
+        Outputs:
+          ts - uint64 timestamps (us)
+          data - int32 array, packets x channels
+        """
+        start_pkt, stop_pkt = self.packet_range(start_ts, stop_ts)
+        data = self.packets['data'][start_pkt:stop_pkt]
+        if channels is not None:
+            if isinstance(channels, (int, np.integer, slice)):
+                data = data[:, channels]
+            else:
+                data = np.take(data, channels, axis=1)
+        return self.timestamps(start_pkt, stop_pkt), data
+
+
+def check_nrd_packets(packets, channels):
+    """Vectorized version of the stx, packet id, packet size and crc checks done in extract_nrd_ec.
+    Inputs:
+      packets - array of nrd packets (make_nrd_packet dtype)
+      channels - total channels in the system
+    Outputs:
+      good - boolean array, True for packets that pass all the checks
+      errors - dictionary with the count of packets failing each check: 'stx', 'pkt_id', 'pkt_size', 'crc'
+    """
+    stx_bad = packets['stx'] != 2048
+    pkt_id_bad = packets['pkt_id'] != 1
+    pkt_size_bad = packets['pkt_data_size'] != 10 + channels
+    # The crc is chosen so that the XOR of all the 32 bit words of a good packet is zero
+    words = np.ascontiguousarray(packets).view('I').reshape(packets.size, -1)
+    crc_bad = np.bitwise_xor.reduce(words, axis=1) != 0
+    good = ~(stx_bad | pkt_id_bad | pkt_size_bad | crc_bad)
+    errors = {'stx': int(stx_bad.sum()), 'pkt_id': int(pkt_id_bad.sum()), 'pkt_size': int(pkt_size_bad.sum()),
+              'crc': int(crc_bad.sum())}
+    return good, errors
+
+
+def scan_nrd_buffer(buf, channels, base_offset=0, last_ts=None, eof=False):
+    """Find and validate all the nrd packets in a raw byte buffer.
+    Every offset in the buffer where the STX magic number appears is a candidate packet start. All the candidates are
+    checked together (packet id, packet size and crc) and the good ones are kept. Bytes that are not part of a good
+    packet are reported as bad ranges. Good packets whose timestamp is earlier than a packet before them are dropped
+    and reported too.
+    Inputs:
+      buf - bytes (or uint8 array) read from the packet region of the file
+      channels - total channels in the system
+      base_offset - file offset of the first byte of buf. Only used for reporting
+      last_ts - timestamp of the last good packet before this buffer, if any
+      eof - if False the bytes at the end of buf that could be the start of a packet are not consumed. Pass them at
+            the start of the next buffer. If True, the whole buffer is consumed
+    Outputs:
+      packets - array of good packets (make_nrd_packet dtype)
+      consumed - how many bytes of buf were dealt with
+      bad_ranges - list of dictionaries, one per bad range, with keys
+        'start', 'stop' - file offsets of the range
+        'reason' - first check the bytes at 'start' fail: 'stx', 'pkt_id', 'pkt_size', 'crc', 'truncated' (not
+                   enough bytes left for a packet) or 'ts' (a good packet with an out of order timestamp)
+    """
+    nrd_packet = make_nrd_packet(channels)
+    packet_size = nrd_packet.itemsize
+    words = packet_size // 4
+    b = np.frombuffer(buf, dtype='B')
+    n_scan = max(0, b.size - packet_size + 1)  # Offsets at which a whole packet fits in the buffer
+
+    # All the offsets holding the little endian STX (2048)
+    cand = np.flatnonzero((b[:n_scan] == 0) & (b[1:n_scan + 1] == 8) & (b[2:n_scan + 2] == 0) & (b[3:n_scan + 3] == 0))
+
+    # Check the candidates in bulk, one 32 bit alignment at a time
+    valid = []
+    for a in range(4):
+        ca = cand[cand % 4 == a]
+        if ca.size == 0:
+            continue
+        w = b[a:a + (b.size - a) // 4 * 4].view('<u4')
+        rows = np.lib.stride_tricks.sliding_window_view(w, words)[(ca - a) // 4]
+        ok = (rows[:, 1] == 1) & (rows[:, 2] == 10 + channels) & (np.bitwise_xor.reduce(rows, axis=1) == 0)
+        valid.append(ca[ok])
+    valid = np.sort(np.concatenate(valid)) if valid else np.zeros(0, dtype=int)
+
+    # A good packet can (very rarely) contain a byte sequence that also looks like a good packet. First come wins.
+    if valid.size > 1 and (np.diff(valid) < packet_size).any():
+        keep = []
+        end = 0
+        for v in valid:
+            if v >= end:
+                keep.append(v)
+                end = v + packet_size
+        valid = np.array(keep)
+
+    consumed = b.size if eof else max(n_scan, int(valid[-1]) + packet_size if valid.size else 0)
+
+    # Bytes in between the good packets
+    bad_ranges = []
+    gap_starts = np.insert(valid + packet_size, 0, 0)
+    gap_stops = np.append(valid, consumed)
+    for start, stop in zip(gap_starts[gap_stops > gap_starts], gap_stops[gap_stops > gap_starts]):
+        bad_ranges.append({'start': base_offset + int(start), 'stop': base_offset + int(stop),
+                           'reason': _nrd_bad_reason(b[start:start + packet_size], channels)})
+
+    # Pick the good packets out of a strided view of the buffer, so that only the packets themselves are copied
+    if valid.size > 0:
+        packets = np.lib.stride_tricks.sliding_window_view(b, packet_size)[valid].view(nrd_packet).ravel()
+    else:
+        packets = np.zeros(0, dtype=nrd_packet)
+
+    ts = nrd_timestamps(packets)
+    if ts.size > 0:
+        prev_max = np.maximum.accumulate(np.insert(ts[:-1], 0, ts[0] if last_ts is None else last_ts))
+        ts_bad = ts < prev_max
+        for v in valid[ts_bad]:
+            bad_ranges.append({'start': base_offset + int(v), 'stop': base_offset + int(v) + packet_size,
+                               'reason': 'ts'})
+        packets = packets[~ts_bad]
+
+    bad_ranges.sort(key=lambda e: e['start'])
+    return packets, consumed, bad_ranges
+
+
+def _nrd_bad_reason(b, channels):
+    """Return the first check that the bytes b, which should have been a packet, fail."""
+    if b.size < make_nrd_packet(channels).itemsize:
+        return 'truncated'
+    w = b.view('<u4')
+    if w[0] != 2048:
+        return 'stx'
+    if w[1] != 1:
+        return 'pkt_id'
+    if w[2] != 10 + channels:
+        return 'pkt_size'
+    return 'crc'
+
+
+def _write_channels(fchan, data, channel_list, channel_filter=None):
+    """Queue the channel_list columns of a block of AD data (packets x channels) on the channel writers. If a
+    channel_filter is given (anything with a filter(block) method that carries its state from one block to the next,
+    like neurapy.signal.continuous.StreamFilter) the channels are passed through it as one block and written out in
+    the original data format."""
+    if channel_filter is None:
+        for idx, ch in enumerate(channel_list):
+            fchan[idx].write(data[:, ch])
+    else:
+        y = channel_filter.filter(data[:, channel_list]).astype(data.dtype)
+        for idx in range(len(channel_list)):
+            fchan[idx].write(y[:, idx])
 
 
 def extract_nrd_ec(fname, ftsname, fttlname, fchanname, channel_list, channels=64, max_pkts=-1, buffer_size=10000,
-                   error_bugout=1000000000):
+                   error_bugout=1000000000, channel_filter=None):
     """Read and write out selected raw traces from the .nrd file with error checking.
     Inputs:
       fname - name of nrd file
@@ -235,9 +676,11 @@ def extract_nrd_ec(fname, ftsname, fttlname, fchanname, channel_list, channels=6
       channels - total channels in the system
       max_pkts - total packets to read. If set to -1 then read all packets
       buffer_size   - how many chunks to read at a time.
-      error_bugout - If the sum of stx, crc and timestamp errors exceed this value quit reading the file
+      error_bugout - If the number of bad ranges exceeds this value quit reading the file
+      channel_filter - optional causal filter applied to the channels as they are extracted (see _write_channels)
     Outputs:
       Data are written to file
+      error_log - list of the bad byte ranges found in the file (see scan_nrd_buffer)
 
     e.g.
     ----------------------------------------------------------------------------------------------------------------------
@@ -253,146 +696,89 @@ def extract_nrd_ec(fname, ftsname, fttlname, fchanname, channel_list, channels=6
     fttlname = 'ttl.raw'
     fchanname = ['chan_{:000d}.raw'.format(ch) for ch in channel_list]
     lynxio.extract_nrd_ec(fname, ftsname, fttlname, fchanname, channel_list, channels, max_pkts=1000)
+
+    # Or, to write out spike band traces instead of the raw ones
+    from neurapy.signal import continuous as cc
+    lynxio.extract_nrd_ec(fname, ftsname, fttlname, fchanname, channel_list, channels,
+                          channel_filter=cc.StreamFilter(**cc.lynxspike))
     ----------------------------------------------------------------------------------------------------------------------
 
     Data are written as a pure stream of binary data and can be easily and efficiently read using the numpy read function.
     For convenience, a function that reads the timestamps, events and channels (read_extracted_data) is included in the library.
 
+    Bad packets are handled by scan_nrd_buffer: every good packet in the buffer is kept and only the bytes that are
+    not part of a good packet are skipped. The skipped ranges are returned in error_log.
     """
-
-    def seek_packet(f):
-        """Skip forward until we find the STX magic number."""
-        # Read in 32bit increments until the magic number is found
-        start = f.tell()
-        pkt = f.read(4)
-        while len(pkt) == 4:
-            if pkt == b'\x00\x08\x00\x00':  # Magic number 2048 0x0800
-                f.seek(-4, 1)  # Realign
-                break
-            pkt = f.read(4)
-        stop = f.tell()
-        return stop - start
-
     logger.info('Notice: you are using the slow version of the extractor. All error checks are done')
     nrd_packet = make_nrd_packet(channels)
     packet_size = nrd_packet.itemsize
 
     pkt_cnt = 0
-    garbage_bytes = 0
-    stx_err_cnt = 0
-    pkt_id_err_cnt = 0
-    pkt_size_err_cnt = 0
-    pkt_ts_err_cnt = 0
-    pkt_crc_err_cnt = 0
+    error_log = []
+    last_ts = None
 
     if max_pkts != -1:  # An insidious bug was killed here!
         if buffer_size > max_pkts:
             buffer_size = max_pkts
 
     # The files we will write to.
-    fts = open(ftsname, 'wb')
-    fttl = open(fttlname, 'wb')
-    fchan = [open(fcn, 'wb') for fcn in fchanname]
+    fts = BackgroundWriter(ftsname)
+    fttl = BackgroundWriter(fttlname)
+    fchan = [BackgroundWriter(fcn) for fcn in fchanname]
 
-    last_ts = 0
     with open(fname, 'rb') as f:
         hdr = read_header(f)
         logger.info('File header: {:s}'.format(hdr))
 
-        garbage_bytes += seek_packet(f)
-        these_packets = np.fromfile(f, dtype=nrd_packet, count=buffer_size)
-        while these_packets.size > 0:
-            all_packets_good = True
-            packets_read = these_packets.size
-
-            idx = np.argwhere(these_packets['stx'] != 2048)
-            if idx.size > 0:
-                stx_err_cnt += 1
-                all_packets_good = False
-                max_good_packets = idx[0]
-                these_packets = these_packets[:max_good_packets]
-
-            if these_packets.size > 0:
-                idx = np.argwhere(these_packets['pkt_id'] != 1)
-                if idx.size > 0:
-                    pkt_id_err_cnt += 1
-                    all_packets_good = False
-                    max_good_packets = idx[0]
-                    these_packets = these_packets[:max_good_packets]
-
-            if these_packets.size > 0:
-                idx = np.argwhere(these_packets['pkt_data_size'] != 10 + channels)
-                if idx.size > 0:
-                    pkt_size_err_cnt += 1
-                    all_packets_good = False
-                    max_good_packets = idx[0]
-                    these_packets = these_packets[:max_good_packets]
-
-            if these_packets.size > 0:
-                # crc computation
-                field32 = np.vstack([these_packets[k].T for k in nrd_packet.fields.keys()]).astype('I')
-                crc = np.zeros(these_packets.size, dtype='I')
-                for idx in range(field32.shape[0]):
-                    crc ^= field32[idx, :]
-                idx = np.argwhere(crc != 0)
-                if idx.size > 0:
-                    pkt_crc_err_cnt += 1
-                    all_packets_good = False
-                    max_good_packets = idx[0]
-                    these_packets = these_packets[:max_good_packets]
-
-            if these_packets.size > 0:
-                ts = (these_packets['timestamp high'].astype('uint64') << 32) | these_packets['timestamp low']
-                bad_idx = -1
-                if last_ts > ts[0]:  # Time stamps out of order at buffer boundary
-                    bad_idx = 0
-                else:
-                    idx = np.argwhere(ts[:-1] > ts[1:])
-                    if idx.size > 0:
-                        bad_idx = idx[0] + 1
-                if bad_idx > -1:
-                    logger.info('Out of order timestamp {:d}'.format(int(ts[bad_idx])))
-                    pkt_ts_err_cnt += 1
-                    all_packets_good = False
-                    max_good_packets = bad_idx
-                    these_packets = these_packets[:max_good_packets]
-                    ts = ts[:max_good_packets]
+        buf_offset = f.tell()
+        carry = b''  # Tail of the last buffer that could still be the start of a packet
+        eof = False
+        while not eof:
+            chunk = f.read(buffer_size * packet_size)
+            eof = len(chunk) < buffer_size * packet_size
+            buf = carry + chunk
+            these_packets, consumed, bad_ranges = \
+                scan_nrd_buffer(buf, channels, base_offset=buf_offset, last_ts=last_ts, eof=eof)
+            carry = buf[consumed:]
+            buf_offset += consumed
+            error_log += bad_ranges
 
+            if max_pkts != -1:
+                these_packets = these_packets[:max_pkts - pkt_cnt]
             if these_packets.size > 0:
+                ts = nrd_timestamps(these_packets)
                 last_ts = ts[-1]  # Ready for the next read
-                ts.tofile(fts)
-                these_packets['ttl'].tofile(fttl)
-                for idx, ch in enumerate(channel_list):
-                    these_packets['data'][:, ch].tofile(fchan[idx])
+                fts.write(ts)
+                fttl.write(these_packets['ttl'])
+                _write_channels(fchan, these_packets['data'], channel_list, channel_filter)
 
             pkt_cnt += these_packets.size
             if max_pkts != -1:
-                if pkt_cnt >= max_pkts:  # NOTE: This may give us upto buffer_size -1 more packets than we want.
+                if pkt_cnt >= max_pkts:
                     break
 
-            if not all_packets_good:
-                f.seek((these_packets.size - packets_read) * packet_size + 4, 1)  # Rewind all the way except 32 bits
-                garbage_bytes += seek_packet(f)
-
-            if pkt_ts_err_cnt + pkt_crc_err_cnt + stx_err_cnt > error_bugout:
+            if len(error_log) > error_bugout:
                 logger.warning('Too many errors, bugging out')
                 break
 
-            these_packets = np.fromfile(f, dtype=nrd_packet, count=buffer_size)
-
     fts.close()
     fttl.close()
     [fch.close() for fch in fchan]
 
+    reasons = [e['reason'] for e in error_log]
     logger.info('Extracted {:d} packets'.format(pkt_cnt))
-    logger.info('{:d} garbage words'.format(garbage_bytes))
-    logger.info('{:d} packets had bad stx'.format(stx_err_cnt))
-    logger.info('{:d} packets had bad pkt id'.format(pkt_id_err_cnt))
-    logger.info('{:d} packets had bad crc'.format(pkt_crc_err_cnt))
-    logger.info('{:d} packets had out of order timestamps'.format(pkt_ts_err_cnt))
-
-
-def extract_nrd_fast(fname, ftsname, fttlname, fchanname, channel_list, channels=64, max_pkts=-1, buffer_size=10000):
+    logger.info('{:d} garbage bytes'.format(sum(e['stop'] - e['start'] for e in error_log if e['reason'] != 'ts')))
+    logger.info('{:d} bad ranges failed the stx check'.format(reasons.count('stx')))
+    logger.info('{:d} bad ranges failed the pkt id check'.format(reasons.count('pkt_id')))
+    logger.info('{:d} bad ranges failed the pkt size check'.format(reasons.count('pkt_size')))
+    logger.info('{:d} bad ranges failed the crc check'.format(reasons.count('crc')))
+    logger.info('{:d} packets had out of order timestamps'.format(reasons.count('ts')))
+    build_raw_index(ftsname)
+    return error_log
+
+
+def extract_nrd_fast(fname, ftsname, fttlname, fchanname, channel_list, channels=64, max_pkts=-1, buffer_size=10000,
+                     channel_filter=None):
     """Read and write out selected raw traces from the .nrd file.
     Inputs:
       fname - name of nrd file
@@ -403,6 +789,7 @@ def extract_nrd_fast(fname, ftsname, fttlname, fchanname, channel_list, channels
       channels - total channels in the system
       max_pkts - total packets to read. If set to -1 then read all packets
       buffer_size   - how many chunks to read at a time.
+      channel_filter - optional causal filter applied to the channels as they are extracted (see _write_channels)
     Outputs:
       Data are written to file
 
@@ -438,9 +825,9 @@ def extract_nrd_fast(fname, ftsname, fttlname, fchanname, channel_list, channels
             buffer_size = max_pkts
 
     # The files we will write to. fixme: test for properly opened?
-    fts = open(ftsname, 'wb')
-    fttl = open(fttlname, 'wb')
-    fchan = [open(fcn, 'wb') for fcn in fchanname]
+    fts = BackgroundWriter(ftsname)
+    fttl = BackgroundWriter(fttlname)
+    fchan = [BackgroundWriter(fcn) for fcn in fchanname]
 
     with open(fname, 'rb') as f:
         hdr = read_header(f)
@@ -457,10 +844,9 @@ def extract_nrd_fast(fname, ftsname, fttlname, fchanname, channel_list, channels
         these_packets = np.fromfile(f, dtype=nrd_packet, count=buffer_size)
         while these_packets.size > 0:
             ts = (these_packets['timestamp high'].astype('uint64') << 32) | these_packets['timestamp low']
-            ts.tofile(fts)
-            these_packets['ttl'].tofile(fttl)
-            for idx, ch in enumerate(channel_list):
-                these_packets['data'][:, ch].tofile(fchan[idx])
+            fts.write(ts)
+            fttl.write(these_packets['ttl'])
+            _write_channels(fchan, these_packets['data'], channel_list, channel_filter)
 
             pkt_cnt += these_packets.size
             if max_pkts != -1:
@@ -473,6 +859,137 @@ def extract_nrd_fast(fname, ftsname, fttlname, fchanname, channel_list, channels
     [fch.close() for fch in fchan]
 
     logger.info('Extracted {:d} packets'.format(pkt_cnt))
+    build_raw_index(ftsname)
+
+
+def _extract_nrd_range(args):
+    """Worker for extract_nrd_parallel. Validates and demultiplexes packets [start_pkt, stop_pkt) into part files."""
+    fname, offset, channels, channel_list, start_pkt, stop_pkt, part_names, error_check, buffer_size = args
+    nrd_packet = make_nrd_packet(channels)
+    errors = {'stx': 0, 'pkt_id': 0, 'pkt_size': 0, 'crc': 0, 'ts': 0}
+    pkt_cnt = 0
+    first_ts = None
+    last_ts = None
+
+    fts, fttl = BackgroundWriter(part_names[0]), BackgroundWriter(part_names[1])
+    fchan = [BackgroundWriter(fcn) for fcn in part_names[2:]]
+    with open(fname, 'rb') as f:
+        f.seek(offset + start_pkt * nrd_packet.itemsize)
+        for n0 in range(start_pkt, stop_pkt, buffer_size):
+            these_packets = np.fromfile(f, dtype=nrd_packet, count=min(buffer_size, stop_pkt - n0))
+            if error_check:
+                good, these_errors = check_nrd_packets(these_packets, channels)
+                for k, v in these_errors.items():
+                    errors[k] += v
+                these_packets = these_packets[good]
+            ts = nrd_timestamps(these_packets)
+            if error_check and ts.size > 0:
+                # Drop packets that are earlier than a packet that came before them
+                prev_max = np.maximum.accumulate(np.insert(ts[:-1], 0, ts[0] if last_ts is None else last_ts))
+                good = ts >= prev_max
+                errors['ts'] += int(ts.size - good.sum())
+                these_packets, ts = these_packets[good], ts[good]
+            if ts.size == 0:
+                continue
+
+            if first_ts is None:
+                first_ts = ts[0]
+            last_ts = ts[-1]
+            fts.write(ts)
+            fttl.write(these_packets['ttl'])
+            for idx, ch in enumerate(channel_list):
+                fchan[idx].write(these_packets['data'][:, ch])
+            pkt_cnt += ts.size
+
+    fts.close()
+    fttl.close()
+    [fch.close() for fch in fchan]
+    return {'pkt_cnt': pkt_cnt, 'errors': errors, 'first_ts': first_ts, 'last_ts': last_ts}
+
+
+def extract_nrd_parallel(fname, ftsname, fttlname, fchanname, channel_list, channels=64, max_pkts=-1,
+                         buffer_size=10000, processes=None, error_check=True, ranges_per_process=4):
+    """Parallel version of extract_nrd_ec/extract_nrd_fast.
+    The packet region of the file is split into byte ranges aligned to packet boundaries. Each range is validated (if
+    error_check is True) and demultiplexed by a worker process into its own part files, which are then stitched
+    together, in order, into the output files.
+    Inputs:
+      fname - name of nrd file
+      ftsname - name under which timestamp vector will be saved
+      fttlname - name under which the events will be saved
+      fchanname - a list of file names for the
+      channel_list - Which AD channels to convert.
+      channels - total channels in the system
+      max_pkts - total packets to read. If set to -1 then read all packets
+      buffer_size   - how many packets each worker reads at a time.
+      processes - number of worker processes. If None, use all the cores
+      error_check - if True, drop packets that fail the stx, packet id, packet size, crc or timestamp order checks
+      ranges_per_process - the file is split into this many ranges per process, to balance the load
+    Outputs:
+      Data are written to file
+
+    Unlike extract_nrd_ec, this assumes that there are no garbage bytes between packets, so that packet boundaries can
+    be computed in advance. Bad packets are dropped individually, rather than along with the rest of their buffer.
+    Timestamp order is checked within each range; out of order timestamps at range boundaries are only reported.
+    A channel_filter carries its state through the file in order, so filtering while extracting is only done by the
+    serial extractors (extract_nrd_ec, extract_nrd_fast).
+    """
+    logger.info('Extracting in parallel. Error checks are {:s}'.format('on' if error_check else 'off'))
+    with open(fname, 'rb') as f:
+        hdr = read_header(f)
+        logger.info('File header: {:s}'.format(hdr))
+        offset = find_first_nrd_packet(f)
+        f.seek(0, 2)
+        file_size = f.tell()
+
+    packet_size = make_nrd_packet(channels).itemsize
+    n_packets = 0 if offset is None else (file_size - offset) // packet_size
+    if max_pkts != -1:
+        n_packets = min(n_packets, max_pkts)
+
+    out_names = [ftsname, fttlname] + list(fchanname)
+    if n_packets == 0:
+        logger.warning('No packets found in {:s}'.format(fname))
+        for fout in out_names:  # Empty outputs, as extract_nrd_ec would leave
+            open(fout, 'wb').close()
+        build_raw_index(ftsname)
+        return
+
+    if processes is None:
+        processes = os.cpu_count()
+    n_ranges = max(1, min(processes * ranges_per_process, n_packets // buffer_size))
+    bounds = np.linspace(0, n_packets, n_ranges + 1).astype(int)
+
+    tasks = [(fname, offset, channels, channel_list, bounds[k], bounds[k + 1],
+              ['{:s}.part{:04d}'.format(fout, k) for fout in out_names], error_check, buffer_size)
+             for k in range(n_ranges)]
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        results = list(executor.map(_extract_nrd_range, tasks))
+
+    # Stitch the parts together in order
+    for m, fout in enumerate(out_names):
+        with open(fout, 'wb') as fo:
+            for task in tasks:
+                with open(task[6][m], 'rb') as fi:
+                    shutil.copyfileobj(fi, fo, 16 * 1024 * 1024)
+                os.remove(task[6][m])
+
+    pkt_cnt = sum(r['pkt_cnt'] for r in results)
+    errors = {k: sum(r['errors'][k] for r in results) for k in results[0]['errors']} if results else {}
+    range_ts = [(r['first_ts'], r['last_ts']) for r in results if r['first_ts'] is not None]
+    boundary_errors = sum(range_ts[k][0] < range_ts[k - 1][1] for k in range(1, len(range_ts)))
+
+    logger.info('Extracted {:d} packets'.format(pkt_cnt))
+    build_raw_index(ftsname)
+    if error_check:
+        logger.info('{:d} packets had bad stx'.format(errors['stx']))
+        logger.info('{:d} packets had bad pkt id'.format(errors['pkt_id']))
+        logger.info('{:d} packets had bad pkt size'.format(errors['pkt_size']))
+        logger.info('{:d} packets had bad crc'.format(errors['crc']))
+        logger.info('{:d} packets had out of order timestamps'.format(errors['ts']))
+        if boundary_errors:
+            logger.warning('{:d} out of order timestamps at range boundaries'.format(boundary_errors))
+
 
 def nrd2mda_epochs(nrd_filename, def_filename, mda_prefix, channel_dict, epoch_names, buffer_size=10000):
     """Read raw traces from the nrd file and split into mda files based on the epochs from the defaults file and the
@@ -484,10 +1001,13 @@ def nrd2mda_epochs(nrd_filename, def_filename, mda_prefix, channel_dict, epoch_n
             mda_prefix - mda file prefix - file names will be <mda_prefix><epoch>.nt<n>.mda
             channel_dict - dict with keys as tetrode numbers/names and values as channels to include in each ntrode file
             epoch_names - names of epochs to decode - these must be contained in the defaults file
-            buffer_size - how many chunks to read at a time
+            buffer_size - how many packets to read at a time. Also the size of the output blocks for each ntrode
         Outputs:
           Data are written to file
 
+        The epoch boundaries are found by binary search on the packet timestamps (see NrdFile), which assumes they
+        increase monotonically. The packets spanned by the epochs are then read in a single pass.
+
         Manu S. Madhav
         30-Apr-20
     """
@@ -511,78 +1031,89 @@ def nrd2mda_epochs(nrd_filename, def_filename, mda_prefix, channel_dict, epoch_n
         logger.error('None of these epochs were found in the defaults file')
         return -1
 
-    max_stop_ts = max([v['stop_ts'] for v in mda_epochs.values()])
+    nrd = NrdFile(nrd_filename)
+    logger.info('File header: {:s}'.format(nrd.header))
 
-    # Construct epoch parameter structure and open files for writing
-    for epoch in mda_epochs:
-        nts = {}
+    # Epoch boundaries, as packet indexes, and the mda files for each epoch and tetrode
+    for epoch_name, epoch in mda_epochs.items():
+        epoch['start_pkt'], epoch['stop_pkt'] = nrd.packet_range(epoch['start_ts'], epoch['stop_ts'])
+        n_samples = epoch['stop_pkt'] - epoch['start_pkt']
+        logger.debug('Epoch {:s}: {:d} samples'.format(epoch_name, n_samples))
+        epoch['nts'] = {}
         for nt in channel_dict:
-            nts[nt] = {}
-            nts[nt]['chans'] = channel_dict[nt]
-            mda_filename = '{}{}.nt{:d}.mda'.format(mda_prefix, epoch, nt)
-            mda_fid = open(mda_filename, 'wb')
-
-            # Write mda header
-            num_channels = len(channel_dict[nt])
-            mda_hdr = np.array([-5, 4, 2, num_channels, 0], dtype='i')
-            mda_hdr.tofile(mda_fid)
-
-            # Save file identifier and initialize packet count
-            nts[nt]['fid'] = mda_fid
-            nts[nt]['pkt_cnt'] = 0
-
-        mda_epochs[epoch]['nts'] = nts
-
-    # Start reading NRD file
-    with open(nrd_filename, 'rb') as f:
-        # Read and print header
-        hdr = read_header(f)
-        logger.info('File header: {:s}'.format(hdr))
-
-        # Find number of channels from header
-        hdr = hdr.split()
-        channels = int(hdr[hdr.index('-NumADChannels') + 1])
-        nrd_packet = make_nrd_packet(channels)
-
-        # Read in 32bit increments until the magic number is found
-        pkt = f.read(4)
-        while len(pkt) == 4:
-            if pkt == b'\x00\x08\x00\x00':  # Magic number 2048 0x0800
-                f.seek(-4, 1)  # Realign
-                break
-            pkt = f.read(4)
-
-        these_packets = np.fromfile(f, dtype=nrd_packet, count=buffer_size)
-        ts = 0
-        while these_packets.size > 0 and np.any(ts <= max_stop_ts):
-            ts = (these_packets['timestamp high'].astype('uint64') << 32) | these_packets['timestamp low']
+            mda_filename = '{}{}.nt{:d}.mda'.format(mda_prefix, epoch_name, nt)
+            epoch['nts'][nt] = _MdaBlockWriter(mda_filename, channel_dict[nt], n_samples, buffer_size)
+
+    # One pass over the packets spanned by all the epochs
+    first_pkt = min(epoch['start_pkt'] for epoch in mda_epochs.values())
+    last_pkt = max(epoch['stop_pkt'] for epoch in mda_epochs.values())
+    for n0 in range(first_pkt, last_pkt, buffer_size):
+        n1 = min(n0 + buffer_size, last_pkt)
+        data = np.array(nrd.packets['data'][n0:n1])  # One sequential read
+        for epoch in mda_epochs.values():
+            e0 = max(epoch['start_pkt'], n0) - n0
+            e1 = min(epoch['stop_pkt'], n1) - n0
+            if e1 > e0:
+                for nt in epoch['nts'].values():
+                    nt.add(data[e0:e1])
 
-            for epoch in mda_epochs.values():
-                ts_idx = np.argwhere(np.logical_and(ts >= epoch['start_ts'], ts <= epoch['stop_ts']))
-                if ts_idx.size != 0:
-                    for nt in epoch['nts'].values():
-                        these_packets['data'][ts_idx, nt['chans']].tofile(nt['fid'])
-                        nt['pkt_cnt'] += these_packets.size
-
-            these_packets = np.fromfile(f, dtype=nrd_packet, count=buffer_size)
-
-    # Rewrite packet size in header.
     for epoch in mda_epochs.values():
         for nt in epoch['nts'].values():
-            nt['fid'].seek(16)
-            np.array(nt['pkt_cnt'], dtype='i').tofile(nt['fid'])
-            nt['fid'].close()
+            nt.close()
 
     return 0
 
 
+class _MdaBlockWriter:
+    """Write selected channels of nrd data into an int32 .mda file whose number of samples is known in advance.
+    Samples are gathered into a ring of preallocated blocks. A full block is handed to a BackgroundWriter and the next
+    block is filled. The ring is one block longer than the writer can hold, so a block is never refilled while it is
+    still waiting to be written."""
+
+    def __init__(self, fname, chans, n_samples, block_len, max_queue=2):
+        self.fname = fname
+        self.chans = chans
+        self.n_samples = n_samples
+        self.f = BackgroundWriter(fname, max_queue=max_queue)
+        self.f.write(np.array([-5, 4, 2, len(chans), n_samples], dtype='i'))
+        self.blocks = [np.empty((block_len, len(chans)), dtype='i') for _ in range(self.f.depth + 1)]
+        self.which = 0
+        self.fill = 0
+        self.n_written = 0
+
+    def add(self, data):
+        """Append the samples of our channels from data (packets x all channels)."""
+        n = 0
+        while n < data.shape[0]:
+            block = self.blocks[self.which]
+            m = min(block.shape[0] - self.fill, data.shape[0] - n)
+            np.take(data[n:n + m], self.chans, axis=1, out=block[self.fill:self.fill + m])
+            self.fill += m
+            n += m
+            if self.fill == block.shape[0]:
+                self.flush()
+
+    def flush(self):
+        if self.fill > 0:
+            self.f.write(self.blocks[self.which][:self.fill])
+            self.n_written += self.fill
+            self.which = (self.which + 1) % len(self.blocks)
+        self.fill = 0
+
+    def close(self):
+        self.flush()
+        self.f.close()
+        if self.n_written != self.n_samples:
+            logger.error('{:s}: wrote {:d} samples, expected {:d}'.format(self.fname, self.n_written, self.n_samples))
+
+
 def nrd2mda_fast(fname, fmdaname, channel_list, max_pkts=-1, buffer_size=10000, start_ts=-1, stop_ts=-1):
     """Read and write out selected raw traces from the .nrd file.
     Inputs:
       fname - name of nrd file
       fmdaname - output mda file name
       channel_list - Which AD channels to convert.
-      max_pkts - total packets to read. If set to -1 then read all packets
+      max_pkts - total packets to write. If set to -1 then write all packets between start_ts and stop_ts
       buffer_size   - how many chunks to read at a time.
       start_ts - Neuralynx timestamp above which to write to file. If set to -1 then start_ts is start of nrd file
       stop_ts - Neuralynx timestamp below which to write to file. If set to -1 then stop_ts is end of nrd file
@@ -610,55 +1141,25 @@ def nrd2mda_fast(fname, fmdaname, channel_list, max_pkts=-1, buffer_size=10000,
     You can note if you have packet errors from your Cheetah software.
     """
     logger.info('Notice: you are using the fast version of the extractor. No error checks are done')
-    nrd_packet = make_nrd_packet(channels)
-
-    pkt_cnt = 0
-    if max_pkts != -1:  # An insidious bug was killed here!
-        if buffer_size > max_pkts:
-            buffer_size = max_pkts
+    nrd = NrdFile(fname)
+    logger.info('File header: {:s}'.format(nrd.header))
 
-    if stop_ts == -1:
-        stop_ts = np.inf
+    # Jump straight to the requested packets instead of scanning the file from the start
+    start_pkt, stop_pkt = nrd.packet_range(start_ts, stop_ts)
+    if max_pkts != -1:
+        stop_pkt = min(stop_pkt, start_pkt + max_pkts)
+    pkt_cnt = stop_pkt - start_pkt
 
     # The files we will write to. fixme: test for properly opened?
-    fmda = open(fmdaname, 'wb')
+    fmda = BackgroundWriter(fmdaname)
     # Write mda header
     num_channels = len(channel_list)
-    mda_hdr = np.array([-5, 4, 2, num_channels, 0], dtype='i')
-    mda_hdr.tofile(fmda)
+    mda_hdr = np.array([-5, 4, 2, num_channels, pkt_cnt], dtype='i')
+    fmda.write(mda_hdr)
 
-    with open(fname, 'rb') as f:
-        hdr = read_header(f)
-        logger.info('File header: {:s}'.format(hdr))
-
-        # Find number of channels from header
-        hdr = hdr.split()
-        channels = int(hdr[hdr.index('-NumADChannels') + 1])
-
-        # Read in 32bit increments until the magic number is found
-        pkt = f.read(4)
-        while len(pkt) == 4:
-            if pkt == b'\x00\x08\x00\x00':  # Magic number 2048 0x0800
-                f.seek(-4, 1)  # Realign
-                break
-            pkt = f.read(4)
-
-        these_packets = np.fromfile(f, dtype=nrd_packet, count=buffer_size)
-        ts = 0
-        while these_packets.size > 0 and np.any(ts <= stop_ts):
-            ts = (these_packets['timestamp high'].astype('uint64') << 32) | these_packets['timestamp low']
-            ts_idx = np.argwhere(np.logical_and(ts >= start_ts, ts <= stop_ts))
-            these_packets['data'][ts_idx, channel_list].tofile(fmda)
-
-            pkt_cnt += these_packets.size
-            if max_pkts != -1:
-                if pkt_cnt >= max_pkts:  # NOTE: This may give us upto buffer_size -1 more packets than we want.
-                    break
-            these_packets = np.fromfile(f, dtype=nrd_packet, count=buffer_size)
-
-    # Rewrite packet size in header.
-    fmda.seek(16)
-    np.array(pkt_cnt, dtype='i').tofile(fmda)
+    for n0 in range(start_pkt, stop_pkt, buffer_size):
+        n1 = min(n0 + buffer_size, stop_pkt)
+        fmda.write(np.take(nrd.packets['data'][n0:n1], channel_list, axis=1))
 
     fmda.close()
     logger.info('Extracted {:d} packets'.format(pkt_cnt))
@@ -686,3 +1187,129 @@ def read_extracted_data(fname, type='addata'):
         return None
 
     return np.memmap(fname, dtype=fmt, mode='r')
+
+
+def build_raw_index(ftsname, block_size=4096, gap_factor=2.0, chunk_size=1 << 24):
+    """Write a compact sidecar index for a timestamp file written by one of the extractors.
+    Inputs:
+      ftsname - name of the timestamp file
+      block_size - number of samples summarized by each block of the index
+      gap_factor - a step between timestamps larger than gap_factor times the typical step is a gap in the recording
+      chunk_size - how many timestamps to process at a time
+    Output:
+      The index, as returned by load_raw_index. It is saved (if the directory is writable) next to the timestamp file
+      as <ftsname>.idx.npz with
+        'block_size'
+        'block_min', 'block_max' - smallest and largest timestamp in each block of block_size samples
+        'gap_idx' - index of every sample that comes after a gap
+        'section_Fs' - sampling frequency estimated from the timestamps for each section between gaps
+        'n_samples'
+        'source_size', 'source_mtime' - of the timestamp file, to tell if the index is stale
+    """
+    chunk_size = max(1, chunk_size // block_size) * block_size  # So that blocks don't straddle chunks
+    st = os.stat(ftsname)
+    n_samples = st.st_size // 8
+    ts = np.memmap(ftsname, dtype='Q', mode='r') if n_samples > 0 else np.zeros(0, dtype='Q')
+
+    block_min, block_max, gap_idx = [], [], []
+    dt_typical = None
+    for n0 in range(0, n_samples, chunk_size):
+        chunk = np.array(ts[n0:min(n0 + chunk_size + 1, n_samples)])  # One extra to get the step at the boundary
+        body = chunk[:min(chunk_size, chunk.size)]
+        n_full = body.size // block_size * block_size
+        block_min.append(body[:n_full].reshape(-1, block_size).min(axis=1))
+        block_max.append(body[:n_full].reshape(-1, block_size).max(axis=1))
+        if n_full < body.size:
+            block_min.append(body[n_full:].min(keepdims=True))
+            block_max.append(body[n_full:].max(keepdims=True))
+        dt = np.diff(chunk.astype('int64'))
+        if dt_typical is None and dt.size > 0:
+            dt_typical = np.median(dt)
+        if dt.size > 0:
+            gap_idx.append(n0 + 1 + np.flatnonzero(dt > gap_factor * dt_typical))
+
+    gap_idx = np.concatenate(gap_idx) if gap_idx else np.zeros(0, dtype=int)
+    bounds = np.concatenate(([0], gap_idx, [n_samples])).astype(int)
+    section_Fs = np.zeros(bounds.size - 1)
+    for n in range(bounds.size - 1):
+        if bounds[n + 1] - bounds[n] > 1:
+            section_Fs[n] = (bounds[n + 1] - bounds[n] - 1) / ((int(ts[bounds[n + 1] - 1]) - int(ts[bounds[n]])) * 1e-6)
+
+    index = {'block_size': block_size,
+             'block_min': np.concatenate(block_min) if block_min else np.zeros(0, dtype='Q'),
+             'block_max': np.concatenate(block_max) if block_max else np.zeros(0, dtype='Q'),
+             'gap_idx': gap_idx, 'section_Fs': section_Fs, 'n_samples': n_samples,
+             'source_size': st.st_size, 'source_mtime': st.st_mtime}
+    try:
+        np.savez(ftsname + '.idx.npz', **index)
+    except OSError as e:  # e.g. a read-only archive. The index is still good for this session
+        logger.warning('Could not save index for {:s}: {:s}'.format(ftsname, str(e)))
+    logger.debug('Indexed {:s}: {:d} samples, {:d} gaps'.format(ftsname, n_samples, gap_idx.size))
+    return index
+
+
+def load_raw_index(ftsname):
+    """Load the sidecar index of a timestamp file, (re)building it if it is missing or out of date."""
+    fidxname = ftsname + '.idx.npz'
+    if os.path.exists(fidxname):
+        with np.load(fidxname) as f:
+            index = {k: f[k] for k in f.files}
+        st = os.stat(ftsname)
+        if index['source_size'] == st.st_size and index['source_mtime'] == st.st_mtime:
+            for k in ['block_size', 'n_samples', 'source_size', 'source_mtime']:
+                index[k] = index[k].item()
+            return index
+        logger.info('Index for {:s} is out of date'.format(ftsname))
+    return build_raw_index(ftsname)
+
+
+class RawSession:
+    """The timestamp, ttl and channel files written by the extractors for one session, with fast lookup by time.
+    Uses the sidecar index written by build_raw_index (built here if needed) so that finding the sample for a
+    timestamp is a binary search over the blocks followed by a binary search inside one block. Assumes the timestamps
+    increase monotonically, which is what extract_nrd_ec guarantees.
+
+    e.g.
+    ----------------------------------------------------------------------------------------------------------------------
+    from neurapy.neuralynx import lynxio
+
+    session = lynxio.RawSession('timestamps.raw', 'ttl.raw', ['chan_000.raw', 'chan_001.raw'])
+    n0, n1 = session.time_to_sample([t0, t1])
+    x = session.channels[1][n0:n1]
+    ----------------------------------------------------------------------------------------------------------------------
+    """
+
+    def __init__(self, ftsname='timestamps.raw', fttlname='ttl.raw', fchanname=()):
+        self.index = load_raw_index(ftsname)
+        self.timestamps = read_extracted_data(ftsname, 'ts')
+        self.ttl = read_extracted_data(fttlname, 'ttl') if fttlname is not None else None
+        self.channels = [read_extracted_data(fcn, 'addata') for fcn in fchanname]
+
+    @property
+    def Fs(self):
+        """Sampling frequency averaged over all the sections of the recording."""
+        sections = np.diff(np.concatenate(([0], self.index['gap_idx'], [self.index['n_samples']])))
+        return (self.index['section_Fs'] * sections).sum() / sections.sum()
+
+    @property
+    def gaps(self):
+        """Index of every sample that comes after a gap in the recording."""
+        return self.index['gap_idx']
+
+    def time_to_sample(self, t, side='left'):
+        """Equivalent of np.searchsorted(timestamps, t, side) that reads one block of timestamps per distinct block
+        the values of t fall in. t can be a scalar or an array."""
+        t = np.asarray(t)
+        block_size = self.index['block_size']
+        blk = np.searchsorted(self.index['block_max'], t, side)
+        out = np.empty(t.shape, dtype='int64')
+        for b in np.unique(blk):
+            sel = blk == b
+            n0 = b * block_size
+            out[sel] = n0 + np.searchsorted(self.timestamps[n0:n0 + block_size], t[sel], side)
+        out = np.minimum(out, self.index['n_samples'])
+        return out if out.ndim else int(out)
+
+    def window(self, t0, t1):
+        """Return the slice of samples with t0 <= timestamp <= t1, for use on the timestamps, ttl or channels."""
+        return slice(self.time_to_sample(t0, 'left'), self.time_to_sample(t1, 'right'))
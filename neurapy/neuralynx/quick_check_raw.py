@@ -1,67 +1,115 @@
 """The functions in lynxio.py allow you to extract raw binary data from the raw Neuralynx files (.nrd)
 This script does a quick check of the extraction by comparing the data in the TTL events and the Events.nev file.
 Tp be able to run this you should be saving the Events.nev file while recording the data.
+Pass -d to check every session under a directory tree instead.
 """
 
 import os, argparse, logging
+from multiprocessing import Pool
+import numpy as np
 logger = logging.getLogger(__name__)
 from neurapy.neuralynx import lynxio
 
-def check_codes(codes, times, codes_raw, times_raw):
-  """Cycle through each event in turn (ignore events with code 0 - those are recording start and do not match in the
-  raw file), find the raw code that corresponds to the matching time and see if the code matches. Flag the file if
-  any code does not match up and spit out the first index and time stamp where things don't match. Return True if no
-  errors with the file, False otherwise"""
-
-  cri = 0
-  for n, (code, time) in enumerate(zip(codes, times)):
-    time = int(time)
-    if code == 0: continue
-    while times_raw[cri] != time:
-      #cri += int((time - int(times_raw[cri]))/30.8 + .5)
-      fwd = (time - int(times_raw[cri])) >> 5
-      if fwd == 0: fwd = 1
-      cri += fwd
-      if cri >= times_raw.size:
-        logger.error('Problem with matching code times for code #{:d}: Ran out of raw data'.format(n))
-        return False
-
-    #If we get here we successfully matched up times
-    if (code ^ codes_raw[cri]) & 0xff: #More compact way of testing if the lower 8 bits of the two are same
-      logger.error('Times matchup, but codes do not for code #{:d}'.format(n))
-      return False
-
-  return True #If we get here, all is OK
+def match_codes(codes, times, codes_raw, times_raw, raw_idx=None):
+  """Find, for every event (ignoring events with code 0 - those are recording start and do not match in the raw file),
+  the raw sample with the same time stamp and compare the codes.
+  Inputs:
+    codes, times - event codes and times from the Events.nev file
+    codes_raw, times_raw - the extracted ttl and timestamps
+    raw_idx - np.searchsorted(times_raw, times), if already known (e.g. from lynxio.RawSession.time_to_sample)
+  Output: Dictionary with fields
+    'missing' - indexes of the events whose time stamp is not in the raw data
+    'mismatch' - indexes of the events whose time stamp matches but whose code does not (lower 8 bits)
+    'raw_idx' - for each event, the index of the raw sample with the same time stamp (-1 if none or code 0)
+  """
+  codes = np.asarray(codes)
+  times = np.asarray(times).astype('uint64')
+  if raw_idx is None:
+    raw_idx = np.searchsorted(times_raw, times)
+  raw_idx = np.asarray(raw_idx)
+
+  check = np.flatnonzero(codes != 0)
+  cri = raw_idx[check]
+  found = cri < times_raw.size
+  found[found] = times_raw[cri[found]] == times[check[found]]
+  matched, cri = check[found], cri[found]
+  mismatch = ((codes[matched] ^ codes_raw[cri]) & 0xff) != 0 #Compact way of testing if the lower 8 bits are the same
+
+  all_raw_idx = -np.ones(codes.size, dtype='int64')
+  all_raw_idx[matched] = cri
+  return {'missing': check[~found], 'mismatch': matched[mismatch], 'raw_idx': all_raw_idx}
+
+def check_codes(codes, times, codes_raw, times_raw, raw_idx=None):
+  """Match up the events with the raw data (see match_codes) and log every event whose time or code does not match.
+  Return True if no errors with the file, False otherwise"""
+  report = match_codes(codes, times, codes_raw, times_raw, raw_idx)
+  for n in report['missing']:
+    logger.error('No raw data with the time of code #{:d} ({:d})'.format(int(n), int(times[n])))
+  for n in report['mismatch']:
+    logger.error('Times matchup, but codes do not for code #{:d} ({:d})'.format(int(n), int(times[n])))
+  return report['missing'].size == 0 and report['mismatch'].size == 0
 
 def process_session(events_nev_fname='Events.nev', timestamps_raw_fname='timestamps.raw', ttl_raw_fname='ttl.raw'):
-  """Wrapper around check_codes."""
+  """Wrapper around check_codes. Returns True if the conversion checks out, False if it does not and None if there is
+  nothing to check."""
   for fname in [events_nev_fname, timestamps_raw_fname, ttl_raw_fname]:
     if not os.path.exists(fname):
       logger.info('Missing file {:s}'.format(fname))
       return
 
-  events = lynxio.read_nev(open(events_nev_fname))
+  with open(events_nev_fname, 'rb') as f:
+    events = lynxio.read_nev(f)
   codes = events['packets']['nttl']
   times = events['packets']['timestamp']
 
   if not len(codes): return #These lead to 0 byte .raw files and screw us up
 
-  times_raw = lynxio.read_extracted_data(timestamps_raw_fname, 'ts')
-  codes_raw = lynxio.read_extracted_data(ttl_raw_fname, 'ttl')
+  session = lynxio.RawSession(timestamps_raw_fname, ttl_raw_fname)
+  raw_idx = session.time_to_sample(times)
 
-  if not check_codes(codes, times, codes_raw, times_raw):
+  if not check_codes(codes, times, session.ttl, session.timestamps, raw_idx):
     logger.error('Problem with file')
-    return
+    return False
 
   logger.info('File conversion checks out')
-  return
+  return True
+
+def _process_dir(args):
+  """Worker for process_tree. A session that can not be checked (e.g. truncated or malformed files) is logged and
+  reported as 'error' so that it does not stop the rest of the run."""
+  dirname, fnames = args
+  try:
+    return dirname, process_session(*[os.path.join(dirname, fn) for fn in fnames])
+  except Exception as e:
+    logger.error('{:s}: {:s}: {:s}'.format(dirname, type(e).__name__, str(e)))
+    return dirname, 'error'
+
+def process_tree(root='.', events_nev_fname='Events.nev', timestamps_raw_fname='timestamps.raw',
+                 ttl_raw_fname='ttl.raw', processes=None):
+  """Run process_session on every directory under root that has all three files, using a pool of processes.
+  Returns a dictionary mapping each directory to the result of process_session ('error' if the check itself failed)."""
+  fnames = (events_nev_fname, timestamps_raw_fname, ttl_raw_fname)
+  dirs = [dirname for dirname, _, files in os.walk(root) if all(fn in files for fn in fnames)]
+  logger.info('Checking {:d} sessions'.format(len(dirs)))
+
+  results = {}
+  with Pool(processes) as pool:
+    for dirname, ok in pool.imap_unordered(_process_dir, [(d, fnames) for d in dirs]):
+      logger.info('{:s}: {:s}'.format(dirname, {True: 'OK', False: 'PROBLEM', None: 'nothing to check', 'error': 'ERROR'}[ok]))
+      results[dirname] = ok
+  return results
 
 if __name__ == '__main__':
   parser = argparse.ArgumentParser(description=__doc__)
-  parser.add_argument('-e', default='Events.nev', help='Full path to Events.nev file')
-  parser.add_argument('-t', default='timestamps.raw', help='Full path to timestamps raw file')
-  parser.add_argument('-l', default='ttl.raw', help='Full path to ttl raw file')
+  parser.add_argument('-e', default='Events.nev', help='Full path to Events.nev file (file name in batch mode)')
+  parser.add_argument('-t', default='timestamps.raw', help='Full path to timestamps raw file (file name in batch mode)')
+  parser.add_argument('-l', default='ttl.raw', help='Full path to ttl raw file (file name in batch mode)')
+  parser.add_argument('-d', default=None, help='Check every session under this directory')
+  parser.add_argument('-p', default=None, type=int, help='Number of processes in batch mode (default: all cores)')
   args = parser.parse_args()
 
   logging.basicConfig(level=logging.DEBUG)
-  process_session(args.e, args.t, args.l)
\ No newline at end of file
+  if args.d is None:
+    process_session(args.e, args.t, args.l)
+  else:
+    process_tree(args.d, args.e, args.t, args.l, args.p)
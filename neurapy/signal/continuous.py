@@ -1,8 +1,9 @@
 """Some methods for dealing with continuous data. We assume that the original data is in files and that they are
 annoyingly large. So all the methods here work on buffered input, using memory maps.
 """
+import multiprocessing
 import pylab
-from scipy.signal import filtfilt, iirdesign
+from scipy.signal import iirdesign, sosfilt, sosfilt_zi, sosfiltfilt, sos2tf, sos2zpk, tf2sos
 
 #Some useful presets for loading continuous data dumped from the Neuralynx system
 lynxlfp = {
@@ -12,8 +13,8 @@ lynxlfp = {
   'fh' : 100,
   'gpass' : 0.1,
   'gstop' : 15,
-  'buffer_len' : 100000,
-  'overlap_len': 100,
+  'buffer_len' : 1000000,
+  'overlap_len': None,
   'max_len': -1
 }
 
@@ -24,36 +25,80 @@ lynxspike = {
   'fh' : 8000,
   'gpass' : 0.1,
   'gstop' : 15,
-  'buffer_len' : 100000,
-  'overlap_len': 100,
+  'buffer_len' : 1000000,
+  'overlap_len': None,
   'max_len': -1
 }
 """Use these presets as follows
 
 from neurapy.utility import continuous as cc
-y,b,a = cc.butterfilt('chan_000.raw', 'test.raw', **cc.lynxlfp)"""
+y,b,a = cc.butterfilt('chan_000.raw', 'test.raw', **cc.lynxlfp)
 
+The filtering itself is done with second order sections. To get those, use design_filter
 
-def butterfilt(finname, foutname, fmt, fs, fl=5.0, fh=100.0, gpass=1.0, gstop=30.0, ftype='butter', buffer_len=100000, overlap_len=100, max_len=-1):
-  """Given sampling frequency, low and high pass frequencies design a butterworth filter and filter our data with it."""
+sos = cc.design_filter(cc.lynxlfp['fs'], cc.lynxlfp['fl'], cc.lynxlfp['fh'], cc.lynxlfp['gpass'], cc.lynxlfp['gstop'])
+y = cc.sosfiltfiltlong('chan_000.raw', 'test.raw', 'i', sos)
+
+or, for causal filtering on the fly (see StreamFilter)
+
+sf = cc.StreamFilter(**cc.lynxspike)
+for y in sf.stream(blocks):
+  ..."""
+
+
+def design_filter(fs, fl=5.0, fh=100.0, gpass=1.0, gstop=30.0, ftype='butter'):
+  """Given sampling frequency, low and high pass frequencies design a band pass filter and return it as second order
+  sections (which, unlike b,a, stay stable for the narrow low frequency bands we use for the LFP)."""
   fso2 = fs/2.0
   wp = [fl/fso2, fh/fso2]
   ws = [0.8*fl/fso2,1.4*fh/fso2]
-  import pdb; pdb.set_trace()
-  b, a = iirdesign(wp, ws, gpass=gpass, gstop=gstop, ftype=ftype, output='ba')
-  y = filtfiltlong(finname, foutname, fmt, b, a, buffer_len, overlap_len, max_len)
+  return iirdesign(wp, ws, gpass=gpass, gstop=gstop, ftype=ftype, output='sos')
+
+
+def impulse_len(sos, tol=1e-6):
+  """How many samples it takes the impulse response of the filter to die down by a factor of tol. Worked out from the
+  slowest decaying pole, whose envelope goes as r^n. We use this as the overlap between chunks."""
+  z, p, k = sos2zpk(sos)
+  r = pylab.absolute(p).max() if len(p) else 0
+  if r <= 0:
+    return len(sos) * 2
+  return int(pylab.ceil(pylab.log(tol)/pylab.log(r)))
+
+
+def butterfilt(finname, foutname, fmt, fs, fl=5.0, fh=100.0, gpass=1.0, gstop=30.0, ftype='butter', buffer_len=100000,
+               overlap_len=None, max_len=-1, processes=1):
+  """Given sampling frequency, low and high pass frequencies design a butterworth filter and filter our data with it.
+  finname/foutname can be lists of files, which are then filtered in parallel (see filtfiltmany).
+  Returns y, b, a where b, a are the filter coefficients. The data are filtered with the second order sections from
+  design_filter, which is the better form to use if you want to apply the filter yourself."""
+  sos = design_filter(fs, fl, fh, gpass, gstop, ftype)
+  if isinstance(finname, str):
+    y = sosfiltfiltlong(finname, foutname, fmt, sos, buffer_len, overlap_len, max_len, processes)
+  else:
+    y = filtfiltmany(finname, foutname, fmt, sos, buffer_len, overlap_len, max_len, processes)
+  b, a = sos2tf(sos)
   return y, b, a
 
-def filtfiltlong(finname, foutname, fmt, b, a, buffer_len=100000, overlap_len=100, max_len=-1):
+
+def filtfiltlong(finname, foutname, fmt, b, a, buffer_len=100000, overlap_len=None, max_len=-1, processes=1):
+  """sosfiltfiltlong for a filter given as coefficients b, a. These are converted to second order sections (tf2sos),
+  which does not recover the precision already lost in b, a for narrow bands, so prefer design_filter and
+  sosfiltfilt when designing a new filter."""
+  return sosfiltfiltlong(finname, foutname, fmt, tf2sos(b, a), buffer_len, overlap_len, max_len, processes)
+
+
+def sosfiltfiltlong(finname, foutname, fmt, sos, buffer_len=100000, overlap_len=None, max_len=-1, processes=1):
   """Use memmap and chunking to filter continuous data.
   Inputs:
     finname -
     foutname    -
     fmt         - data format eg 'i'
-    b,a         - filter coefficients
+    sos         - filter as second order sections (e.g. from design_filter)
     buffer_len  - how much data to process at a time
-    overlap_len - how much data do we add to the end of each chunk to smooth out filter transients
+    overlap_len - how much data do we add to the end of each chunk to smooth out filter transients. If None, use the
+                  length of the filter's impulse response (impulse_len)
     max_len     - how many samples to process. If set to -1, processes the whole file
+    processes   - how many processes to filter the chunks with (None means one per core)
   Outputs:
     y           - The memmapped array pointing to the written file
 
@@ -71,21 +116,113 @@ def filtfiltlong(finname, foutname, fmt, b, a, buffer_len=100000, overlap_len=10
 
     From the array of data we cut out contiguous buffers (b1,b2,...) and to each buffer we add some extra overlap to
     make chunks (c1,c2). The overlap helps to remove the transients from the filtering which would otherwise appear at
-    each buffer boundary.
+    each buffer boundary. The chunks are independent, so they can be filtered in any order, by different processes.
+
+  """
+  return filtfiltmany([finname], [foutname], fmt, sos, buffer_len, overlap_len, max_len, processes)[0]
+
+
+def filtfiltmany(finnames, foutnames, fmt, sos, buffer_len=100000, overlap_len=None, max_len=-1, processes=None):
+  """sosfiltfiltlong for a list of files. The chunks of all the files are handed out to a pool of processes, each of which
+  reads its chunk from the input memmap and writes its buffer straight into the output memmap. Returns a list of
+  memmapped arrays pointing to the written files."""
+  if overlap_len is None:
+    overlap_len = impulse_len(sos)
+
+  jobs = []
+  for finname, foutname in zip(finnames, foutnames):
+    n_in = pylab.memmap(finname, dtype=fmt, mode='r').size
+    n_out = n_in if max_len == -1 else min(max_len, n_in)
+    pylab.memmap(foutname, dtype=fmt, mode='w+', shape=n_out).flush()  # Create the output file at full size
+    for buff_st_idx in range(0, n_out, buffer_len):
+      buff_nd_idx = min(n_out, buff_st_idx + buffer_len)
+      jobs.append((finname, foutname, fmt, sos, buff_st_idx, buff_nd_idx, overlap_len))
 
+  if processes == 1:
+    for job in jobs:
+      _filtfilt_chunk(job)
+  else:
+    pool = multiprocessing.Pool(processes)
+    try:
+      pool.map(_filtfilt_chunk, jobs, chunksize=1)
+    finally:
+      pool.close()
+      pool.join()
+
+  return [pylab.memmap(foutname, dtype=fmt, mode='r+') for foutname in foutnames]
+
+
+def _filtfilt_chunk(args):
+  """Filter one chunk for filtfiltmany and write its buffer into the output file."""
+  finname, foutname, fmt, sos, buff_st_idx, buff_nd_idx, overlap_len = args
+  x = pylab.memmap(finname, dtype=fmt, mode='r')
+  y = pylab.memmap(foutname, dtype=fmt, mode='r+')
+  chk_st_idx = max(0, buff_st_idx - overlap_len)
+  chk_nd_idx = min(x.size, buff_nd_idx + overlap_len)
+  rel_st_idx = buff_st_idx - chk_st_idx
+  rel_nd_idx = buff_nd_idx - chk_st_idx
+  this_y_chk = sosfiltfilt(sos, x[chk_st_idx:chk_nd_idx])
+  y[buff_st_idx:buff_nd_idx] = this_y_chk[rel_st_idx:rel_nd_idx]
+  y.flush()
+
+
+class StreamFilter(object):
+  """Causal band pass filter that carries its state from one block of data to the next, so a recording can be filtered
+  in a single pass, in constant memory, as it is read (or while it is still being written). The output is identical to
+  filtering the whole recording in one go with sosfilt (but, unlike butterfilt, it is not zero phase).
+
+  Blocks are 1-D (samples) or 2-D (samples x channels) arrays, e.g. the AD data of successive NRD packets
+
+  nrd = lynxio.NrdFile('DigitalLynxRawDataFile.nrd')
+  sf = StreamFilter(**lynxspike)
+  blocks = (nrd.packets['data'][n:n + 10000, 0:4] for n in range(0, len(nrd), 10000))
+  for y in sf.stream(blocks):
+    ...
   """
+
+  def __init__(self, fs, fl=5.0, fh=100.0, gpass=1.0, gstop=30.0, ftype='butter', **kwargs):
+    """Takes the same arguments as butterfilt (any that don't apply, like buffer_len, are ignored) so the presets can be
+    passed in directly."""
+    self.sos = design_filter(fs, fl, fh, gpass, gstop, ftype)
+    self.zi = None
+
+  def reset(self):
+    """Forget the state, e.g. before starting on a new recording."""
+    self.zi = None
+
+  def filter(self, x):
+    """Filter the next block, x, and return the filtered block (as float). The state at the start of the first block
+    is set as if the signal had been steady at its first value (this avoids a large start up transient)."""
+    x = pylab.asarray(x)
+    if self.zi is None:
+      zi = sosfilt_zi(self.sos)  # n_sections x 2
+      x0 = pylab.asarray(x[0], dtype=float)
+      self.zi = zi.reshape(zi.shape + (1,) * x0.ndim) * x0
+    y, self.zi = sosfilt(self.sos, x, axis=0, zi=self.zi)
+    return y
+
+  def stream(self, blocks):
+    """Generator that filters each block from the iterator blocks in turn."""
+    for x in blocks:
+      if len(x):
+        yield self.filter(x)
+
+
+def raw_blocks(finname, fmt, buffer_len=100000, max_len=-1):
+  """Generator that steps through a raw data file buffer_len samples at a time, using a memmap."""
   x = pylab.memmap(finname, dtype=fmt, mode='r')
   if max_len == -1:
     max_len = x.size
-  y = pylab.memmap(foutname, dtype=fmt, mode='w+', shape=max_len)
-
-  for buff_st_idx in xrange(0, max_len, buffer_len):
-    chk_st_idx = max(0, buff_st_idx - overlap_len)
-    buff_nd_idx = min(max_len, buff_st_idx + buffer_len)
-    chk_nd_idx = min(x.size, buff_nd_idx + overlap_len)
-    rel_st_idx = buff_st_idx - chk_st_idx
-    rel_nd_idx = buff_nd_idx - chk_st_idx
-    this_y_chk = filtfilt(b, a, x[chk_st_idx:chk_nd_idx])
-    y[buff_st_idx:buff_nd_idx] = this_y_chk[rel_st_idx:rel_nd_idx]
-
-  return y
\ No newline at end of file
+  for buff_st_idx in range(0, max_len, buffer_len):
+    yield x[buff_st_idx:min(max_len, buff_st_idx + buffer_len)]
+
+
+def filtlong(finname, foutname, fmt, fs, fl=5.0, fh=100.0, gpass=1.0, gstop=30.0, ftype='butter', buffer_len=100000,
+             max_len=-1, **kwargs):
+  """Causal counterpart of butterfilt. Reads each sample of finname once, with no overlap, and writes the filtered data
+  to foutname in the same format. Returns the StreamFilter, whose state can be used to carry on if more data arrives."""
+  sf = StreamFilter(fs, fl, fh, gpass, gstop, ftype)
+  with open(foutname, 'wb') as fout:
+    for y in sf.stream(raw_blocks(finname, fmt, buffer_len, max_len)):
+      y.astype(fmt).tofile(fout)
+  return sf
@@ -0,0 +1,103 @@
+"""Tests for neurapy.signal.continuous on synthetic raw files. Run with
+
+python -m pytest neurapy/tests
+"""
+import numpy
+import pytest
+from scipy.signal import butter, iirdesign, sosfilt, sosfilt_zi, sosfiltfilt, tf2sos
+
+pytest.importorskip('pylab')
+from neurapy.signal import continuous as cc
+
+N = 300000
+
+def make_raw(fname, n = N, seed = 0):
+  """A random walk plus noise, like an unfiltered trace, written as int32"""
+  rng = numpy.random.RandomState(seed)
+  x = (numpy.cumsum(rng.normal(0, 50, n)) + rng.normal(0, 1000, n)).astype('i')
+  x.tofile(fname)
+  return x
+
+def preset_sos(preset):
+  return cc.design_filter(preset['fs'], preset['fl'], preset['fh'],
+                          preset['gpass'], preset['gstop'])
+
+@pytest.mark.parametrize('preset', [cc.lynxlfp, cc.lynxspike])
+def test_sosfiltfiltlong_matches_whole_signal(tmpdir, preset):
+  """Chunking with the derived overlap gives the same result as one filtfilt
+  over the whole signal, up to integer rounding"""
+  x = make_raw(str(tmpdir.join('in.raw')))
+  sos = preset_sos(preset)
+  y = cc.sosfiltfiltlong(str(tmpdir.join('in.raw')), str(tmpdir.join('out.raw')), 'i',
+                         sos, buffer_len = 70000)
+  ref = sosfiltfilt(sos, x).astype('i')
+  assert y.size == x.size
+  assert numpy.abs(y - ref).max() <= 1
+
+def test_filtfiltlong_takes_b_a(tmpdir):
+  """The old positional signature (b, a, buffer_len, overlap_len, max_len). A
+  low order filter, as b, a are only usable for those"""
+  x = make_raw(str(tmpdir.join('in.raw')))
+  b, a = butter(3, [0.03, 0.3], 'band')
+  y = cc.filtfiltlong(str(tmpdir.join('in.raw')), str(tmpdir.join('out.raw')), 'i',
+                      b, a, 70000, 2000, 200000)
+  ref = sosfiltfilt(tf2sos(b, a), x)[:200000]
+  assert numpy.isfinite(ref).all()
+  assert y.size == 200000
+  assert numpy.abs(y - ref.astype('i')).max() <= 1
+
+def test_filtfiltmany_parallel_matches_serial(tmpdir):
+  sos = preset_sos(cc.lynxspike)
+  finnames = [str(tmpdir.join('in%d.raw' %(n))) for n in range(3)]
+  for n, fname in enumerate(finnames):
+    make_raw(fname, N // (n + 1), seed = n)
+  serial = cc.filtfiltmany(finnames, [fn + '.serial' for fn in finnames], 'i', sos,
+                           50000, processes = 1)
+  parallel = cc.filtfiltmany(finnames, [fn + '.parallel' for fn in finnames], 'i', sos,
+                             50000, processes = 2)
+  for a, b in zip(serial, parallel):
+    assert numpy.array_equal(a, b)
+
+def test_butterfilt(tmpdir):
+  """butterfilt returns the output and the (b, a) of the filter"""
+  x = make_raw(str(tmpdir.join('in.raw')))
+  y, b, a = cc.butterfilt(str(tmpdir.join('in.raw')), str(tmpdir.join('out.raw')),
+                          **dict(cc.lynxspike, max_len = 100000))
+  fso2 = cc.lynxspike['fs'] / 2.0
+  b0, a0 = iirdesign([500 / fso2, 8000 / fso2], [400 / fso2, 11200 / fso2],
+                     gpass = cc.lynxspike['gpass'], gstop = cc.lynxspike['gstop'],
+                     ftype = 'butter', output = 'ba')
+  assert numpy.allclose(b, b0) and numpy.allclose(a, a0)
+  assert y.size == 100000
+  assert numpy.array_equal(numpy.fromfile(str(tmpdir.join('out.raw')), dtype = 'i'), y)
+
+def test_impulse_len():
+  sos = preset_sos(cc.lynxlfp)
+  n = cc.impulse_len(sos, tol = 1e-6)
+  impulse = numpy.zeros(n + 1)
+  impulse[0] = 1
+  h = sosfilt(sos, impulse)
+  assert numpy.abs(h[-1]) < 1e-6 * numpy.abs(h).max()
+
+def stream_reference(sos, x):
+  """sosfilt over all of x, starting as if the signal had been steady at x[0]"""
+  zi = sosfilt_zi(sos)
+  zi = zi.reshape(zi.shape + (1,) * (x.ndim - 1)) * x[0]
+  return sosfilt(sos, x, axis = 0, zi = zi)[0]
+
+def test_stream_filter_matches_one_pass():
+  x = numpy.random.RandomState(1).normal(0, 100, (50000, 3))
+  sf = cc.StreamFilter(**cc.lynxspike)
+  bounds = [0, 1, 1000, 1000, 1017, 30000, 50000]  #Including an empty block
+  y = numpy.concatenate(list(sf.stream(x[a:b] for a, b in zip(bounds[:-1], bounds[1:]))))
+  assert numpy.allclose(y, stream_reference(sf.sos, x))
+
+  sf.reset()
+  assert numpy.allclose(sf.filter(x[:500, 0]), stream_reference(sf.sos, x[:500, 0]))
+
+def test_filtlong(tmpdir):
+  x = make_raw(str(tmpdir.join('in.raw')), 100000)
+  sf = cc.filtlong(str(tmpdir.join('in.raw')), str(tmpdir.join('out.raw')),
+                   **dict(cc.lynxspike, buffer_len = 7777))
+  y = numpy.fromfile(str(tmpdir.join('out.raw')), dtype = 'i')
+  assert numpy.array_equal(y, stream_reference(sf.sos, x.astype(float)).astype('i'))
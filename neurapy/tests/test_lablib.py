@@ -0,0 +1,265 @@
+"""Tests for neurapy.lablib.lablib on small synthetic data files. The sequential
+reader (read) is the reference the indexed, column and lazy readers are checked
+against. Run with
+
+python -m pytest neurapy/tests
+"""
+import struct
+import sys
+
+import numpy
+import pytest
+
+if sys.version_info[0] > 2:
+  pytest.skip('lablib is Python 2 code', allow_module_level = True)
+from neurapy.lablib import lablib
+
+def llstring(s):
+  return struct.pack('B', len(s)) + s.encode('ascii')
+
+def leaf(E, type_name, name, offset, elements, element_bytes):
+  return llstring(type_name) + llstring(name) + \
+         struct.pack(E + 'LlLL', offset, elements, element_bytes, 0)
+
+def struct_def(E, name, offset, children):
+  return llstring('struct') + llstring(name) + \
+         struct.pack(E + 'LlLL', offset, 1, 0, len(children)) + b''.join(children)
+
+def make_lldata(fname, E = '<', n_trials = 50, seed = 0):
+  """Write a lablib data file with byte order E. It has the timing events that
+  LLDataFileReader treats specially, variable length events, nested structs
+  (with padding) and strings, in a random mix in each trial, with junk events
+  between some of the trials"""
+  rng = numpy.random.RandomState(seed)
+  window = struct_def(E, 'windowDeg', 4, [
+    struct_def(E, 'origin', 0, [leaf(E, 'float', 'x', 0, 1, 4), leaf(E, 'float', 'y', 4, 1, 4)]),
+    struct_def(E, 'size', 8, [leaf(E, 'float', 'width', 0, 1, 4), leaf(E, 'float', 'height', 4, 1, 4)])])
+  events = [ #name, data bytes (-1 for variable length), definition
+    ('fileEnd', 0, leaf(E, 'no data', 'fileEnd', 0, 1, 0)),
+    ('text', -1, leaf(E, 'char', 'text', 0, -1, 1)),
+    ('trialStart', 4, leaf(E, 'long', 'trialStart', 0, 1, 4)),
+    ('trialEnd', 4, leaf(E, 'long', 'trialEnd', 0, 1, 4)),
+    ('sampleZero', 4, leaf(E, 'long', 'sampleZero', 0, 1, 4)),
+    ('spikeZero', 0, leaf(E, 'no data', 'spikeZero', 0, 1, 0)),
+    ('sample01', 4, leaf(E, 'short', 'sample01', 0, 2, 2)),
+    ('sample', 4, struct_def(E, 'sample', 0, [leaf(E, 'short', 'channel', 0, 1, 2),
+                                               leaf(E, 'short', 'data', 2, 1, 2)])),
+    ('spike', 6, struct_def(E, 'spike', 0, [leaf(E, 'short', 'channel', 0, 1, 2),
+                                             leaf(E, 'long', 'time', 2, 1, 4)])),
+    ('spike0', 4, leaf(E, 'long', 'spike0', 0, 1, 4)),
+    ('eyeXData', -1, leaf(E, 'short', 'eyeXData', 0, -1, 2)),
+    ('eyeYData', -1, leaf(E, 'short', 'eyeYData', 0, -1, 2)),
+    ('fixWindowData', 32, struct_def(E, 'fixWindowData', 0, [
+      leaf(E, 'long', 'index', 0, 1, 4), window, leaf(E, 'double', 'scale', 20, 1, 8),
+      leaf(E, 'char', 'tag', 28, 4, 1)])),
+    ('stimulus', 10, struct_def(E, 'stimulus', 0, [
+      leaf(E, 'unsigned short', 'a', 0, 3, 2), leaf(E, 'boolean', 'on', 6, 1, 1),
+      leaf(E, 'unsigned short', 'b', 8, 1, 2)])),
+    ('fixate', 0, leaf(E, 'no data', 'fixate', 0, 1, 0))]
+  codes = dict((name, n) for n, (name, data_bytes, definition) in enumerate(events))
+
+  out = [b'\x07\x03' + b'6.2' + struct.pack(E + 'l', len(events))]
+  for name, data_bytes, definition in events:
+    out.append(llstring(name) + struct.pack(E + 'l', data_bytes) + definition)
+  out.append(llstring('2009-01-01') + llstring('12:00'))
+  clock = [1000]
+  def emit(name, payload):
+    data = struct.pack(E + 'b', codes[name])
+    if events[codes[name]][1] < 0:
+      data += struct.pack(E + 'L', len(payload))
+    clock[0] += rng.randint(0, 5)
+    out.append(data + payload + struct.pack(E + 'L', clock[0]))
+
+  emit('text', b'hello world')
+  emit('stimulus', struct.pack(E + '3H?xH', 1, 2, 3, True, 9))
+  for trial in range(n_trials):
+    emit('trialStart', struct.pack(E + 'l', trial))
+    emit('sampleZero', struct.pack(E + 'l', 5))
+    emit('spikeZero', b'')
+    for k in range(rng.randint(1, 30)):
+      r = rng.randint(0, 7)
+      if r in (0, 1):
+        m = rng.randint(r, 20) #Allow empty eyeXData
+        emit(['eyeXData', 'eyeYData'][r], struct.pack(E + '%dh' %(m), *rng.randint(-999, 999, m)))
+      elif r == 2:
+        emit('sample', struct.pack(E + 'hh', rng.randint(0, 2), rng.randint(-9, 9)))
+      elif r == 3:
+        emit('spike', struct.pack(E + 'hl', 1, rng.randint(0, 1000)))
+      elif r == 4:
+        emit('fixWindowData', struct.pack(E + 'lffffd4s', trial, *(list(rng.normal(size = 4)) + [2.5, b'ab\0c'])))
+      elif r == 5:
+        emit('stimulus', struct.pack(E + '3H?xH', *(list(rng.randint(0, 60000, 3)) + [trial % 2 == 1, 7])))
+      else:
+        emit('sample01', struct.pack(E + 'hh', 1, 2))
+        emit('fixate', b'')
+        emit('spike0', struct.pack(E + 'l', 33))
+    emit('trialEnd', struct.pack(E + 'l', trial))
+    if trial % 7 == 0:
+      emit('text', b'between')
+  emit('fileEnd', b'')
+  f = open(fname, 'wb')
+  f.write(b''.join(out))
+  f.close()
+
+def as_read(column):
+  """Turn a column (see LLDataFileReader.event_column) back into the nested
+  lists read gives"""
+  offsets = column['Trial Offsets']
+  trials = list(zip(offsets[:-1], offsets[1:]))
+  def convert(node):
+    out = {}
+    for key, value in node.items():
+      if key == 'Trial Offsets':
+        continue
+      if key in ('Absolute Time', 'Trial Time'):
+        out[key] = [[int(t) for t in value[a:b]] for a, b in trials]
+      elif isinstance(value, dict) and 'Event Offsets' in value: #Variable length
+        values, event_offsets = value['Values'], value['Event Offsets']
+        if isinstance(values, list): #Strings
+          out[key] = [[[v] for v in values[a:b]] for a, b in trials]
+        else:
+          out[key] = [[values[event_offsets[e]:event_offsets[e+1]].tolist()
+                       for e in range(a, b)] for a, b in trials]
+      elif isinstance(value, dict):
+        out[key] = convert(value)
+      elif isinstance(value, list): #Variable length strings
+        out[key] = [value[a:b] for a, b in trials]
+      elif value.dtype.kind == 'S':
+        out[key] = [[[v] for v in value[a:b].tolist()] for a, b in trials]
+      else:
+        out[key] = [[list(row) for row in value[a:b].tolist()] for a, b in trials]
+    return out
+  return convert(column)
+
+@pytest.fixture(params = ['<', '>'])
+def lldata(request, tmpdir):
+  fname = str(tmpdir.join('data.dat'))
+  make_lldata(fname, request.param, n_trials = 120, seed = 3)
+  return fname, request.param
+
+@pytest.fixture
+def reference(lldata):
+  fname, endian = lldata
+  return lablib.LLDataFileReader(fname, endian = endian)
+
+def test_index_matches_sequential_reads(lldata):
+  """Every event in the index is where read_llevent_from_file finds it"""
+  fname, endian = lldata
+  R = lablib.LLDataFileReader()
+  index = R.read_index(fname, endian)
+  f = open(fname, 'rb')
+  lablib.readLLHeader(f, endian)
+  for n, entry in enumerate(index):
+    code = lablib.read_llevent_code_from_file(f, R.event_code_fmt)
+    assert code == entry['code']
+    if n % 2: #Alternate between reading and skipping
+      absolute_time, data = lablib.read_llevent_from_file(f, code, R.events_by_code, endian)
+      assert absolute_time == entry['time']
+      assert data == R.buffer[entry['offset']:entry['offset'] + entry['length']]
+    else:
+      lablib.skip_llevent_from_file(f, code, R.events_by_code, endian)
+  assert f.tell() == len(R.buffer)
+  f.close()
+  assert R.n_trials == 120
+
+def test_native_endian(tmpdir):
+  """With endian '' (native) the file is still read with the standard sizes of
+  the file (4 byte longs), whatever the native size"""
+  fname = str(tmpdir.join('data.dat'))
+  native = '<' if sys.byteorder == 'little' else '>'
+  make_lldata(fname, native, n_trials = 20)
+  R = lablib.LLDataFileReader()
+  index = R.read_index(fname, native)
+  f = open(fname, 'rb')
+  header, template = lablib.readLLHeader(f, '')
+  assert header['Events'] == R.data['Header']['Events']
+  index_native = lablib.index_llevents(R.buffer, f.tell(), R.events_by_code,
+                                       R.event_code_fmt, '', R.trialStart_code,
+                                       R.trialEnd_code)
+  for field in ['code', 'offset', 'length', 'time', 'trial']:
+    assert numpy.array_equal(index_native[field], index[field]), field
+  for entry in index:
+    code = lablib.read_llevent_code_from_file(f, R.event_code_fmt, '')
+    absolute_time, data = lablib.read_llevent_from_file(f, code, R.events_by_code, '')
+    assert absolute_time == entry['time']
+    assert data == R.buffer[entry['offset']:entry['offset'] + entry['length']]
+  assert f.tell() == len(R.buffer)
+  f.close()
+
+  reference = lablib.LLDataFileReader(fname, endian = native)
+  assert lablib.LLDataFileReader(fname, endian = '').data == reference.data
+  columns = lablib.LLDataFileReader().read_columns(fname, '')
+  for event_name, column in columns.items():
+    assert as_read(column) == reference.data['Trials'][event_name], event_name
+
+def test_columns_match_read(lldata, reference):
+  fname, endian = lldata
+  R = lablib.LLDataFileReader()
+  for section in ['Trials', 'Experiment Header']:
+    columns = R.read_columns(fname, endian, section = section)
+    assert sorted(columns.keys()) == sorted(reference.data[section].keys())
+    for event_name, column in columns.items():
+      assert as_read(column) == reference.data[section][event_name], (section, event_name)
+
+def test_lazy_matches_read(lldata, reference):
+  fname, endian = lldata
+  R = lablib.LLDataFileReader(fname, endian = endian, lazy = True, max_decoded = 3)
+  for section in ['Trials', 'Experiment Header']:
+    events = R.data[section]
+    assert sorted(events.keys()) == sorted(reference.data[section].keys())
+    for key in reference.data[section].keys():
+      assert events.has_key(key)
+      assert events[key] == reference.data[section][key], (section, key)
+    assert len(events.decoded) == 3
+    assert dict(events.items()) == reference.data[section]
+    assert events.to_dict() == reference.data[section]
+  assert not R.data['Trials'].has_key('no such event')
+  assert R.data['Trials'].get('no such event', 1) == 1
+
+def same(a, b):
+  """Nested dictionaries of arrays and lists are equal, including dtypes"""
+  if isinstance(a, dict):
+    return sorted(a.keys()) == sorted(b.keys()) and all(same(a[k], b[k]) for k in a)
+  if isinstance(a, list):
+    return a == b
+  return numpy.array_equal(a, b) and numpy.asarray(a).dtype == numpy.asarray(b).dtype
+
+def test_cache_round_trip(lldata):
+  fname, endian = lldata
+  columns = lablib.LLDataFileReader().read_columns(fname, endian)
+  R = lablib.cache(fname, ignore_eye_data = False, endian = endian)
+  assert R.n_trials == 120
+  assert same(R.data['Trials'], columns)
+
+  cache_dir = lablib.cache_name(fname, ignore_eye_data = False)
+  assert lablib.cache_is_current(fname, cache_dir, endian)
+  other = '>' if endian == '<' else '<'
+  assert not lablib.cache_is_current(fname, cache_dir, other)
+  assert not lablib.is_up_to_date(fname, {}, False, 'cache', other)
+
+def test_is_up_to_date(tmpdir):
+  fname = str(tmpdir.join('data.dat'))
+  make_lldata(fname, n_trials = 5)
+  foutname = lablib.output_name(fname)
+  assert not lablib.is_up_to_date(fname, {})
+  open(foutname, 'wb').close()
+  assert not lablib.is_up_to_date(fname, {}) #No manifest entry, even though the output is newer
+
+  key = lablib.manifest_key(fname)
+  assert key['decoder version'] == lablib.decoder_version
+  manifest = {'data.pkl': dict(key, seconds = 1.0)}
+  assert lablib.is_up_to_date(fname, manifest)
+  manifest['data.pkl']['decoder version'] = lablib.decoder_version - 1
+  assert not lablib.is_up_to_date(fname, manifest)
+  manifest = {'data.pkl': dict(key, size = key['size'] + 1)}
+  assert not lablib.is_up_to_date(fname, manifest)
+
+def test_pickle_all_cache(tmpdir):
+  dirname = str(tmpdir)
+  for n in range(3):
+    make_lldata(str(tmpdir.join('s%d.dat' %(n))), n_trials = 10 + 20 * n, seed = n)
+  results = lablib.pickle_all(dirname, format = 'cache', endian = '<', processes = 2)
+  assert sorted(r[0] for r in results) == sorted(str(tmpdir.join('s%d.dat' %(n))) for n in range(3))
+  assert all(error is None for fname, seconds, error in results)
+  assert sorted(lablib.load_manifest(dirname).keys()) == ['s0.llc', 's1.llc', 's2.llc']
+  assert lablib.pickle_all(dirname, format = 'cache', endian = '<', processes = 2) == []
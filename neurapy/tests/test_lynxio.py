@@ -0,0 +1,268 @@
+"""Round trip tests for neurapy.neuralynx.lynxio on small synthetic files. Run with
+
+python -m pytest neurapy/tests
+"""
+import numpy as np
+import pytest
+
+from neurapy.neuralynx import lynxio
+
+CHANNELS = 8
+PACKET_SIZE = lynxio.make_nrd_packet(CHANNELS).itemsize
+
+
+def make_nrd_packets(n=20000, channels=CHANNELS, seed=0):
+    """n good packets with steadily increasing timestamps (crossing into the high word) and random data."""
+    packets = np.zeros(n, dtype=lynxio.make_nrd_packet(channels))
+    packets['stx'] = 2048
+    packets['pkt_id'] = 1
+    packets['pkt_data_size'] = 10 + channels
+    ts = np.arange(n, dtype='uint64') * 31 + (1 << 32) - 1000
+    packets['timestamp high'] = ts >> 32
+    packets['timestamp low'] = ts & 0xffffffff
+    packets['ttl'] = np.arange(n) % 7
+    packets['data'] = np.random.default_rng(seed).integers(-30000, 30000, (n, channels))
+    words = packets.view('I').reshape(n, packets.dtype.itemsize // 4)
+    words[:, -1] = np.bitwise_xor.reduce(words[:, :-1], axis=1)  # The crc
+    return packets, ts
+
+
+def corrupted(packets, garbage=b'', corrupt=()):
+    """The packets as bytes, after garbage, with the bytes at the offsets in corrupt (counted from the first packet)
+    flipped."""
+    raw = bytearray(packets.tobytes())
+    for c in corrupt:
+        raw[c] ^= 0xff
+    return garbage + bytes(raw)
+
+
+def make_nrd(fname, n=20000, garbage=b'', corrupt=()):
+    """Write a synthetic .nrd file. Returns the packets and their timestamps."""
+    packets, ts = make_nrd_packets(n)
+    with open(fname, 'wb') as f:
+        f.write('######## Neuralynx\n-NumADChannels {:d}\n'.format(CHANNELS).encode().ljust(16 * 1024, b'\0'))
+        f.write(corrupted(packets, garbage, corrupt))
+    return packets, ts
+
+
+def extract(extractor, tmp_path, fname, channel_list, **kwargs):
+    """Run one of the extractors and read back what it wrote."""
+    fchanname = [str(tmp_path / 'chan_{:03d}.raw'.format(ch)) for ch in channel_list]
+    extractor(fname, str(tmp_path / 'timestamps.raw'), str(tmp_path / 'ttl.raw'), fchanname, channel_list,
+              channels=CHANNELS, **kwargs)
+    return (np.fromfile(str(tmp_path / 'timestamps.raw'), dtype='Q'), np.fromfile(str(tmp_path / 'ttl.raw'), dtype='I'),
+            [np.fromfile(fcn, dtype='i') for fcn in fchanname])
+
+
+class RunningSum:
+    """A trivial stateful channel_filter."""
+
+    def __init__(self):
+        self.total = 0
+
+    def filter(self, x):
+        y = np.cumsum(x, axis=0, dtype='int64') + self.total
+        self.total = y[-1]
+        return y
+
+
+@pytest.mark.parametrize('extractor', [lynxio.extract_nrd_fast, lynxio.extract_nrd_ec, lynxio.extract_nrd_parallel])
+def test_extract_clean_file(tmp_path, extractor):
+    fname = str(tmp_path / 'clean.nrd')
+    packets, ts = make_nrd(fname)
+    kwargs = {'processes': 2, 'buffer_size': 3000} if extractor is lynxio.extract_nrd_parallel else {'buffer_size': 777}
+    t, ttl, chans = extract(extractor, tmp_path, fname, [0, 5], **kwargs)
+    assert np.array_equal(t, ts)
+    assert np.array_equal(ttl, packets['ttl'])
+    assert np.array_equal(chans[0], packets['data'][:, 0])
+    assert np.array_equal(chans[1], packets['data'][:, 5])
+
+
+def test_extract_ec_skips_garbage_and_bad_packets(tmp_path):
+    fname = str(tmp_path / 'bad.nrd')
+    garbage = b'\x07' * 6
+    packets, ts = make_nrd(fname, garbage=garbage,
+                           corrupt=[len(garbage) + PACKET_SIZE * 10 + 50, len(garbage) + PACKET_SIZE * 9000 + 8])
+    t, ttl, chans = extract(lynxio.extract_nrd_ec, tmp_path, fname, [3], buffer_size=777)
+    keep = np.ones(ts.size, dtype=bool)
+    keep[[10, 9000]] = False
+    assert np.array_equal(t, ts[keep])
+    assert np.array_equal(ttl, packets['ttl'][keep])
+    assert np.array_equal(chans[0], packets['data'][keep, 3])
+
+
+def test_extract_parallel_drops_bad_packets(tmp_path):
+    fname = str(tmp_path / 'bad.nrd')
+    packets, ts = make_nrd(fname, corrupt=[PACKET_SIZE * 10 + 50, PACKET_SIZE * 9000 + 8])
+    t, ttl, chans = extract(lynxio.extract_nrd_parallel, tmp_path, fname, [3], processes=3, buffer_size=2000)
+    keep = np.ones(ts.size, dtype=bool)
+    keep[[10, 9000]] = False
+    assert np.array_equal(t, ts[keep])
+    assert np.array_equal(chans[0], packets['data'][keep, 3])
+
+
+def test_extract_parallel_empty_file(tmp_path):
+    fname = str(tmp_path / 'empty.nrd')
+    make_nrd(fname, n=0)
+    t, ttl, chans = extract(lynxio.extract_nrd_parallel, tmp_path, fname, [0, 1])
+    assert t.size == 0 and ttl.size == 0 and all(c.size == 0 for c in chans)
+
+
+@pytest.mark.parametrize('extractor', [lynxio.extract_nrd_fast, lynxio.extract_nrd_ec])
+def test_extract_with_channel_filter(tmp_path, extractor):
+    fname = str(tmp_path / 'clean.nrd')
+    packets, ts = make_nrd(fname)
+    t, ttl, chans = extract(extractor, tmp_path, fname, [1, 6], buffer_size=777, channel_filter=RunningSum())
+    for ch, y in zip([1, 6], chans):
+        assert np.array_equal(y, np.cumsum(packets['data'][:, ch], dtype='int64').astype('i'))
+
+
+def test_scan_nrd_buffer():
+    packets, ts = make_nrd_packets(500)
+    garbage = b'\x00\x08\x00\x00junk'  # Starts with an stx
+    buf = corrupted(packets, garbage, corrupt=[PACKET_SIZE * 100 + 40])
+    good, consumed, bad_ranges = lynxio.scan_nrd_buffer(buf, CHANNELS, base_offset=1000, eof=True)
+    keep = np.arange(500) != 100
+    assert good.tobytes() == packets[keep].tobytes()
+    assert consumed == len(buf)
+    assert [(e['start'], e['stop'], e['reason']) for e in bad_ranges] == [
+        (1000, 1000 + len(garbage), 'pkt_id'),
+        (1000 + len(garbage) + 100 * PACKET_SIZE, 1000 + len(garbage) + 101 * PACKET_SIZE, 'crc')]
+
+
+def test_scan_nrd_buffer_carries_partial_packet():
+    packets, ts = make_nrd_packets(50)
+    buf = packets.tobytes()
+    good, consumed, bad_ranges = lynxio.scan_nrd_buffer(buf[:-30], CHANNELS)
+    assert good.size == 49 and consumed == 49 * PACKET_SIZE and bad_ranges == []
+    good, consumed, bad_ranges = lynxio.scan_nrd_buffer(buf[consumed:], CHANNELS, last_ts=ts[48], eof=True)
+    assert good.tobytes() == packets[49:].tobytes() and bad_ranges == []
+
+
+def test_scan_nrd_buffer_out_of_order_timestamp():
+    packets, ts = make_nrd_packets(20)
+    good, consumed, bad_ranges = lynxio.scan_nrd_buffer(packets.tobytes(), CHANNELS, last_ts=ts[5], eof=True)
+    assert good.tobytes() == packets[5:].tobytes()
+    assert [e['reason'] for e in bad_ranges] == ['ts'] * 5
+
+
+def test_nrd_file_slice(tmp_path):
+    fname = str(tmp_path / 'clean.nrd')
+    packets, ts = make_nrd(fname)
+    nrd = lynxio.NrdFile(fname, index_stride=100)
+    assert len(nrd) == ts.size
+    t, data = nrd.slice(ts[1234], ts[5678], channels=[2, 7])  # Both ends included
+    assert np.array_equal(t, ts[1234:5679])
+    assert np.array_equal(data, packets['data'][1234:5679][:, [2, 7]])
+    t, data = nrd.slice(ts[1234] + 1, -1, channels=3)
+    assert np.array_equal(t, ts[1235:])
+    assert np.array_equal(data, packets['data'][1235:, 3])
+
+
+def test_nrd2mda_epochs(tmp_path):
+    fname = str(tmp_path / 'clean.nrd')
+    packets, ts = make_nrd(fname)
+    defaults = tmp_path / 'Defaults'
+    defaults.write_text('junk\n"Epoch","a: {:d} {:d}"\n"Epoch","b: {:d} {:d}"\n'.format(
+        int(ts[100]), int(ts[12000]), int(ts[9000]) + 3, int(ts[-1]) + 100))
+    channel_dict = {1: [0, 1, 2, 3], 2: [7, 3]}
+    prefix = str(tmp_path / 'out_')
+    assert lynxio.nrd2mda_epochs(fname, str(defaults), prefix, channel_dict, ['a', 'b'], buffer_size=700) == 0
+    for epoch, (a, b) in {'a': (100, 12001), 'b': (9001, ts.size)}.items():
+        for nt, ch in channel_dict.items():
+            mda = np.fromfile('{:s}{:s}.nt{:d}.mda'.format(prefix, epoch, nt), dtype='i')
+            assert mda[4] == b - a
+            assert np.array_equal(mda[5:].reshape(-1, len(ch)), packets['data'][a:b][:, ch])
+
+
+def make_ncs(fname, n=200, Fs=32000, gaps=(), seed=0):
+    """Write a synthetic continuous record file of n packets with a pause in the recording of the given number of
+    microseconds before each of the packets in gaps ({packet: us})."""
+    packets = np.zeros(n, dtype=lynxio.csc_packet)
+    step_us = 512 / Fs * 1e6
+    packets['timestamp'] = np.round(np.arange(n) * step_us + 123456789).astype('Q')
+    for k, us in dict(gaps).items():
+        packets['timestamp'][k:] += us
+    packets['Fs'] = Fs
+    packets['Ns'] = 512
+    packets['samp'] = np.random.default_rng(seed).integers(-2000, 2000, (n, 512))
+    with open(fname, 'wb') as f:
+        f.write(b'######## Neuralynx'.ljust(16 * 1024, b'\0'))
+        packets.tofile(f)
+    return packets
+
+
+@pytest.mark.parametrize('gaps', [{}, {50: 100000}, {3: 5000, 120: 250000}])
+def test_csc_trace_matches_read_csc(tmp_path, gaps):
+    fname = str(tmp_path / 'CSC1.ncs')
+    make_ncs(fname, gaps=gaps)
+    with open(fname, 'rb') as f:
+        ref = lynxio.read_csc(f)
+    trace = lynxio.CscTrace(fname)
+    assert len(trace) == ref['trace'].size
+    assert (len(trace) > 512 * 200) == bool(gaps)  # Padded
+    assert trace.Fs == pytest.approx(ref['Fs'])
+    assert trace.t0 == ref['t0']
+    assert np.array_equal(trace[:], ref['trace'])
+    for a, b in [(0, 1), (500, 3000), (25000, 26000), (len(trace) - 700, len(trace)), (100, 100)]:
+        assert np.array_equal(trace[a:b], ref['trace'][a:b])
+    assert np.array_equal(trace[10:5000:7], ref['trace'][10:5000:7])
+    assert trace[-1] == ref['trace'][-1]
+    with pytest.raises(IndexError):
+        trace[len(trace)]
+
+
+def make_extracted(tmp_path, n=50000, gaps=(20000, 41000), seed=0):
+    """Timestamp, ttl and channel files like those written by the extractors, sampled at about 32 kHz with a pause
+    before each of the samples in gaps."""
+    ts = np.arange(n, dtype='Q') * 31 + 1000
+    for g in gaps:
+        ts[g:] += 1000000
+    ttl = (np.arange(n) % 5).astype('I')
+    x = np.random.default_rng(seed).integers(-1000, 1000, n).astype('i')
+    names = [str(tmp_path / fn) for fn in ['timestamps.raw', 'ttl.raw', 'chan_000.raw']]
+    for a, fn in zip([ts, ttl, x], names):
+        a.tofile(fn)
+    return ts, x, names
+
+
+def test_raw_index(tmp_path):
+    ts, x, (ftsname, fttlname, fchanname) = make_extracted(tmp_path)
+    index = lynxio.build_raw_index(ftsname, block_size=1000, chunk_size=7000)
+    assert index['n_samples'] == ts.size
+    assert np.array_equal(index['gap_idx'], [20000, 41000])
+    assert np.allclose(index['section_Fs'], 1e6 / 31)
+    assert np.array_equal(index['block_min'], ts[::1000])
+    assert np.array_equal(index['block_max'], ts[999::1000])
+
+    loaded = lynxio.load_raw_index(ftsname)  # From the sidecar
+    assert loaded['block_size'] == 1000
+    assert all(np.array_equal(loaded[k], index[k]) for k in index)
+
+    with open(ftsname, 'ab') as f:  # The recording grew, so the index is stale
+        (ts[-1] + 31 * np.arange(1, 11, dtype='Q')).tofile(f)
+    assert lynxio.load_raw_index(ftsname)['n_samples'] == ts.size + 10
+
+
+def test_raw_index_read_only(tmp_path, monkeypatch):
+    ts, x, (ftsname, fttlname, fchanname) = make_extracted(tmp_path)
+
+    def read_only(*args, **kwargs):
+        raise PermissionError(13, 'Read-only file system')
+    monkeypatch.setattr(lynxio.np, 'savez', read_only)
+    index = lynxio.load_raw_index(ftsname)
+    assert index['n_samples'] == ts.size
+    assert not (tmp_path / 'timestamps.raw.idx.npz').exists()
+
+
+def test_raw_session(tmp_path):
+    ts, x, names = make_extracted(tmp_path)
+    session = lynxio.RawSession(*names[:2], fchanname=names[2:])
+    assert np.array_equal(session.gaps, [20000, 41000])
+    assert session.Fs == pytest.approx(1e6 / 31)
+    t = np.array([0, ts[0], ts[0] + 1, ts[19999] + 5, ts[20000], ts[-1], ts[-1] + 1, ts[12345]])
+    for side in ['left', 'right']:
+        assert np.array_equal(session.time_to_sample(t, side), np.searchsorted(ts, t, side))
+    assert session.time_to_sample(ts[777]) == 777
+    w = session.window(ts[19000], ts[21000])
+    assert np.array_equal(session.channels[0][w], x[19000:21001])
@@ -0,0 +1,243 @@
+"""Round trip tests for neurapy.cerebus.nev on small synthetic files. Run with
+
+python -m pytest neurapy/tests
+"""
+import os
+import struct
+import sys
+
+import numpy
+import pytest
+
+from neurapy.cerebus import nev
+
+FS = 30000
+N_SAMPLES = 48
+BYTES_IN_DATA_PACKETS = 8 + 2 * N_SAMPLES
+CHANNELS = 8
+SORTED_UNITS = 3
+NV_PER_LSB = 250
+
+#read_basic_header and read_extended_header parse the header as str
+py2_only = pytest.mark.skipif(sys.version_info[0] > 2,
+                              reason = 'nev header parsing is Python 2 code')
+
+def make_packets(n = 20000, seed = 0):
+  """Packets in time order from channels 0 (non neural) to CHANNELS + 1, with
+  units 0 to SORTED_UNITS"""
+  dtype = numpy.dtype([('timestamp', '<u4'), ('packet id', '<u2'), ('unit', 'u1'),
+                       ('reserved', 'u1'), ('waveform', '<i2', (N_SAMPLES,))])
+  rng = numpy.random.RandomState(seed)
+  packets = numpy.zeros(n, dtype = dtype)
+  packets['timestamp'] = numpy.sort(rng.randint(0, FS * 600, n))
+  packets['packet id'] = rng.randint(0, CHANNELS + 2, n)
+  packets['unit'] = rng.randint(0, SORTED_UNITS + 1, n)
+  packets['unit'][packets['packet id'] == 0] = 0
+  packets['waveform'] = rng.randint(-500, 500, packets['waveform'].shape)
+  return packets
+
+def make_nev(fname, packets, widths = None):
+  """Write a nev file (spec 2.1) holding packets. widths gives the bytes per
+  waveform sample of each channel (2 if not given); the file is flagged as 16
+  bit if they are all 2. Returns the basic and extended headers, as 
+  read_basic_header and read_extended_header would return them"""
+  n_extended = CHANNELS + 1
+  widths = dict((channel, (widths or {}).get(channel, 2)) for channel in range(1, n_extended + 1))
+  is_16bit = set(widths.values()) == set([2])
+  bytes_in_headers = 336 + 32 * n_extended
+  f = open(fname, 'wb')
+  f.write(b'NEURALEV' + b'\x02\x01' + struct.pack('<H', int(is_16bit)))
+  f.write(struct.pack('<IIII', bytes_in_headers, BYTES_IN_DATA_PACKETS, FS, FS))
+  f.write(struct.pack('<8H', 2009, 3, 2, 1, 0, 0, 0, 0))
+  f.write(b'test'.ljust(32, b'\0') + b''.ljust(256, b'\0'))
+  f.write(struct.pack('<I', n_extended))
+  for channel in range(1, n_extended + 1):
+    payload = struct.pack('<HBBHHhhBB', channel, 1, channel, NV_PER_LSB, 0, 100,
+                          -100, SORTED_UNITS, widths[channel])
+    f.write(b'NEUEVWAV' + payload.ljust(24, b'\0'))
+  packets.tofile(f)
+  f.close()
+
+  basic_header = {'bytes in headers': bytes_in_headers,
+                  'bytes in data packets': BYTES_IN_DATA_PACKETS,
+                  'time stamp resolution Hz': FS,
+                  'spike waveform is 16bit': is_16bit,
+                  'number of extended headers': n_extended,
+                  'file size': bytes_in_headers + packets.nbytes,
+                  'total packets': packets.size}
+  extended_header = {'neural event waveform': dict(
+    (channel, {'nV per LSB': NV_PER_LSB, 'number of sorted units': SORTED_UNITS,
+               'bytes per waveform sample': widths[channel]})
+    for channel in range(1, n_extended + 1))}
+  return basic_header, extended_header
+
+def expected_spikes(packets, channel, unit, tstart_ms, tdur_ms, width = 2):
+  """Brute force version of read_frag_unit. width is the bytes per waveform
+  sample of the channel"""
+  sel = (packets['packet id'] == channel) & (packets['unit'] == unit)
+  ts = packets['timestamp'].astype('int64')
+  sel &= ts >= numpy.ceil(tstart_ms * FS / 1000.0)
+  if tdur_ms >= 0:
+    sel &= ts < numpy.ceil((tstart_ms + tdur_ms) * FS / 1000.0)
+  waveforms = packets['waveform'][sel]
+  if width == 1:
+    waveforms = waveforms.view('i1')
+  return ((packets['timestamp'][sel] * (1000.0 / FS)).astype('float32'),
+          (waveforms * (NV_PER_LSB * 1e-3)).astype('float32'))
+
+windows = [(0.0, -1), (12345.0, 50000.0), (0.0, 10.0), (599000.0, 5000.0),
+           (700000.0, 10.0)]
+
+@pytest.fixture
+def nev_file(tmpdir):
+  packets = make_packets()
+  fname = str(tmpdir.join('data.nev'))
+  basic_header, extended_header = make_nev(fname, packets)
+  return fname, packets, basic_header, extended_header
+
+def fragment(fname, basic_header, extended_header, frag_dir,
+             ignore_spike_sorting):
+  f = open(fname, 'rb')
+  ok = nev.fragment(f, basic_header, extended_header, frag_dir = frag_dir,
+                    channel_list = numpy.arange(1, CHANNELS + 1),
+                    ignore_spike_sorting = ignore_spike_sorting,
+                    block_packets = 777)
+  f.close()
+  return ok
+
+@pytest.mark.parametrize('ignore_spike_sorting', [True, False])
+def test_fragment_is_byte_identical(tmpdir, nev_file, ignore_spike_sorting):
+  """Each file holds the packets of its unit exactly as they are in the nev
+  file, in the same order"""
+  fname, packets, basic_header, extended_header = nev_file
+  frag_dir = str(tmpdir.join('frag'))
+  assert fragment(fname, basic_header, extended_header, frag_dir,
+                  ignore_spike_sorting)
+
+  pid = packets['packet id']
+  expected = {'nonneural.bin': packets[pid == 0]}
+  for channel in range(1, CHANNELS + 1):
+    if ignore_spike_sorting:
+      expected['channel%02dunit00.bin' %(channel)] = packets[pid == channel]
+    else:
+      for unit in range(SORTED_UNITS + 1):
+        expected['channel%02dunit%02d.bin' %(channel, unit)] = \
+          packets[(pid == channel) & (packets['unit'] == unit)]
+  assert sorted(os.listdir(frag_dir)) == sorted(expected.keys())
+  for name, these_packets in expected.items():
+    f = open(os.path.join(frag_dir, name), 'rb')
+    assert f.read() == these_packets.tobytes(), name
+    f.close()
+
+def test_read_frag_unit(tmpdir, nev_file):
+  fname, packets, basic_header, extended_header = nev_file
+  frag_dir = str(tmpdir.join('frag'))
+  fragment(fname, basic_header, extended_header, frag_dir, False)
+
+  assert nev.list_frag_units(frag_dir) == [(channel, unit)
+    for channel in range(1, CHANNELS + 1) for unit in range(SORTED_UNITS + 1)]
+  for channel, unit in [(1, 0), (3, 2), (CHANNELS, SORTED_UNITS)]:
+    for tstart_ms, tdur_ms in windows:
+      data, ok = nev.read_frag_unit(frag_dir, basic_header, extended_header,
+                                    channel, unit, tstart_ms, tdur_ms,
+                                    load_waveform = True)
+      spike_time_ms, waveform_mV = expected_spikes(packets, channel, unit,
+                                                   tstart_ms, tdur_ms)
+      assert ok
+      assert numpy.array_equal(data['spike time ms'], spike_time_ms)
+      assert numpy.array_equal(data['waveform mV'], waveform_mV)
+
+def test_read_frag_unit_mixed_widths(tmpdir):
+  """With 1 and 2 byte electrodes in one file the 2 byte ones still come back
+  as int16 samples"""
+  packets = make_packets()
+  fname = str(tmpdir.join('data.nev'))
+  widths = dict((channel, 1 + channel % 2) for channel in range(1, CHANNELS + 2))
+  basic_header, extended_header = make_nev(fname, packets, widths)
+  assert nev.packet_dtype(basic_header, extended_header)['waveform'].base == numpy.uint8
+  frag_dir = str(tmpdir.join('frag'))
+  fragment(fname, basic_header, extended_header, frag_dir, False)
+  for channel, unit in [(1, 0), (3, 2)]:
+    for tstart_ms, tdur_ms in windows:
+      data, ok = nev.read_frag_unit(frag_dir, basic_header, extended_header,
+                                    channel, unit, tstart_ms, tdur_ms,
+                                    load_waveform = True)
+      spike_time_ms, waveform_mV = expected_spikes(packets, channel, unit,
+                                                   tstart_ms, tdur_ms)
+      assert data['waveform mV'].shape == (spike_time_ms.size, N_SAMPLES)
+      assert numpy.array_equal(data['waveform mV'], waveform_mV)
+
+@py2_only
+def test_nev_file(nev_file):
+  fname, packets, basic_header, extended_header = nev_file
+  nf = nev.NevFile(fname)
+  assert len(nf) == packets.size
+  assert numpy.array_equal(nf.timestamps, packets['timestamp'])
+  assert numpy.array_equal(nf.packet_ids, packets['packet id'])
+  assert numpy.array_equal(nf.units, packets['unit'])
+  assert numpy.array_equal(nf.waveforms, packets['waveform'])
+
+@py2_only
+@pytest.mark.parametrize('ignore_spike_sorting', [True, False])
+def test_spike_store_matches_fragments(tmpdir, nev_file, ignore_spike_sorting):
+  fname, packets, basic_header, extended_header = nev_file
+  frag_dir = str(tmpdir.join('frag'))
+  store = str(tmpdir.join('data.spk'))
+  fragment(fname, basic_header, extended_header, frag_dir, ignore_spike_sorting)
+  nev.build_spike_store(fname, store, ignore_spike_sorting = ignore_spike_sorting,
+                        block_spikes = 1000)
+
+  #The store has every channel, the fragments just the ones in channel_list
+  assert [(channel, unit) for channel, unit in nev.list_frag_units(store)
+          if channel <= CHANNELS] == nev.list_frag_units(frag_dir)
+  for channel, unit in nev.list_frag_units(frag_dir):
+    for tstart_ms, tdur_ms in windows:
+      from_frag, ok = nev.read_frag_unit(frag_dir, basic_header, extended_header,
+                                         channel, unit, tstart_ms, tdur_ms,
+                                         load_waveform = True)
+      from_store, ok = nev.read_frag_unit(store, basic_header, extended_header,
+                                          channel, unit, tstart_ms, tdur_ms,
+                                          load_waveform = True)
+      assert numpy.array_equal(from_store['spike time ms'], from_frag['spike time ms'])
+      assert numpy.array_equal(from_store['waveform mV'], from_frag['waveform mV'])
+
+@py2_only
+def test_spike_store_mixed_widths(tmpdir):
+  """Each electrode's waveforms are decoded with its own sample width"""
+  packets = make_packets()
+  fname = str(tmpdir.join('data.nev'))
+  widths = dict((channel, 1 + channel % 2) for channel in range(1, CHANNELS + 2))
+  make_nev(fname, packets, widths)
+  store = str(tmpdir.join('data.spk'))
+  nev.build_spike_store(fname, store, ignore_spike_sorting = False)
+  spike_store = nev.SpikeStore(store)
+  for channel, unit in [(1, 0), (2, 1), (3, 2), (CHANNELS, SORTED_UNITS)]:
+    for tstart_ms, tdur_ms in windows:
+      data = spike_store.read_unit(channel, unit, tstart_ms, tdur_ms, load_waveform = True)
+      spike_time_ms, waveform_mV = expected_spikes(packets, channel, unit, tstart_ms,
+                                                   tdur_ms, widths[channel])
+      assert numpy.array_equal(data['spike time ms'], spike_time_ms)
+      assert numpy.array_equal(data['waveform mV'], waveform_mV)
+
+@py2_only
+def test_spike_store_missing_unit(tmpdir, nev_file):
+  fname, packets, basic_header, extended_header = nev_file
+  store = str(tmpdir.join('data.spk'))
+  nev.build_spike_store(fname, store)
+  data = nev.SpikeStore(store).read_unit(CHANNELS + 5, 0, 0.0, -1,
+                                         load_waveform = True)
+  assert data['spike time ms'].size == 0
+  assert data['waveform mV'].shape == (0, N_SAMPLES)
+  assert data['waveform mV'].dtype == numpy.float32
+
+@py2_only
+def test_open_spike_store_reuses_store(tmpdir, nev_file):
+  fname, packets, basic_header, extended_header = nev_file
+  store = str(tmpdir.join('data.spk'))
+  nev.build_spike_store(fname, store)
+  spike_store = nev.open_spike_store(store)
+  assert nev.open_spike_store(store) is spike_store
+  nev.build_spike_store(fname, store, ignore_spike_sorting = False)
+  os.utime(store, (1, 1)) #In case the rewrite lands in the same mtime tick
+  assert nev.open_spike_store(store) is not spike_store
+  assert len(nev.open_spike_store(store).units()) > len(spike_store.units())
@@ -0,0 +1,68 @@
+"""Tests for neurapy.cerebus.nsx on small synthetic files. The sample by sample
+reader (read_channel) is the reference. Run with
+
+python -m pytest neurapy/tests
+"""
+import struct
+import sys
+
+import numpy
+import pytest
+
+if sys.version_info[0] > 2:
+  pytest.skip('nsx is Python 2 code', allow_module_level = True)
+from neurapy.cerebus import nsx
+
+PERIOD = 15 #2 kHz
+CHANNELS = 5
+SAMPLES = 20000
+
+def make_nsx(fname, seed = 0):
+  """Write a NSx 2.1 file of random samples. Returns the samples x channels
+  array"""
+  rng = numpy.random.RandomState(seed)
+  x = rng.randint(-3000, 3000, (SAMPLES, CHANNELS)).astype('<i2')
+  f = open(fname, 'wb')
+  f.write(b'NEURALSG' + b'test'.ljust(16, b'\0'))
+  f.write(struct.pack('<II', PERIOD, CHANNELS))
+  f.write(struct.pack('<%dI' %(CHANNELS), *range(1, CHANNELS + 1)))
+  x.tofile(f)
+  f.close()
+  return x
+
+@pytest.fixture
+def nsx_file(tmpdir):
+  fname = str(tmpdir.join('data.ns3'))
+  x = make_nsx(fname)
+  return fname, x
+
+#Event times (ms) and the window around them. The last two run off the end of
+#the file, the first two start before it
+t_ms = numpy.array([10.0, 40.0, 1000.0, 2500.0, 9000.0, 9960.0, 9999.0])
+tpre_ms, tdur_ms = 50.0, 100.0
+
+def test_epochs_match_read_channel(nsx_file):
+  fname, x = nsx_file
+  f = open(fname, 'rb')
+  basic_header = nsx.read_basic_header(f)
+  channel_list = [2, 5]
+  epochs, valid = nsx.read_epochs(f, basic_header, t_ms, tpre_ms, tdur_ms, channel_list)
+  assert epochs.shape == (t_ms.size, len(channel_list), 200)
+  assert valid.tolist() == [False, False, True, True, True, True, True]
+  for n in numpy.flatnonzero(valid):
+    for m, channel in enumerate(channel_list):
+      lfp = nsx.read_channel(f, basic_header, channel, t_ms[n] - tpre_ms, tdur_ms)
+      assert numpy.array_equal(epochs[n, m], lfp), (n, channel)
+  assert (epochs[~valid] == 0).all()
+  f.close()
+
+  nf = nsx.NsxFile(fname)
+  assert numpy.array_equal(nf.epochs(t_ms, tpre_ms, tdur_ms, channel_list), epochs)
+
+def test_epochs_truncated_at_end(nsx_file):
+  """An epoch that runs off the end of the file is zero past the end"""
+  fname, x = nsx_file
+  nf = nsx.NsxFile(fname)
+  epochs = nf.epochs([9990.0], 0.0, 100.0)
+  assert numpy.array_equal(epochs[0, :, :20], x[-20:].T)
+  assert (epochs[0, :, 20:] == 0).all()